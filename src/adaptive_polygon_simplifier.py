@@ -4,12 +4,275 @@
 Фокусируется на сохранении точности площади и удалении избыточных точек на прямых линиях.
 """
 
+import concurrent.futures
+import heapq
+import itertools
+import multiprocessing
 import numpy as np
+import shapely
 from shapely.geometry import Polygon
 from shapely.ops import unary_union
 from typing import List, Tuple, Optional
 import math
 
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def _point_segment_distance(px: float, py: float, ax: float, ay: float, bx: float, by: float) -> float:
+    """Расстояние от точки до отрезка (та же формула, что в GEOS)"""
+    dx = bx - ax
+    dy = by - ay
+    len2 = dx * dx + dy * dy
+    if len2 == 0.0:
+        return math.hypot(px - ax, py - ay)
+    r = ((px - ax) * dx + (py - ay) * dy) / len2
+    if r <= 0.0:
+        return math.hypot(px - ax, py - ay)
+    if r >= 1.0:
+        return math.hypot(px - bx, py - by)
+    s = ((ay - py) * dx - (ax - px) * dy) / len2
+    return abs(s) * math.sqrt(len2)
+
+
+def simplify_rings(coords: np.ndarray, offsets: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Douglas-Peucker для набора замкнутых колец, упакованных в один массив
+    
+    Повторяет polygon.simplify(tolerance, preserve_topology=False) из GEOS
+    (включая удаление лишней начальной точки кольца), но без восстановления
+    валидности: невалидный результат нужно проверять отдельно.
+    
+    Args:
+        coords: Точки всех колец подряд, массив (N, 2) float64
+        offsets: Границы колец, кольцо r - coords[offsets[r]:offsets[r + 1]]
+        tolerance: Допуск упрощения
+        
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (точки упрощенных колец, их границы)
+    """
+    n_rings = offsets.shape[0] - 1
+    keep = np.zeros(coords.shape[0], dtype=np.bool_)
+    # Стек отрезков вместо рекурсии
+    stack = np.empty((coords.shape[0], 2), dtype=np.int64)
+    out = np.empty_like(coords)
+    out_offsets = np.zeros(n_rings + 1, dtype=np.int64)
+    total = 0
+    
+    for r in range(n_rings):
+        start = offsets[r]
+        end = offsets[r + 1] - 1
+        keep[start] = True
+        keep[end] = True
+        stack[0, 0] = start
+        stack[0, 1] = end
+        top = 1
+        
+        while top > 0:
+            top -= 1
+            i = stack[top, 0]
+            j = stack[top, 1]
+            if j - i < 2:
+                continue
+            
+            max_dist = -1.0
+            max_index = i
+            for k in range(i + 1, j):
+                dist = _point_segment_distance(coords[k, 0], coords[k, 1],
+                                               coords[i, 0], coords[i, 1], coords[j, 0], coords[j, 1])
+                if dist > max_dist:
+                    max_dist = dist
+                    max_index = k
+            
+            if max_dist > tolerance:
+                keep[max_index] = True
+                stack[top, 0] = i
+                stack[top, 1] = max_index
+                stack[top + 1, 0] = max_index
+                stack[top + 1, 1] = j
+                top += 2
+        
+        count = 0
+        for k in range(start, end + 1):
+            if keep[k]:
+                out[total + count] = coords[k]
+                count += 1
+                keep[k] = False
+        
+        # Начальная точка кольца удаляется, если лежит близко к отрезку между соседями
+        if count >= 4:
+            dist = _point_segment_distance(out[total, 0], out[total, 1], out[total + 1, 0], out[total + 1, 1],
+                                           out[total + count - 2, 0], out[total + count - 2, 1])
+            if dist <= tolerance:
+                for k in range(total, total + count - 2):
+                    out[k] = out[k + 1]
+                out[total + count - 2] = out[total]
+                count -= 1
+        
+        total += count
+        out_offsets[r + 1] = total
+    
+    return out[:total].copy(), out_offsets
+
+
+def ring_measures(coords: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Площади и периметры замкнутых колец, упакованных в один массив
+    
+    Args:
+        coords: Точки всех колец подряд, массив (N, 2) float64
+        offsets: Границы колец
+        
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (площади, периметры)
+    """
+    n_rings = offsets.shape[0] - 1
+    areas = np.zeros(n_rings)
+    lengths = np.zeros(n_rings)
+    
+    for r in range(n_rings):
+        start = offsets[r]
+        end = offsets[r + 1]
+        if end - start < 3:
+            continue
+        
+        # Формула площади со сдвигом на x0, как в GEOS
+        x0 = coords[start, 0]
+        area_sum = 0.0
+        for i in range(start + 1, end - 1):
+            area_sum += (coords[i, 0] - x0) * (coords[i - 1, 1] - coords[i + 1, 1])
+        areas[r] = abs(area_sum / 2.0)
+        
+        length = 0.0
+        for i in range(start + 1, end):
+            length += math.hypot(coords[i, 0] - coords[i - 1, 0], coords[i, 1] - coords[i - 1, 1])
+        lengths[r] = length
+    
+    return areas, lengths
+
+
+def _triangle_area(ax: float, ay: float, bx: float, by: float, cx: float, cy: float) -> float:
+    """Площадь треугольника abc"""
+    return abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)) / 2.0
+
+
+def visvalingam_ring(coords: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Visvalingam-Whyatt для замкнутого кольца с бюджетом точек
+    
+    Вершины с наименьшей площадью треугольника с соседями удаляются по одной
+    (куча с ленивым удалением устаревших записей), пока в кольце не останется
+    max_points вершин. Валидность результата нужно проверять отдельно.
+    
+    Args:
+        coords: Вершины кольца без замыкающей точки, массив (N, 2) float64
+        max_points: Сколько вершин оставить (не меньше 3)
+        
+    Returns:
+        np.ndarray: Индексы оставленных вершин по возрастанию
+    """
+    n = coords.shape[0]
+    prev_index = np.empty(n, dtype=np.int64)
+    next_index = np.empty(n, dtype=np.int64)
+    areas = np.empty(n)
+    removed = np.zeros(n, dtype=np.bool_)
+    
+    for i in range(n):
+        prev_index[i] = (i - 1) % n
+        next_index[i] = (i + 1) % n
+    for i in range(n):
+        p, q = prev_index[i], next_index[i]
+        areas[i] = _triangle_area(coords[p, 0], coords[p, 1], coords[i, 0], coords[i, 1], coords[q, 0], coords[q, 1])
+    
+    heap = [(areas[i], i) for i in range(n)]
+    heapq.heapify(heap)
+    
+    remaining = n
+    while remaining > max(max_points, 3) and heap:
+        area, i = heapq.heappop(heap)
+        if removed[i] or area != areas[i]:
+            continue
+        
+        removed[i] = True
+        remaining -= 1
+        p, q = prev_index[i], next_index[i]
+        next_index[p] = q
+        prev_index[q] = p
+        
+        # Площади соседей меняются: новые записи в кучу, старые станут устаревшими
+        for k in (p, q):
+            a, b = prev_index[k], next_index[k]
+            areas[k] = _triangle_area(coords[a, 0], coords[a, 1], coords[k, 0], coords[k, 1], coords[b, 0], coords[b, 1])
+            heapq.heappush(heap, (areas[k], k))
+    
+    return np.flatnonzero(~removed)
+
+
+if NUMBA_AVAILABLE:
+    _point_segment_distance = njit(cache=True)(_point_segment_distance)
+    _triangle_area = njit(cache=True)(_triangle_area)
+    visvalingam_ring = njit(cache=True)(visvalingam_ring)
+    simplify_rings = njit(cache=True)(simplify_rings)
+    ring_measures = njit(cache=True)(ring_measures)
+
+
+def pack_rings(rings: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Упаковывает список колец (M_i, 2) в один массив и границы колец"""
+    offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(ring) for ring in rings], out=offsets[1:])
+    coords = np.concatenate(rings).astype(np.float64, copy=False) if rings else np.empty((0, 2))
+    return coords, offsets
+
+
+def rings_to_polygons(coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Строит полигоны из упакованных колец одним вызовом GEOS
+    
+    Args:
+        coords: Точки всех колец подряд, массив (N, 2)
+        offsets: Границы колец (каждое кольцо не короче 4 точек)
+        
+    Returns:
+        np.ndarray: Массив shapely полигонов
+    """
+    if len(offsets) < 2:
+        return np.empty(0, dtype=object)
+    ring_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return shapely.polygons(shapely.linearrings(coords, indices=ring_ids))
+
+
+def fast_simplify(polygon: Polygon, tolerance: float, is_convex: bool = False) -> Polygon:
+    """
+    Douglas-Peucker упрощение полигона: быстрый вариант GEOS без сохранения
+    топологии, медленный topology-preserving - только если быстрый сломал полигон
+    
+    Невалидный результат быстрого DP GEOS исправляет сам и может вернуть
+    MultiPolygon или пустую геометрию; тогда упрощение повторяется с
+    preserve_topology=True. DP выпуклого полигона не дает самопересечений,
+    поэтому для него проверка валидности пропускается.
+    
+    Args:
+        polygon: Исходный полигон
+        tolerance: Допуск упрощения
+        is_convex: Полигон выпуклый
+        
+    Returns:
+        Polygon: Упрощенный полигон
+    """
+    simplified = polygon.simplify(tolerance, preserve_topology=False)
+    if simplified.is_empty or simplified.geom_type != 'Polygon' or (not is_convex and not simplified.is_valid):
+        simplified = polygon.simplify(tolerance, preserve_topology=True)
+    return simplified
+
+
+def _simplify_batch_chunk(simplifier: "AdaptivePolygonSimplifier", rings: List[np.ndarray]) -> List[Tuple[Polygon, dict]]:
+    """Упрощает часть колец в процессе пула (функция модуля, чтобы передаваться через pickle)"""
+    return simplifier.simplify_batch(rings)
+
+
 class AdaptivePolygonSimplifier:
     """Адаптивный упроститель полигонов с фокусом на точность площади"""
     
@@ -39,14 +302,31 @@ class AdaptivePolygonSimplifier:
             'max_points': 60,
             'area_preservation_threshold': 0.97  # Сохранить 97% площади
         }
+        
+        # Расписания tolerance и пороги площади для каждого класса сложности,
+        # строятся один раз, чтобы цикл упрощения не обращался к словарям параметров
+        self.schedule_steps = 8
+        self._schedules = {}
+        self._thresholds = {}
+        for complexity, params in (('simple', self.simple_params),
+                                   ('medium', self.default_params),
+                                   ('complex', self.complex_params)):
+            self._schedules[complexity] = np.geomspace(
+                params['min_tolerance'], params['max_tolerance'], self.schedule_steps
+            )
+            self._thresholds[complexity] = params['area_preservation_threshold']
     
-    def simplify_polygon(self, polygon: Polygon, target_points: Optional[int] = None) -> Tuple[Polygon, dict]:
+    def simplify_polygon(self, polygon: Polygon, target_points: Optional[int] = None,
+                         preserve_topology: Optional[bool] = None) -> Tuple[Polygon, dict]:
         """
         Адаптивное упрощение полигона с сохранением точности площади
         
         Args:
             polygon: Исходный полигон
             target_points: Целевое количество точек (None для автоматического выбора)
+            preserve_topology: Режим simplify (None - автоматический выбор:
+                быстрый DP для выпуклых полигонов, повтор с сохранением
+                топологии только для невалидного результата)
             
         Returns:
             Tuple[Polygon, dict]: (упрощенный полигон, метрики качества)
@@ -86,7 +366,7 @@ class AdaptivePolygonSimplifier:
         
         # Адаптивное упрощение с проверкой качества
         best_polygon, best_metrics = self._adaptive_simplify(
-            polygon, target_points, params, complexity
+            polygon, target_points, params, complexity, preserve_topology
         )
         
         # Вычисляем финальные метрики
@@ -103,60 +383,261 @@ class AdaptivePolygonSimplifier:
         
         return best_polygon, final_metrics
     
-    def _adaptive_simplify(self, polygon: Polygon, target_points: int, params: dict, complexity: str) -> Tuple[Polygon, dict]:
+    def simplify_batch(self, rings: List[np.ndarray]) -> List[Tuple[Polygon, dict]]:
+        """
+        Адаптивное упрощение набора полигонов без дыр
+        
+        Дает тот же результат, что simplify_polygon для каждого полигона, но DP
+        на каждом шаге расписания tolerance выполняется одним вызовом для всех
+        полигонов: ядром simplify_rings или, без numba, векторизованным
+        shapely.simplify. Полигоны, для которых быстрый DP дал невалидное
+        кольцо, досчитываются через simplify_polygon.
+        
+        Args:
+            rings: Замкнутые внешние кольца валидных полигонов, массивы (M_i, 2)
+            
+        Returns:
+            List[Tuple[Polygon, dict]]: (упрощенный полигон, метрики качества) для каждого кольца
+        """
+        groups = {'simple': [], 'medium': [], 'complex': []}
+        for index, ring in enumerate(rings):
+            if len(ring) < self.simple_threshold:
+                groups['simple'].append(index)
+            elif len(ring) > self.complex_threshold:
+                groups['complex'].append(index)
+            else:
+                groups['medium'].append(index)
+        
+        results = [None] * len(rings)
+        for complexity, indices in groups.items():
+            if indices:
+                group_results = self._simplify_group([rings[i] for i in indices], complexity)
+                for index, result in zip(indices, group_results):
+                    results[index] = result
+        return results
+    
+    def simplify_batch_parallel(self, rings: List[np.ndarray], max_workers: int,
+                                chunk_size: int = 256) -> List[Tuple[Polygon, dict]]:
+        """
+        simplify_batch, распределенный по процессам частями по chunk_size колец
+        
+        Досчет невалидных колец и запасные методы упрощения идут по одному полигону
+        в Python, поэтому для больших наборов части обрабатываются в отдельных
+        процессах. Небольшие наборы упрощаются в текущем процессе. Процессы
+        запускаются через spawn: fork процесса с инициализированной CUDA и живыми
+        потоками чтения и инференса может зависнуть или испортить контекст CUDA.
+        
+        Args:
+            rings: Замкнутые внешние кольца валидных полигонов, массивы (M_i, 2)
+            max_workers: Количество процессов
+            chunk_size: Количество колец в одной задаче пула
+            
+        Returns:
+            List[Tuple[Polygon, dict]]: Результаты в порядке колец, как у simplify_batch
+        """
+        if max_workers <= 1 or len(rings) <= chunk_size:
+            return self.simplify_batch(rings)
+        
+        chunks = [rings[start:start + chunk_size] for start in range(0, len(rings), chunk_size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(chunks)),
+                                                    mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunk_results = executor.map(_simplify_batch_chunk, itertools.repeat(self), chunks)
+            return [result for results in chunk_results for result in results]
+    
+    def _simplify_group(self, rings: List[np.ndarray], complexity: str) -> List[Tuple[Polygon, dict]]:
+        """Пакетное адаптивное упрощение колец одного класса сложности"""
+        params = {'simple': self.simple_params, 'medium': self.default_params,
+                  'complex': self.complex_params}[complexity]
+        target_points = params['max_points']
+        
+        coords, offsets = pack_rings(rings)
+        polygons = rings_to_polygons(coords, offsets)
+        original_points = np.diff(offsets)
+        original_areas, original_lengths = ring_measures(coords, offsets)
+        target_areas = self._thresholds[complexity] * original_areas
+        inv_orig_areas = np.divide(1.0, original_areas, out=np.zeros(len(rings)), where=original_areas > 0)
+        
+        # Состояние прохода по расписанию для каждого кольца
+        active = original_points > target_points
+        needs_exact = np.zeros(len(rings), dtype=bool)
+        best_scores = np.zeros(len(rings))
+        best = [None] * len(rings)
+        
+        for iteration, tolerance in enumerate(self._schedules[complexity].tolist()):
+            if not active.any():
+                break
+            
+            checked, candidates, areas, lengths, counts = self._simplify_step(
+                coords, offsets, polygons, active, tolerance
+            )
+            
+            # Упрощение слишком агрессивное
+            active &= counts >= 4
+            
+            # Валидность всех активных колец за один вызов GEOS
+            valid = shapely.is_valid(candidates)
+            
+            # GEOS исправил бы невалидное кольцо или перешел бы на сохранение топологии
+            needs_exact[checked[~valid]] = True
+            active[checked[~valid]] = False
+            
+            # Площадь потеряна, большие tolerance ее не вернут
+            active &= areas >= target_areas
+            
+            scores = areas * inv_orig_areas * (target_points / np.maximum(counts, 1))
+            improved = checked[valid & active[checked] & (counts[checked] <= target_points)
+                               & (scores[checked] > best_scores[checked])]
+            best_scores[improved] = scores[improved]
+            candidate_positions = np.searchsorted(checked, improved)
+            for k, position in zip(improved.tolist(), candidate_positions.tolist()):
+                best[k] = (candidates[position], areas[k], lengths[k], tolerance, iteration + 1)
+        
+        results = []
+        for k, polygon in enumerate(polygons):
+            if needs_exact[k]:
+                results.append(self.simplify_polygon(polygon))
+                continue
+            
+            if original_points[k] <= target_points:
+                results.append((polygon, {
+                    'original_points': int(original_points[k]),
+                    'simplified_points': int(original_points[k]),
+                    'area_preserved': 1.0,
+                    'perimeter_preserved': 1.0,
+                    'complexity': complexity,
+                    'method': 'no_simplification_needed'
+                }))
+                continue
+            
+            original_area = original_areas[k]
+            original_length = original_lengths[k]
+            if best[k] is None:
+                polygon, fallback_metrics = self._fallback_simplify(polygon, target_points, params)
+                results.append((polygon, {
+                    'original_points': int(original_points[k]),
+                    'simplified_points': len(polygon.exterior.coords),
+                    'area_preserved': polygon.area / original_area if original_area > 0 else 0,
+                    'perimeter_preserved': polygon.length / original_length if original_length > 0 else 0,
+                    'complexity': complexity,
+                    'method': fallback_metrics.get('method', 'adaptive_simplify'),
+                    'tolerance_used': 0,
+                    'iterations': 0
+                }))
+                continue
+            
+            best_polygon, best_area, best_length, tolerance, iterations = best[k]
+            results.append((best_polygon, {
+                'original_points': int(original_points[k]),
+                'simplified_points': int(shapely.get_num_coordinates(best_polygon)),
+                'area_preserved': best_area / original_area if original_area > 0 else 0,
+                'perimeter_preserved': best_length / original_length if original_length > 0 else 0,
+                'complexity': complexity,
+                'method': 'douglas_peucker',
+                'tolerance_used': tolerance,
+                'iterations': iterations
+            }))
+        
+        return results
+    
+    def _simplify_step(self, coords: np.ndarray, offsets: np.ndarray, polygons: np.ndarray,
+                       active: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                                                      np.ndarray, np.ndarray]:
+        """
+        Один шаг расписания: DP без сохранения топологии для всех активных колец
+        
+        Args:
+            coords, offsets: Упакованные исходные кольца
+            polygons: Исходные полигоны
+            active: Маска колец, которые еще упрощаются
+            tolerance: Tolerance шага
+            
+        Returns:
+            Tuple: (индексы активных колец не короче 4 точек, их упрощенные полигоны,
+                площади, длины и число точек упрощенных колец для всех колец)
+        """
+        if NUMBA_AVAILABLE:
+            simplified, simplified_offsets = simplify_rings(coords, offsets, tolerance)
+            areas, lengths = ring_measures(simplified, simplified_offsets)
+            counts = np.diff(simplified_offsets)
+            
+            # Полигоны строятся одним вызовом GEOS только для проверяемых колец
+            checked_mask = active & (counts >= 4)
+            checked = np.flatnonzero(checked_mask)
+            checked_offsets = np.zeros(len(checked) + 1, dtype=np.int64)
+            np.cumsum(counts[checked], out=checked_offsets[1:])
+            candidates = rings_to_polygons(simplified[np.repeat(checked_mask, counts)], checked_offsets)
+            return checked, candidates, areas, lengths, counts
+        
+        # Без JIT тот же DP выполняет GEOS, но одним векторизованным вызовом
+        indices = np.flatnonzero(active)
+        simplified = shapely.simplify(polygons[indices], tolerance, preserve_topology=False)
+        areas = np.zeros(len(polygons))
+        lengths = np.zeros(len(polygons))
+        counts = np.zeros(len(polygons), dtype=np.int64)
+        areas[indices] = shapely.area(simplified)
+        lengths[indices] = shapely.length(simplified)
+        counts[indices] = shapely.get_num_coordinates(simplified)
+        
+        enough_points = counts[indices] >= 4
+        return indices[enough_points], simplified[enough_points], areas, lengths, counts
+    
+    def _adaptive_simplify(self, polygon: Polygon, target_points: int, params: dict, complexity: str,
+                           preserve_topology: Optional[bool] = None) -> Tuple[Polygon, dict]:
         """Адаптивное упрощение с проверкой качества"""
         
-        min_tolerance = params['min_tolerance']
-        max_tolerance = params['max_tolerance']
-        area_threshold = params['area_preservation_threshold']
+        # Расписание tolerance и порог площади подготовлены в __init__ для класса сложности
+        schedule = self._schedules[complexity]
+        area_threshold = self._thresholds[complexity]
+        original_area = polygon.area
+        original_points = len(polygon.exterior.coords)
+        
+        # Деление и умножение на порог вынесены из цикла: внутри сравнивается
+        # только площадь упрощенного полигона с целевой
+        inv_orig_area = 1.0 / original_area if original_area > 0 else 0.0
+        target_area = area_threshold * original_area
+        
+        # Для выпуклого полигона DP без сохранения топологии дает тот же результат,
+        # поэтому проверяем выпуклость один раз до цикла
+        is_convex = preserve_topology is None and polygon.equals(polygon.convex_hull)
         
         best_polygon = polygon
         best_score = 0
         best_metrics = {}
         
-        # Бинарный поиск оптимального tolerance
-        for iteration in range(12):  # Увеличиваем количество итераций
-            tolerance = (min_tolerance + max_tolerance) / 2
-            
+        # Проход по возрастающему расписанию tolerance: упрощение становится только
+        # агрессивнее, поэтому при потере площади или валидности дальше идти нет смысла
+        for iteration, tolerance in enumerate(schedule.tolist()):
             try:
-                simplified = polygon.simplify(tolerance, preserve_topology=True)
+                simplified = self._simplify_with_tolerance(polygon, tolerance, preserve_topology, is_convex)
                 
                 if not simplified.is_valid or len(simplified.exterior.coords) < 3:
                     # Упрощение слишком агрессивное
-                    max_tolerance = tolerance
-                    continue
+                    break
                 
                 # Проверяем качество упрощения
-                area_preserved = simplified.area / polygon.area if polygon.area > 0 else 0
-                points_count = len(simplified.exterior.coords)
+                simplified_area = simplified.area
+                if simplified_area < target_area:
+                    # Площадь потеряна, большие tolerance ее не вернут
+                    break
                 
-                # Вычисляем оценку качества
-                if area_preserved >= area_threshold:
-                    # Площадь сохранена хорошо
-                    if points_count <= target_points:
-                        # Количество точек подходящее
-                        score = area_preserved * (target_points / max(points_count, 1))
-                        if score > best_score:
-                            best_score = score
-                            best_polygon = simplified
-                            best_metrics = {
-                                'method': 'douglas_peucker',
-                                'tolerance_used': tolerance,
-                                'iterations': iteration + 1,
-                                'area_preserved': area_preserved,
-                                'points_reduction': (len(polygon.exterior.coords) - points_count) / len(polygon.exterior.coords)
-                            }
-                        min_tolerance = tolerance
-                    else:
-                        # Нужно больше упрощения
-                        max_tolerance = tolerance
-                else:
-                    # Площадь потеряна, нужно менее агрессивное упрощение
-                    max_tolerance = tolerance
+                points_count = len(simplified.exterior.coords)
+                if points_count <= target_points:
+                    # Количество точек подходящее
+                    area_preserved = simplified_area * inv_orig_area
+                    score = area_preserved * (target_points / max(points_count, 1))
+                    if score > best_score:
+                        best_score = score
+                        best_polygon = simplified
+                        best_metrics = {
+                            'method': 'douglas_peucker',
+                            'tolerance_used': tolerance,
+                            'iterations': iteration + 1,
+                            'area_preserved': area_preserved,
+                            'points_reduction': (original_points - points_count) / original_points
+                        }
                     
             except Exception as e:
-                max_tolerance = tolerance
-                continue
+                break
         
         # Если не удалось найти хорошее упрощение, пробуем альтернативные методы
         if best_score == 0 or len(best_polygon.exterior.coords) > target_points * 1.5:
@@ -164,6 +645,14 @@ class AdaptivePolygonSimplifier:
         
         return best_polygon, best_metrics
     
+    def _simplify_with_tolerance(self, polygon: Polygon, tolerance: float,
+                                 preserve_topology: Optional[bool], is_convex: bool) -> Polygon:
+        """Упрощение с выбором между быстрым DP и topology-preserving вариантом GEOS"""
+        if preserve_topology is not None:
+            return polygon.simplify(tolerance, preserve_topology=preserve_topology)
+        
+        return fast_simplify(polygon, tolerance, is_convex)
+    
     def _fallback_simplify(self, polygon: Polygon, target_points: int, params: dict) -> Tuple[Polygon, dict]:
         """Альтернативные методы упрощения"""
         
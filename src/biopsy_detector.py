@@ -7,8 +7,32 @@ import json
 import os
 from typing import List, Dict, Tuple, Optional
 from dataclasses import dataclass
+import numpy as np
+import shapely
 
-@dataclass
+from data_structures import DATACLASS_SLOTS
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def _find_containing(x_min: np.ndarray, y_min: np.ndarray, x_max: np.ndarray, y_max: np.ndarray,
+                     x: int, y: int) -> int:
+    """Индекс первого прямоугольника, содержащего точку (-1 если такого нет)"""
+    for i in range(x_min.shape[0]):
+        if x_min[i] <= x <= x_max[i] and y_min[i] <= y <= y_max[i]:
+            return i
+    return -1
+
+
+if NUMBA_AVAILABLE:
+    _find_containing = njit(cache=True)(_find_containing)
+
+
+@dataclass(**DATACLASS_SLOTS)
 class BiopsyRegion:
     """Область биоптата"""
     id: int
@@ -20,7 +44,7 @@ class BiopsyRegion:
     width: int
     height: int
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class GridConfig:
     """Конфигурация сетки"""
     step_x: int
@@ -41,9 +65,18 @@ class BiopsyDetector:
         self.config_path = config_path
         self.biopsy_regions: List[BiopsyRegion] = []
         self.grid_config: Optional[GridConfig] = None
+        self._by_id: Dict[int, BiopsyRegion] = {}
+        self._recommendations: Optional[Dict] = None
         self.wsi_size: Tuple[int, int] = (136192, 77312)
         
+        # Пустые массивы и дерево на случай, если конфигурация не загрузится
+        self._build_region_arrays()
         self._load_config()
+        
+        if NUMBA_AVAILABLE:
+            # Прогрев при создании детектора, а не при импорте модуля: первый реальный
+            # запрос не ждет компиляции (или загрузки ядра из кэша cache=True)
+            _find_containing(self._x_min, self._y_min, self._x_max, self._y_max, 0, 0)
     
     def _load_config(self):
         """Загружает конфигурацию из файла"""
@@ -69,6 +102,10 @@ class BiopsyDetector:
                     )
                     for region in biopsy_data
                 ]
+                # При повторяющихся ID приоритет у первого биоптата, как при линейном поиске
+                self._by_id = {region.id: region for region in reversed(self.biopsy_regions)}
+                self._recommendations = None
+                self._build_region_arrays()
                 
                 # Загружаем конфигурацию сетки
                 grid_data = manual_analysis.get('recommended_grid', {})
@@ -90,6 +127,20 @@ class BiopsyDetector:
         except Exception as e:
             print(f"❌ Ошибка загрузки конфигурации: {e}")
     
+    def _build_region_arrays(self):
+        """Строит SoA массивы границ биоптатов для векторизованных запросов"""
+        self._x_min = np.array([region.x_min for region in self.biopsy_regions], dtype=np.int32)
+        self._y_min = np.array([region.y_min for region in self.biopsy_regions], dtype=np.int32)
+        self._x_max = np.array([region.x_max for region in self.biopsy_regions], dtype=np.int32)
+        self._y_max = np.array([region.y_max for region in self.biopsy_regions], dtype=np.int32)
+        self._widths = np.array([region.width for region in self.biopsy_regions], dtype=np.int64)
+        self._heights = np.array([region.height for region in self.biopsy_regions], dtype=np.int64)
+        
+        # R-tree (STR) индекс по bbox биоптатов для запросов точка/прямоугольник
+        self._region_tree = shapely.STRtree(
+            shapely.box(self._x_min, self._y_min, self._x_max, self._y_max)
+        )
+    
     def get_biopsy_count(self) -> int:
         """Возвращает количество биоптатов"""
         return len(self.biopsy_regions)
@@ -104,18 +155,45 @@ class BiopsyDetector:
     
     def get_biopsy_by_id(self, biopsy_id: int) -> Optional[BiopsyRegion]:
         """Возвращает биоптат по ID"""
-        for region in self.biopsy_regions:
-            if region.id == biopsy_id:
-                return region
-        return None
+        return self._by_id.get(biopsy_id)
     
     def get_biopsy_at_position(self, x: int, y: int) -> Optional[BiopsyRegion]:
         """Возвращает биоптат, содержащий указанную позицию"""
-        for region in self.biopsy_regions:
-            if (region.x_min <= x <= region.x_max and 
-                region.y_min <= y <= region.y_max):
-                return region
-        return None
+        if NUMBA_AVAILABLE:
+            # Для небольшого числа биоптатов скомпилированный линейный проход быстрее дерева
+            index = _find_containing(self._x_min, self._y_min, self._x_max, self._y_max, x, y)
+            return self.biopsy_regions[index] if index >= 0 else None
+        
+        hits = self._region_tree.query(shapely.Point(x, y), predicate='intersects')
+        return self.biopsy_regions[hits.min()] if len(hits) else None
+    
+    def get_biopsies_in_bbox(self, x_min: int, y_min: int, x_max: int, y_max: int) -> List[BiopsyRegion]:
+        """Возвращает биоптаты, пересекающиеся с прямоугольником (например, тайлом)"""
+        hits = self._region_tree.query(shapely.box(x_min, y_min, x_max, y_max), predicate='intersects')
+        return [self.biopsy_regions[i] for i in np.sort(hits)]
+    
+    def get_biopsy_at_position_batch(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Находит биоптаты для набора позиций за один векторизованный проход
+        
+        Args:
+            xs: Координаты X позиций
+            ys: Координаты Y позиций
+        
+        Returns:
+            Индексы биоптатов в biopsy_regions (-1 если позиция вне биоптатов)
+        """
+        xs = np.asarray(xs)[:, None]
+        ys = np.asarray(ys)[:, None]
+        
+        if not self.biopsy_regions:
+            return np.full(xs.shape[0], -1, dtype=np.int64)
+        
+        hits = ((self._x_min <= xs) & (xs <= self._x_max) &
+                (self._y_min <= ys) & (ys <= self._y_max))
+        indices = np.argmax(hits, axis=1)
+        indices[~hits.any(axis=1)] = -1
+        return indices
     
     def get_grid_cell_for_position(self, x: int, y: int) -> Tuple[int, int]:
         """Возвращает координаты ячейки сетки для указанной позиции"""
@@ -151,10 +229,10 @@ class BiopsyDetector:
         if not self.biopsy_regions:
             return {}
         
-        # Вычисляем статистику
-        total_area = sum(region.width * region.height for region in self.biopsy_regions)
-        avg_width = sum(region.width for region in self.biopsy_regions) / len(self.biopsy_regions)
-        avg_height = sum(region.height for region in self.biopsy_regions) / len(self.biopsy_regions)
+        # Вычисляем статистику по SoA массивам размеров
+        total_area = int(np.dot(self._widths, self._heights))
+        avg_width = float(self._widths.mean())
+        avg_height = float(self._heights.mean())
         
         return {
             "biopsy_count": len(self.biopsy_regions),
@@ -165,40 +243,55 @@ class BiopsyDetector:
             "grid_step": f"{self.grid_config.step_x}x{self.grid_config.step_y}" if self.grid_config else "N/A"
         }
     
-    def create_biopsy_mask(self, wsi_size: Tuple[int, int]) -> List[List[bool]]:
+    def create_biopsy_mask(self, wsi_size: Tuple[int, int], downsample: int = 1,
+                           packed: bool = False) -> np.ndarray:
         """
         Создает маску биоптатов для WSI
         
         Args:
             wsi_size: Размеры WSI (width, height)
+            downsample: Шаг прореживания координат (8/16 для полного WSI)
+            packed: Вернуть маску, упакованную np.packbits по оси X
         
         Returns:
-            Маска биоптатов (True если позиция в биоптате)
+            Маска биоптатов формы (height, width) / downsample (True если позиция в биоптате)
         """
         width, height = wsi_size
-        mask = [[False for _ in range(width)] for _ in range(height)]
+        mask_width = -(-width // downsample)
+        mask_height = -(-height // downsample)
+        mask = np.zeros((mask_height, mask_width), dtype=bool)
         
         for region in self.biopsy_regions:
-            for x in range(region.x_min, min(region.x_max, width)):
-                for y in range(region.y_min, min(region.y_max, height)):
-                    mask[y][x] = True
+            x1 = min(region.x_max, width)
+            y1 = min(region.y_max, height)
+            mask[region.y_min // downsample:-(-y1 // downsample),
+                 region.x_min // downsample:-(-x1 // downsample)] = True
+        
+        if packed:
+            return np.packbits(mask, axis=1)
         
         return mask
     
     def get_optimization_recommendations(self) -> Dict:
         """Возвращает рекомендации по оптимизации pipeline"""
+        # Рекомендации зависят только от загруженной конфигурации
+        if self._recommendations is not None:
+            return self._recommendations
+        
         stats = self.get_biopsy_statistics()
+        recommended_biopsy = self.get_biopsy_by_id(1)
+        speedup_factor = stats.get("speedup_factor", 0)
         
-        return {
+        self._recommendations = {
             "detailed_analysis": {
                 "recommended_biopsy_id": 1,
-                "biopsy_name": self.get_biopsy_by_id(1).name if self.get_biopsy_by_id(1) else "N/A",
+                "biopsy_name": recommended_biopsy.name if recommended_biopsy else "N/A",
                 "reason": "Анализ одного биоптата для экстраполяции на остальные"
             },
             "speed_optimization": {
-                "speedup_factor": stats["speedup_factor"],
-                "time_reduction": f"{100 - (100 / stats['speedup_factor']):.1f}%",
-                "reason": f"Обработка 1 из {stats['biopsy_count']} биоптатов"
+                "speedup_factor": speedup_factor,
+                "time_reduction": f"{100 - (100 / speedup_factor):.1f}%" if speedup_factor else "N/A",
+                "reason": f"Обработка 1 из {stats.get('biopsy_count', 0)} биоптатов"
             },
             "grid_optimization": {
                 "grid_step": self.grid_config.step_x if self.grid_config else "N/A",
@@ -206,6 +299,7 @@ class BiopsyDetector:
                 "reason": "Сетка без пересечений с биоптатами"
             }
         }
+        return self._recommendations
 
 def main():
     """Тестирование детектора биоптатов"""
@@ -3,19 +3,51 @@
 Соответствует спецификации WSIYOLO.md
 """
 
-from dataclasses import dataclass
-from typing import Optional, List
+import sys
+import json
+from dataclasses import dataclass, field, InitVar
+from typing import Optional, List, Iterable, Iterator, Tuple
 import numpy as np
 
+# __slots__ вместо __dict__ у мелких и массовых объектов (Coords, Box, ...):
+# меньше памяти на экземпляр и быстрее доступ к атрибутам. Требует Python 3.10+
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
-@dataclass
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _box_iou(ax0: float, ay0: float, ax1: float, ay1: float,
+             bx0: float, by0: float, bx1: float, by1: float) -> float:
+    """IoU двух прямоугольников, заданных координатами углов"""
+    iw = max(0.0, min(ax1, bx1) - max(ax0, bx0))
+    ih = max(0.0, min(ay1, by1) - max(ay0, by0))
+    inter = iw * ih
+    union = (ax1 - ax0) * (ay1 - ay0) + (bx1 - bx0) * (by1 - by0) - inter
+    return inter / union if union > 0.0 else 0.0
+
+
+if NUMBA_AVAILABLE:
+    _box_iou = njit(cache=True, fastmath=True)(_box_iou)
+
+
+@dataclass(**DATACLASS_SLOTS)
 class Coords:
     """Координаты точки"""
     x: float
     y: float
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Box:
     """Прямоугольник с начальной и конечной точками"""
     start: Coords
@@ -48,21 +80,228 @@ class Box:
 
     def iou(self, other: "Box") -> float:
         """Intersection over Union с другим прямоугольником"""
-        inter_area = self.intersection_area(other)
-        union_area = self.area() + other.area() - inter_area
-        return inter_area / union_area if union_area > 0 else 0
+        return _box_iou(
+            float(self.start.x), float(self.start.y), float(self.end.x), float(self.end.y),
+            float(other.start.x), float(other.start.y), float(other.end.x), float(other.end.y),
+        )
+
 
+def coords_to_array(coords: List[Coords]) -> np.ndarray:
+    """Точки полигона в виде массива (N, 2) [x, y]"""
+    return np.fromiter(
+        (value for point in coords for value in (point.x, point.y)),
+        dtype=np.float64,
+        count=2 * len(coords),
+    ).reshape(-1, 2)
 
-@dataclass
+
+@dataclass(**DATACLASS_SLOTS)
 class Prediction:
     """Предсказание модели"""
     class_name: str
     box: Box
     conf: float
-    polygon: Optional[List[Coords]] = None
+    # Точки полигона списком Coords; хранятся в polygon_xy, см. свойство polygon ниже
+    polygon: InitVar[Optional[List[Coords]]] = None
+    # Точки полигона массивом (N, 2) - основное представление
+    polygon_xy: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    # Метрики упрощения полигона (заполняет пайплайн)
+    simplification_metrics: Optional[dict] = field(default=None, repr=False, compare=False)
+    # Кэш shapely-полигона для polygon_xy (заполняет ImprovedPolygonMerger)
+    _shapely_cache: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+    # Кэш списка Coords для polygon_xy, строится при первом обращении к polygon
+    _polygon_cache: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self, polygon: Optional[List[Coords]]):
+        if polygon:
+            if self.polygon_xy is None:
+                self.polygon_xy = coords_to_array(polygon)
+            self._polygon_cache = (self.polygon_xy, polygon)
+
+    def _get_polygon(self) -> Optional[List[Coords]]:
+        """Точки полигона списком Coords (создаются лениво из polygon_xy)"""
+        if self.polygon_xy is None:
+            return None
+        cached = self._polygon_cache
+        if cached is not None and cached[0] is self.polygon_xy:
+            return cached[1]
+        polygon = [Coords(x=x, y=y) for x, y in self.polygon_xy.tolist()]
+        self._polygon_cache = (self.polygon_xy, polygon)
+        return polygon
+
+    def _set_polygon(self, polygon: Optional[List[Coords]]):
+        self.polygon_xy = coords_to_array(polygon) if polygon else None
+        self._polygon_cache = (self.polygon_xy, polygon) if polygon else None
+
+    @property
+    def num_points(self) -> int:
+        """Количество точек полигона (без создания Coords)"""
+        return 0 if self.polygon_xy is None else len(self.polygon_xy)
+
+
+# Свойство назначается после создания класса, чтобы dataclass видел polygon как InitVar
+Prediction.polygon = property(Prediction._get_polygon, Prediction._set_polygon)
+
+
+# Запись предсказания в структурированном массиве: одна строка вместо
+# четырех объектов (Coords, Coords, Box, Prediction) на детекцию
+PREDICTION_DTYPE = np.dtype([
+    ('class_name', 'U32'),
+    ('conf', 'f8'),
+    ('x1', 'f8'),
+    ('y1', 'f8'),
+    ('x2', 'f8'),
+    ('y2', 'f8'),
+])
+
+
+def predictions_to_records(predictions: List[Prediction]) -> np.ndarray:
+    """Предсказания в виде структурированного массива PREDICTION_DTYPE (без полигонов)"""
+    return np.array(
+        [(p.class_name, p.conf, p.box.start.x, p.box.start.y, p.box.end.x, p.box.end.y) for p in predictions],
+        dtype=PREDICTION_DTYPE,
+    )
+
+
+def records_to_predictions(records: np.ndarray,
+                           polygons: Optional[List[Optional[np.ndarray]]] = None) -> List[Prediction]:
+    """
+    Создает Prediction для записей структурированного массива
+    
+    Args:
+        records: Массив PREDICTION_DTYPE
+        polygons: Точки полигонов (N, 2) для каждой записи (или None)
+        
+    Returns:
+        List[Prediction]: Предсказания в исходном порядке
+    """
+    if polygons is None:
+        polygons = [None] * len(records)
+    return [
+        Prediction(
+            class_name=class_name,
+            box=Box(start=Coords(x=x1, y=y1), end=Coords(x=x2, y=y2)),
+            conf=conf,
+            polygon_xy=polygon_xy,
+        )
+        for (class_name, conf, x1, y1, x2, y2), polygon_xy in zip(records.tolist(), polygons)
+    ]
+
+
+def prediction_to_dict(pred: Prediction) -> dict:
+    """Словарь предсказания для JSON: класс, уверенность, box и точки полигона (если есть)"""
+    pred_data = {
+        'class_name': pred.class_name,
+        'confidence': pred.conf,
+        'box': {
+            'start': {'x': pred.box.start.x, 'y': pred.box.start.y},
+            'end': {'x': pred.box.end.x, 'y': pred.box.end.y}
+        }
+    }
+    if pred.num_points:
+        pred_data['polygon'] = [{'x': x, 'y': y} for x, y in pred.polygon_xy.tolist()]
+    return pred_data
+
+
+def write_predictions_json(path: str, header: dict, predictions: Iterable[Prediction]):
+    """
+    Записывает JSON {**header, "predictions": [...]} с отступом 2 по одному предсказанию
+    
+    Словарь каждого предсказания строится, кодируется и пишется в файл сразу,
+    поэтому в памяти нет ни словарей всех предсказаний, ни всего JSON целиком.
+    Файл побайтно совпадает с кодированием всего словаря одним вызовом
+    (orjson с OPT_INDENT_2, если установлен, иначе json с indent=2); вывод всегда UTF-8.
+    
+    Args:
+        path: Путь к файлу
+        header: Поля JSON перед списком предсказаний
+        predictions: Предсказания
+    """
+    if ORJSON_AVAILABLE:
+        def encode(obj) -> bytes:
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2)
+    else:
+        def encode(obj) -> bytes:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    
+    # Заголовок до открывающей скобки списка: кодируем его с пустым списком и отрезаем "[]\n}"
+    head = encode({**header, 'predictions': []})[:-len(b'[]\n}')]
+    
+    with open(path, 'wb') as f:
+        f.write(head + b'[')
+        separator = b'\n    '
+        for pred in predictions:
+            # Элемент списка находится на втором уровне вложенности: сдвигаем его строки на 4 пробела
+            f.write(separator + encode(prediction_to_dict(pred)).replace(b'\n', b'\n    '))
+            separator = b',\n    '
+        f.write(b']\n}' if separator == b'\n    ' else b'\n  ]\n}')
+
+
+def boxes_to_array(predictions: List[Prediction]) -> np.ndarray:
+    """Bounding boxes предсказаний в виде массива (N, 4) [x1, y1, x2, y2]"""
+    return np.array(
+        [(p.box.start.x, p.box.start.y, p.box.end.x, p.box.end.y) for p in predictions],
+        dtype=np.float64,
+    ).reshape(-1, 4)
+
+
+def box_iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Матрица IoU (N, M) между массивами прямоугольников (N, 4) и (M, 4)"""
+    inter_x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    inter_y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    inter_x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    inter_y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter_area = np.clip(inter_x2 - inter_x1, 0, None) * np.clip(inter_y2 - inter_y1, 0, None)
+
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union_area = area_a[:, None] + area_b[None, :] - inter_area
+
+    iou = np.zeros_like(inter_area)
+    np.divide(inter_area, union_area, out=iou, where=union_area > 0)
+    return iou
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    """Раздвигает младшие 32 бита значений в четные биты uint64 (0b1011 -> 0b1000101)"""
+    v = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def morton_order(cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Порядок обхода клеток сетки по кривой Мортона (Z-order)
+    
+    Соседние тайлы идут подряд блоками 2x2, 4x4, ..., поэтому кэш тайлов
+    декодера WSI переиспользуется лучше, чем при обходе по строкам.
+    
+    Args:
+        cols, rows: Неотрицательные индексы столбцов и строк клеток (N,)
+        
+    Returns:
+        np.ndarray: Индексы клеток (N,) в порядке обхода
+    """
+    return np.argsort(_spread_bits(cols) | (_spread_bits(rows) << np.uint64(1)), kind='stable')
+
+
+def box_iou_pairs(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """IoU (N,) построчно сопоставленных прямоугольников a[k] и b[k] из массивов (N, 4)"""
+    inter_w = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    inter_area = inter_w * inter_h
+    union_area = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - inter_area
 
+    iou = np.zeros_like(inter_area)
+    np.divide(inter_area, union_area, out=iou, where=union_area > 0)
+    return iou
 
-@dataclass
+
+@dataclass(**DATACLASS_SLOTS)
 class Model:
     """Конфигурация модели"""
     model_path: str
@@ -77,18 +316,87 @@ class Model:
             raise ValueError("min_conf должен быть между 0 и 1")
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class PatchInfo:
     """Информация о патче"""
     patch_id: int
     x: int  # Абсолютная координата X в WSI
     y: int  # Абсолютная координата Y в WSI
     size: int  # Размер патча
-    image: np.ndarray  # Изображение патча
+    image: np.ndarray  # Изображение патча (H, W, 3); при чтении на GPU - массив CuPy
     has_tissue: bool = True  # Содержит ли патч ткань
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
+class PatchBatch:
+    """Пакет патчей в виде отдельных массивов по полям (вместо списка PatchInfo)"""
+    patch_ids: np.ndarray  # (N,) идентификаторы патчей
+    xs: np.ndarray  # (N,) абсолютные координаты X в WSI
+    ys: np.ndarray  # (N,) абсолютные координаты Y в WSI
+    sizes: np.ndarray  # (N,) размеры патчей
+    has_tissue: np.ndarray  # (N,) bool, содержит ли патч ткань
+    images: np.ndarray  # (N, H, W, C) изображения патчей одним непрерывным массивом
+
+    @classmethod
+    def from_patches(cls, patches: List[PatchInfo]) -> "PatchBatch":
+        """
+        Собирает пакет из списка PatchInfo
+        
+        Args:
+            patches: Патчи одинакового размера
+            
+        Returns:
+            PatchBatch с данными патчей
+        """
+        if not patches:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(empty, empty, empty, empty, np.empty(0, dtype=bool), np.empty((0, 0, 0, 0), dtype=np.uint8))
+        
+        return cls(
+            patch_ids=np.fromiter((p.patch_id for p in patches), dtype=np.int64, count=len(patches)),
+            xs=np.fromiter((p.x for p in patches), dtype=np.int64, count=len(patches)),
+            ys=np.fromiter((p.y for p in patches), dtype=np.int64, count=len(patches)),
+            sizes=np.fromiter((p.size for p in patches), dtype=np.int64, count=len(patches)),
+            has_tissue=np.fromiter((p.has_tissue for p in patches), dtype=bool, count=len(patches)),
+            images=np.stack([p.image for p in patches]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    def tissue_only(self) -> "PatchBatch":
+        """Пакет только из патчей с тканью (одна операция маскирования на поле)"""
+        mask = self.has_tissue
+        return PatchBatch(
+            patch_ids=self.patch_ids[mask],
+            xs=self.xs[mask],
+            ys=self.ys[mask],
+            sizes=self.sizes[mask],
+            has_tissue=self.has_tissue[mask],
+            images=self.images[mask],
+        )
+
+    def iter_patches(self) -> Iterator[Tuple[int, int, int, np.ndarray]]:
+        """Итерирует (patch_id, x, y, image) без создания PatchInfo; image - view в images"""
+        for i in range(len(self)):
+            yield int(self.patch_ids[i]), int(self.xs[i]), int(self.ys[i]), self.images[i]
+
+    def to_patches(self) -> List[PatchInfo]:
+        """Обратное преобразование в список PatchInfo (изображения - views)"""
+        return [
+            PatchInfo(
+                patch_id=int(self.patch_ids[i]),
+                x=int(self.xs[i]),
+                y=int(self.ys[i]),
+                size=int(self.sizes[i]),
+                image=self.images[i],
+                has_tissue=bool(self.has_tissue[i]),
+            )
+            for i in range(len(self))
+        ]
+
+
+@dataclass(**DATACLASS_SLOTS)
 class WSIInfo:
     """Информация о WSI"""
     path: str
@@ -4,14 +4,22 @@
 и фильтрацию коротких сегментов для lp модели.
 """
 
-from typing import List, Tuple, Optional
+import concurrent.futures
+import logging
+import math
+import os
+from typing import List, Tuple, Optional, Union
 import numpy as np
-from shapely.geometry import Polygon, MultiPolygon
-from shapely.ops import unary_union
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
 from shapely.validation import make_valid
 
-from data_structures import Prediction, Coords, Box
+from data_structures import Prediction, Coords, Box, boxes_to_array, box_iou_pairs, records_to_predictions
+from adaptive_polygon_simplifier import fast_simplify, pack_rings, rings_to_polygons
+from polygon_merger import union_polygons
 
+logger = logging.getLogger(__name__)
 
 class ImprovedPolygonMerger:
     """Улучшенный класс для объединения перекрывающихся полигонов"""
@@ -38,49 +46,111 @@ class ImprovedPolygonMerger:
         self.lp_class_name = lp_class_name
         self.background_class = background_class
     
-    def merge_predictions(self, predictions: List[Prediction]) -> List[Prediction]:
+    def merge_predictions(self, predictions: Union[List[Prediction], np.ndarray],
+                          polygons: Optional[List[Optional[np.ndarray]]] = None) -> List[Prediction]:
         """
         Объединяет перекрывающиеся предсказания с улучшенной фильтрацией
         
         Args:
-            predictions: Список предсказаний
+            predictions: Список предсказаний или структурированный массив PREDICTION_DTYPE
+            polygons: Точки полигонов (N, 2) для записей массива (только вместе с массивом)
             
         Returns:
             List[Prediction]: Объединенные предсказания
         """
-        if not predictions:
+        if len(predictions) == 0:
             return []
         
         print(f"🔧 Улучшенное объединение {len(predictions)} предсказаний...")
         
-        # 1. Фильтрация background класса для lp модели
-        filtered_predictions = self._filter_background_class(predictions)
-        print(f"   После фильтрации background: {len(filtered_predictions)}")
-        
-        # 2. Фильтрация коротких сегментов для lp класса
-        filtered_predictions = self._filter_short_segments(filtered_predictions)
-        print(f"   После фильтрации коротких сегментов: {len(filtered_predictions)}")
+        if isinstance(predictions, np.ndarray):
+            # 1-2. Для массива фильтры считаются по столбцам, а Prediction
+            # создаются только для прошедших фильтры записей
+            filtered_predictions = self._filter_records(predictions, polygons)
+        else:
+            # 1. Фильтрация background класса для lp модели
+            filtered_predictions = self._filter_background_class(predictions)
+            print(f"   После фильтрации background: {len(filtered_predictions)}")
+            
+            # 2. Фильтрация коротких сегментов для lp класса
+            filtered_predictions = self._filter_short_segments(filtered_predictions)
+            print(f"   После фильтрации коротких сегментов: {len(filtered_predictions)}")
         
         # 3. Группировка по классам
         grouped_predictions = self._group_by_class(filtered_predictions)
         
+        # 4-5. Один пул потоков на вызов; параллельно идет только объединение полигонов (см. union_polygons)
+        max_workers = os.cpu_count() or 1
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        
         merged_predictions = []
         
-        for class_name, class_predictions in grouped_predictions.items():
-            print(f"   Обработка класса {class_name}: {len(class_predictions)} предсказаний")
-            
-            # 4. Фильтрация вложенных объектов для lp класса
-            if class_name == self.lp_class_name:
-                class_predictions = self._filter_nested_objects(class_predictions)
-                print(f"   После фильтрации вложенных объектов: {len(class_predictions)}")
-            
-            # 5. Объединение предсказаний класса
-            merged_class_predictions = self._merge_class_predictions(class_predictions)
-            merged_predictions.extend(merged_class_predictions)
+        try:
+            for class_name, class_predictions in grouped_predictions.items():
+                print(f"   Обработка класса {class_name}: {len(class_predictions)} предсказаний")
+                kept_predictions, merged_class_predictions = self._process_class_predictions(
+                    class_name, class_predictions, executor)
+                if class_name == self.lp_class_name:
+                    print(f"   После фильтрации вложенных объектов: {len(kept_predictions)}")
+                merged_predictions.extend(merged_class_predictions)
+        finally:
+            if executor is not None:
+                executor.shutdown()
         
         print(f"   Финальный результат: {len(merged_predictions)} предсказаний")
         return merged_predictions
     
+    def _process_class_predictions(self, class_name: str, class_predictions: List[Prediction],
+                                   executor: Optional[concurrent.futures.Executor] = None
+                                   ) -> Tuple[List[Prediction], List[Prediction]]:
+        """
+        Обрабатывает предсказания одного класса: фильтрация вложенных объектов
+        (для lp класса) и объединение
+        
+        Args:
+            class_name: Название класса
+            class_predictions: Предсказания этого класса
+            executor: Пул потоков для объединения полигонов (None - последовательно)
+            
+        Returns:
+            Tuple[List[Prediction], List[Prediction]]: (предсказания после фильтрации, объединенные предсказания)
+        """
+        # Фильтрация вложенных объектов для lp класса
+        if class_name == self.lp_class_name:
+            class_predictions = self._filter_nested_objects(class_predictions)
+        
+        # Объединение предсказаний класса
+        return class_predictions, self._merge_class_predictions(class_predictions, executor)
+    
+    def _filter_records(self, records: np.ndarray,
+                        polygons: Optional[List[Optional[np.ndarray]]]) -> List[Prediction]:
+        """
+        Фильтрация background класса и коротких lp сегментов для структурированного массива
+        
+        Args:
+            records: Массив PREDICTION_DTYPE
+            polygons: Точки полигонов (N, 2) для каждой записи (или None)
+            
+        Returns:
+            List[Prediction]: Предсказания, прошедшие оба фильтра
+        """
+        if polygons is None:
+            polygons = [None] * len(records)
+        class_names = records['class_name']
+        
+        # 1. Фильтрация background класса
+        keep = np.char.lower(class_names) != self.background_class.lower()
+        print(f"   После фильтрации background: {int(keep.sum())}")
+        
+        # 2. Фильтрация коротких сегментов для lp класса (полигон без точек не считается)
+        num_points = np.fromiter((0 if xy is None else len(xy) for xy in polygons),
+                                 dtype=np.int64, count=len(polygons))
+        keep &= ~((class_names == self.lp_class_name) & (num_points > 0) & (num_points < self.min_polygon_points))
+        print(f"   После фильтрации коротких сегментов: {int(keep.sum())}")
+        
+        kept = np.flatnonzero(keep)
+        return records_to_predictions(records[kept], [polygons[i] for i in kept])
+    
     def _filter_background_class(self, predictions: List[Prediction]) -> List[Prediction]:
         """
         Исключает background класс из предсказаний lp модели
@@ -96,7 +166,7 @@ class ImprovedPolygonMerger:
         for pred in predictions:
             # Исключаем background класс
             if pred.class_name.lower() == self.background_class.lower():
-                print(f"   Исключен background класс: {pred.class_name}")
+                logger.debug("Исключен background класс: %s", pred.class_name)
                 continue
             
             filtered.append(pred)
@@ -117,12 +187,12 @@ class ImprovedPolygonMerger:
         
         for pred in predictions:
             # Проверяем только lp класс
-            if pred.class_name == self.lp_class_name and pred.polygon:
-                polygon_points = len(pred.polygon)
+            if pred.class_name == self.lp_class_name and pred.num_points:
+                polygon_points = pred.num_points
                 
                 # Фильтруем короткие сегменты
                 if polygon_points < self.min_polygon_points:
-                    print(f"   Исключен короткий сегмент lp: {polygon_points} точек")
+                    logger.debug("Исключен короткий сегмент lp: %d точек", polygon_points)
                     continue
             
             filtered.append(pred)
@@ -143,62 +213,190 @@ class ImprovedPolygonMerger:
             return predictions
         
         # Создаем полигоны для проверки вложенности
-        polygons_with_predictions = []
+        candidate_predictions = [pred for pred in predictions if pred.num_points >= 3]
+        try:
+            polygons = self._to_shapely_batch(candidate_predictions)
+        except Exception as e:
+            logger.warning("Ошибка создания полигонов: %s", e)
+            return predictions
         
-        for pred in predictions:
-            if pred.polygon and len(pred.polygon) >= 3:
-                try:
-                    coords = [(p.x, p.y) for p in pred.polygon]
-                    poly = Polygon(coords)
-                    if poly.is_valid:
-                        polygons_with_predictions.append((poly, pred))
-                except Exception as e:
-                    print(f"   ⚠️  Ошибка создания полигона: {e}")
-                    continue
+        # Валидность и площади считаются одним вызовом GEOS для всего массива
+        polygons = np.array(polygons, dtype=object)
+        valid = shapely.is_valid(polygons)
+        polygons = polygons[valid]
+        candidate_predictions = [pred for pred, is_valid in zip(candidate_predictions, valid) if is_valid]
         
-        if not polygons_with_predictions:
+        if not candidate_predictions:
             return predictions
         
         # Сортируем по площади (от больших к маленьким)
-        polygons_with_predictions.sort(key=lambda x: x[0].area, reverse=True)
+        areas = shapely.area(polygons)
+        order = np.argsort(-areas, kind='stable')
+        polygons = polygons[order]
+        areas = areas[order]
+        candidate_predictions = [candidate_predictions[k] for k in order]
+        
+        # Подготовленные геометрии (GEOSPreparedGeometry): индекс ребер строится один раз
+        # на полигон и переиспользуется во всех проверках, где он стоит первым аргументом
+        shapely.prepare(polygons)
+        
+        # Пространственный индекс: вложенность возможна только у пересекающихся полигонов.
+        # Берем пары (меньший i, больший j), сгруппированные по i в порядке j
+        tree = STRtree(polygons)
+        pair_i, pair_j = tree.query(polygons, predicate='intersects')
+        larger = pair_j < pair_i
+        pair_i, pair_j = pair_i[larger], pair_j[larger]
+        pair_order = np.lexsort((pair_j, pair_i))
+        pair_i, pair_j = pair_i[pair_order], pair_j[pair_order]
+        
+        # Дешевые проверки по bbox перед вызовами GEOS
+        bounds = shapely.bounds(polygons)
+        bounds_i, bounds_j = bounds[pair_i], bounds[pair_j]
+        
+        # Вложение возможно только если bbox меньшего полигона лежит внутри bbox большего
+        bbox_inside = ((bounds_i[:, 0] >= bounds_j[:, 0]) & (bounds_i[:, 1] >= bounds_j[:, 1]) &
+                       (bounds_i[:, 2] <= bounds_j[:, 2]) & (bounds_i[:, 3] <= bounds_j[:, 3]))
+        
+        # Проверки вложенности за один векторизованный вызов на операцию.
+        # poly1.within(poly2) эквивалентно poly2.contains(poly1), а contains использует
+        # подготовленный больший полигон, поэтому within отдельно не вызываем
+        contains_checks = np.zeros(len(pair_i), dtype=bool)
+        contains_checks[bbox_inside] = shapely.contains(
+            polygons[pair_j[bbox_inside]], polygons[pair_i[bbox_inside]]
+        )
+        within_checks = contains_checks
+        
+        # Площадь пересечения полигонов не больше площади пересечения их bbox:
+        # если даже она не дает долю > 0.8, точное пересечение не считаем (NaN)
+        bbox_overlap = (
+            np.clip(np.minimum(bounds_i[:, 2], bounds_j[:, 2]) - np.maximum(bounds_i[:, 0], bounds_j[:, 0]), 0, None) *
+            np.clip(np.minimum(bounds_i[:, 3], bounds_j[:, 3]) - np.maximum(bounds_i[:, 1], bounds_j[:, 1]), 0, None)
+        )
+        ratio_upper_bound = np.divide(bbox_overlap, areas[pair_i],
+                                      out=np.zeros(len(pair_i)), where=areas[pair_i] > 0)
+        
+        # Площадь пересечения нужна только там, где полного вложения нет
+        # (при вложении пересечение совпадает с меньшим полигоном)
+        intersection_ratios = np.ones(len(pair_i))
+        intersection_ratios[ratio_upper_bound <= 0.8] = np.nan
+        need_ratio = ~(within_checks | contains_checks) & (ratio_upper_bound > 0.8)
+        ratio_i, ratio_j = pair_i[need_ratio], pair_j[need_ratio]
+        intersection_areas = shapely.area(shapely.intersection(polygons[ratio_i], polygons[ratio_j]))
+        intersection_ratios[need_ratio] = np.divide(
+            intersection_areas, areas[ratio_i],
+            out=np.zeros(len(ratio_i)), where=areas[ratio_i] > 0
+        )
+        
+        # Объект считается вложенным если:
+        # 1. Он полностью внутри другого (within)
+        # 2. Другой объект содержит его (contains) 
+        # 3. Большая часть его площади пересекается с другим объектом (>80%)
+        nested_pairs = within_checks | contains_checks | (intersection_ratios > 0.8)
+        
+        pair_starts = np.searchsorted(pair_i, np.arange(len(polygons)), side='left')
+        pair_ends = np.searchsorted(pair_i, np.arange(len(polygons)), side='right')
+        is_kept = np.zeros(len(polygons), dtype=bool)
+        
+        # Форматирование отладочных сообщений в цикле выполняется только при уровне DEBUG
+        debug = logger.isEnabledFor(logging.DEBUG)
         
         # Проверяем вложенность - оставляем только самые большие объекты
         filtered_predictions = []
         
-        for i, (poly1, pred1) in enumerate(polygons_with_predictions):
+        for i, pred1 in enumerate(candidate_predictions):
             is_nested = False
             
-            # Проверяем только с уже отфильтрованными (большими) объектами
-            for j, pred2 in enumerate(filtered_predictions):
-                # Создаем полигон для pred2
-                if pred2.polygon:
-                    coords2 = [(p.x, p.y) for p in pred2.polygon]
-                    poly2 = Polygon(coords2)
-                else:
+            # Проверяем только с уже отфильтрованными (большими) объектами,
+            # в порядке их добавления
+            for k in range(pair_starts[i], pair_ends[i]):
+                j = pair_j[k]
+                if not is_kept[j]:
                     continue
-                # Проверяем различные типы вложенности
-                within_check = poly1.within(poly2)
-                contains_check = poly2.contains(poly1)
-                intersection_ratio = poly1.intersection(poly2).area / poly1.area if poly1.area > 0 else 0
                 
-                print(f"   Проверка вложенности: poly1({poly1.area:.1f}) vs poly2({poly2.area:.1f})")
-                print(f"     within: {within_check}, contains: {contains_check}, intersection_ratio: {intersection_ratio:.3f}")
+                if debug:
+                    logger.debug(
+                        "Проверка вложенности: poly1(%.1f) vs poly2(%.1f) - within: %s, contains: %s, intersection_ratio: %.3f",
+                        areas[i], areas[j], within_checks[k], contains_checks[k], intersection_ratios[k]
+                    )
                 
-                # Объект считается вложенным если:
-                # 1. Он полностью внутри другого (within)
-                # 2. Другой объект содержит его (contains) 
-                # 3. Большая часть его площади пересекается с другим объектом (>80%)
-                if within_check or contains_check or intersection_ratio > 0.8:
-                    print(f"   Исключен вложенный объект lp: площадь {poly1.area:.1f} вложена в {poly2.area:.1f}")
+                if nested_pairs[k]:
+                    if debug:
+                        logger.debug("Исключен вложенный объект lp: площадь %.1f вложена в %.1f", areas[i], areas[j])
                     is_nested = True
                     break
             
             if not is_nested:
+                is_kept[i] = True
                 filtered_predictions.append(pred1)
-                print(f"   Сохранен объект lp: площадь {poly1.area:.1f}")
+                if debug:
+                    logger.debug("Сохранен объект lp: площадь %.1f", areas[i])
         
         return filtered_predictions
     
+    def cached_polygon(self, pred: Prediction) -> Optional[Polygon]:
+        """
+        Shapely полигон, уже построенный для текущего pred.polygon_xy, без создания нового
+        
+        Предсказания, полученные объединением, несут исходный полигон объединения,
+        поэтому следующие этапы могут не строить его заново из точек.
+        
+        Args:
+            pred: Предсказание
+            
+        Returns:
+            Optional[Polygon]: Кэшированный полигон или None, если его нет
+        """
+        cached = pred._shapely_cache
+        if cached is not None and cached[0] is pred.polygon_xy:
+            return cached[1]
+        return None
+    
+    def _to_shapely(self, pred: Prediction) -> Optional[Polygon]:
+        """
+        Возвращает shapely полигон предсказания, создавая его не более одного раза
+        
+        Полигон кэшируется на предсказании вместе с массивом точек pred.polygon_xy,
+        из которого он построен, поэтому замена массива сбрасывает кэш.
+        
+        Args:
+            pred: Предсказание
+            
+        Returns:
+            Optional[Polygon]: Полигон или None, если точек меньше трех
+        """
+        cached = pred._shapely_cache
+        if cached is not None and cached[0] is pred.polygon_xy:
+            return cached[1]
+        
+        poly = None
+        if pred.polygon_xy is not None and len(pred.polygon_xy) >= 3:
+            poly = Polygon(pred.polygon_xy)
+        
+        pred._shapely_cache = (pred.polygon_xy, poly)
+        return poly
+    
+    def _to_shapely_batch(self, predictions: List[Prediction]) -> List[Polygon]:
+        """
+        Полигоны для списка предсказаний, недостающие строятся одним вызовом GEOS
+        
+        Кольца предсказаний без кэшированного полигона упаковываются в один массив
+        и передаются в shapely.polygons, построенные полигоны сохраняются в кэш.
+        
+        Args:
+            predictions: Предсказания с polygon_xy не короче трех точек
+            
+        Returns:
+            List[Polygon]: Полигоны в порядке предсказаний
+        """
+        polygons = [self.cached_polygon(pred) for pred in predictions]
+        missing = [k for k, poly in enumerate(polygons) if poly is None]
+        if missing:
+            built = rings_to_polygons(*pack_rings([predictions[k].polygon_xy for k in missing]))
+            for k, poly in zip(missing, built):
+                predictions[k]._shapely_cache = (predictions[k].polygon_xy, poly)
+                polygons[k] = poly
+        return polygons
+    
     def _group_by_class(self, predictions: List[Prediction]) -> dict:
         """
         Группирует предсказания по классам
@@ -209,19 +407,29 @@ class ImprovedPolygonMerger:
         Returns:
             dict: Словарь {class_name: [predictions]}
         """
+        class_names = np.array([pred.class_name for pred in predictions])
+        unique_names, first_indices, class_indices, counts = np.unique(
+            class_names, return_index=True, return_inverse=True, return_counts=True
+        )
+        
+        # Индексы предсказаний, отсортированные по классу (внутри класса - исходный порядок)
+        order = np.argsort(class_indices, kind='stable')
+        class_groups = np.split(order, np.cumsum(counts)[:-1])
+        
+        # Классы в порядке первого появления, как при группировке словарем
         grouped = {}
-        for pred in predictions:
-            if pred.class_name not in grouped:
-                grouped[pred.class_name] = []
-            grouped[pred.class_name].append(pred)
+        for k in np.argsort(first_indices):
+            grouped[str(unique_names[k])] = [predictions[i] for i in class_groups[k]]
         return grouped
     
-    def _merge_class_predictions(self, predictions: List[Prediction]) -> List[Prediction]:
+    def _merge_class_predictions(self, predictions: List[Prediction],
+                                 executor: Optional[concurrent.futures.Executor] = None) -> List[Prediction]:
         """
         Объединяет предсказания одного класса с улучшенной фильтрацией
         
         Args:
             predictions: Список предсказаний одного класса
+            executor: Пул потоков для объединения полигонов (None - последовательно)
             
         Returns:
             List[Prediction]: Объединенные предсказания
@@ -229,55 +437,48 @@ class ImprovedPolygonMerger:
         if len(predictions) <= 1:
             return predictions
         
-        # Создаем полигоны из предсказаний
-        polygons = []
-        
-        for i, pred in enumerate(predictions):
-            if pred.polygon:
-                try:
-                    coords = [(p.x, p.y) for p in pred.polygon]
-                    if len(coords) >= 3:
-                        poly = Polygon(coords)
-                        if poly.is_valid:
-                            polygons.append(poly)
-                        else:
-                            print(f"   ⚠️  Невалидный полигон для предсказания {i}")
-                    else:
-                        print(f"   ⚠️  Недостаточно точек для полигона {i}: {len(coords)}")
-                except Exception as e:
-                    print(f"   ⚠️  Ошибка создания полигона {i}: {e}")
-                    continue
+        # Создаем полигоны из предсказаний (минимум 3 точки для полигона)
+        with_points = [pred for pred in predictions if pred.num_points]
+        candidates = [pred for pred in with_points if pred.num_points >= 3]
+        try:
+            polygons = np.array(self._to_shapely_batch(candidates), dtype=object)
+        except Exception as e:
+            logger.warning("Ошибка создания полигонов (класс: %s): %s", predictions[0].class_name, e)
+            return predictions
+        
+        # Отбрасываем невалидные полигоны одним вызовом shapely.is_valid
+        valid = shapely.is_valid(polygons)
+        num_short = len(with_points) - len(candidates)
+        num_invalid = len(valid) - int(np.count_nonzero(valid))
+        if num_short or num_invalid:
+            logger.warning("Отброшено полигонов класса %s: %d с числом точек меньше трех, %d невалидных",
+                           predictions[0].class_name, num_short, num_invalid)
+        polygons = polygons[valid].tolist()
         
         if not polygons:
             return predictions
         
         # Объединяем полигоны
         try:
-            merged_polygons = unary_union(polygons)
+            merged_polygons = union_polygons(np.array(polygons, dtype=object), executor)
             
-            if merged_polygons.is_empty:
+            if not merged_polygons:
                 return predictions
             
             # Создаем новые предсказания из объединенных полигонов
             merged_predictions = []
             class_name = predictions[0].class_name if predictions else "unknown"
             
-            if isinstance(merged_polygons, MultiPolygon):
-                for poly in merged_polygons.geoms:
-                    if poly.area >= self.min_area:
-                        merged_pred = self._polygon_to_prediction(poly, class_name)
-                        if merged_pred:
-                            merged_predictions.append(merged_pred)
-            else:
-                if merged_polygons.area >= self.min_area:
-                    merged_pred = self._polygon_to_prediction(merged_polygons, class_name)
+            for poly, area in zip(merged_polygons, shapely.area(merged_polygons).tolist()):
+                if area >= self.min_area:
+                    merged_pred = self._polygon_to_prediction(poly, class_name)
                     if merged_pred:
                         merged_predictions.append(merged_pred)
             
             return merged_predictions if merged_predictions else predictions
             
         except Exception as e:
-            print(f"   ⚠️  Ошибка объединения полигонов: {e}")
+            logger.warning("Ошибка объединения полигонов: %s", e)
             return predictions
     
     def _polygon_to_prediction(self, polygon: Polygon, class_name: str) -> Optional[Prediction]:
@@ -299,7 +500,8 @@ class ImprovedPolygonMerger:
                 max_points = 40  # Меньше точек для других классов
             
             if len(polygon.exterior.coords) > max_points:
-                print(f"   Упрощение полигона {class_name}: {len(polygon.exterior.coords)} -> {max_points} точек")
+                logger.debug("Упрощение полигона %s: %d -> %d точек",
+                             class_name, len(polygon.exterior.coords), max_points)
                 polygon = self._smart_simplify_polygon(polygon, max_points=max_points)
             
             # Получаем границы полигона
@@ -312,22 +514,25 @@ class ImprovedPolygonMerger:
                 end=Coords(x=maxx, y=maxy)
             )
             
-            # Создаем полигон из координат
-            coords = list(polygon.exterior.coords[:-1])
-            polygon_coords = [Coords(x=x, y=y) for x, y in coords]
+            # Создаем полигон из координат (без замыкающей точки)
+            polygon_xy = np.asarray(polygon.exterior.coords)[:-1]
             
             # Вычисляем среднюю уверенность
             confidence = 0.8  # Можно улучшить на основе исходных предсказаний
             
-            return Prediction(
+            prediction = Prediction(
                 class_name=class_name,
                 box=box,
                 conf=confidence,
-                polygon=polygon_coords
+                polygon_xy=polygon_xy
             )
+            if not polygon.interiors:
+                # Без дыр полигон совпадает с построенным из polygon_xy: кэшируем его
+                prediction._shapely_cache = (polygon_xy, polygon)
+            return prediction
             
         except Exception as e:
-            print(f"   ⚠️  Ошибка преобразования полигона: {e}")
+            logger.warning("Ошибка преобразования полигона: %s", e)
             return None
     
     def _smart_simplify_polygon(self, polygon: Polygon, max_points: int = 60) -> Polygon:
@@ -348,36 +553,30 @@ class ImprovedPolygonMerger:
             if current_points <= max_points:
                 return current_poly
             
-            # Улучшенные параметры упрощения
-            min_tolerance = 0.2  # Увеличен с 0.1
-            max_tolerance = 5.0   # Уменьшен с 10.0
+            # Tolerance в замкнутой форме от диагонали bbox и целевого числа точек
+            # вместо бинарного поиска: один проход Douglas-Peucker, второй - только
+            # если точек все еще слишком много
+            minx, miny, maxx, maxy = current_poly.bounds
+            diagonal = math.hypot(maxx - minx, maxy - miny)
+            tolerance = diagonal / max(max_points, 1) * 0.5
             best_poly = current_poly
             
-            # Бинарный поиск оптимального tolerance
-            for _ in range(8):  # Уменьшено количество итераций
-                tolerance = (min_tolerance + max_tolerance) / 2
-                simplified = current_poly.simplify(tolerance, preserve_topology=True)
-                
-                if simplified.is_valid and len(simplified.exterior.coords) > 3:
-                    points_count = len(simplified.exterior.coords)
-                    
-                    if points_count <= max_points:
-                        best_poly = simplified
-                        min_tolerance = tolerance
-                        if points_count >= max_points * 0.9:  # Более строгое условие
-                            break
-                    else:
-                        max_tolerance = tolerance
-                else:
-                    max_tolerance = tolerance
+            simplified = fast_simplify(current_poly, tolerance)
+            if len(simplified.exterior.coords) > max_points:
+                simplified = fast_simplify(current_poly, tolerance * 2)
+            
+            if simplified.is_valid and len(simplified.exterior.coords) > 3:
+                best_poly = simplified
             
             # Если все еще слишком много точек, используем равномерную выборку
             if len(best_poly.exterior.coords) > max_points:
-                coords = list(best_poly.exterior.coords)
-                step = len(coords) // max_points
-                sampled_coords = coords[::max(1, step)]
+                # Ровно max_points индексов по замкнутому кольцу: первая и последняя
+                # точки совпадают, поэтому кольцо остается замкнутым
+                coords = np.asarray(best_poly.exterior.coords)
+                indices = np.linspace(0, len(coords) - 1, max_points, dtype=np.int64)
+                sampled_coords = coords[indices]
                 
-                if len(sampled_coords) >= 3:
+                if len(sampled_coords) >= 4:
                     sampled_poly = Polygon(sampled_coords)
                     if sampled_poly.is_valid:
                         best_poly = sampled_poly
@@ -385,7 +584,7 @@ class ImprovedPolygonMerger:
             return best_poly
             
         except Exception as e:
-            print(f"   ⚠️  Ошибка умного упрощения: {e}")
+            logger.warning("Ошибка умного упрощения: %s", e)
             return polygon
     
     def filter_by_improved_iou(self, predictions: List[Prediction]) -> List[Prediction]:
@@ -404,23 +603,39 @@ class ImprovedPolygonMerger:
         # Сортируем по уверенности (убывание)
         sorted_predictions = sorted(predictions, key=lambda x: x.conf, reverse=True)
         
-        filtered = []
-        
-        for pred in sorted_predictions:
-            is_duplicate = False
-            
-            for filtered_pred in filtered:
-                if pred.class_name == filtered_pred.class_name:
-                    iou = pred.box.iou(filtered_pred.box)
-                    if iou > self.iou_threshold:  # 0.7 вместо 0.5
-                        is_duplicate = True
-                        print(f"   Исключен дубликат по IoU {iou:.3f} > {self.iou_threshold}")
-                        break
+        # IoU > 0 только у пересекающихся bbox, поэтому пары кандидатов дает STRtree,
+        # а не полная матрица N x N. Берем пары (i, более уверенный j < i) одного
+        # класса, сгруппированные по i в порядке j
+        boxes = boxes_to_array(sorted_predictions)
+        class_names = np.array([pred.class_name for pred in sorted_predictions])
+        tree = STRtree(shapely.box(boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]))
+        pair_i, pair_j = tree.query(tree.geometries, predicate='intersects')
+        candidates = (pair_j < pair_i) & (class_names[pair_i] == class_names[pair_j])
+        pair_i, pair_j = pair_i[candidates], pair_j[candidates]
+        pair_order = np.lexsort((pair_j, pair_i))
+        pair_i, pair_j = pair_i[pair_order], pair_j[pair_order]
+        
+        # Дубликаты - пары выше порога IoU
+        pair_iou = box_iou_pairs(boxes[pair_i], boxes[pair_j])
+        duplicates = pair_iou > self.iou_threshold
+        pair_i, pair_j, pair_iou = pair_i[duplicates], pair_j[duplicates], pair_iou[duplicates]
+        
+        pair_starts = np.searchsorted(pair_i, np.arange(len(sorted_predictions)), side='left')
+        pair_ends = np.searchsorted(pair_i, np.arange(len(sorted_predictions)), side='right')
+        is_kept = np.zeros(len(sorted_predictions), dtype=bool)
+        
+        for i in range(len(sorted_predictions)):
+            kept_duplicates = np.flatnonzero(is_kept[pair_j[pair_starts[i]:pair_ends[i]]])
+            
+            if len(kept_duplicates):
+                if logger.isEnabledFor(logging.DEBUG):
+                    iou = pair_iou[pair_starts[i] + kept_duplicates[0]]
+                    logger.debug("Исключен дубликат по IoU %.3f > %s", iou, self.iou_threshold)
+                continue
             
-            if not is_duplicate:
-                filtered.append(pred)
+            is_kept[i] = True
         
-        return filtered
+        return [pred for pred, kept in zip(sorted_predictions, is_kept) if kept]
     
     def get_filtering_statistics(self, original_predictions: List[Prediction], 
                                 filtered_predictions: List[Prediction]) -> dict:
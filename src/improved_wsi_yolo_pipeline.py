@@ -8,24 +8,137 @@
 """
 
 import os
+import copy
 import json
+import logging
+import logging.handlers
 import time
 import numpy as np
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Union
 import torch
 from ultralytics import YOLO
 from monai.data import CuCIMWSIReader
-from monai.transforms import Compose, LoadImaged, EnsureChannelFirstd
 import concurrent.futures
-from shapely.geometry import Polygon
-from dataclasses import asdict
+import itertools
+import queue
+import threading
+import shapely
+from skimage import measure
 
 # Импорты наших улучшенных модулей
-from data_structures import PatchInfo, Prediction, Model, Coords, Box
+from data_structures import PatchInfo, Prediction, Model, PREDICTION_DTYPE, records_to_predictions
+from tissue_mask import build_tissue_mask, tissue_window_counts
 from yolo_inference import YOLOInference
 from improved_polygon_merger import ImprovedPolygonMerger
-from adaptive_polygon_simplifier import AdaptivePolygonSimplifier
+from adaptive_polygon_simplifier import AdaptivePolygonSimplifier, pack_rings, rings_to_polygons
+
+try:
+    import cupy
+    CUPY_AVAILABLE = True
+except ImportError:
+    CUPY_AVAILABLE = False
+
+try:
+    from cucim import CuImage
+    CUCIM_AVAILABLE = True
+except ImportError:
+    CUCIM_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """
+    Настраивает корневой логгер на неблокирующую запись через очередь
+    
+    Вызовы логгера в горячих циклах только кладут запись в очередь, а вывод
+    в stderr выполняет фоновый поток QueueListener.
+    
+    Args:
+        level: Уровень корневого логгера
+        
+    Returns:
+        logging.handlers.QueueListener: Запущенный слушатель (остановить через stop())
+    """
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+def _saturated_fraction(rgb: np.ndarray, stride: int) -> float:
+    """Доля пикселей с S > 30 среди каждого stride-го пикселя RGB uint8 патча"""
+    saturated = 0
+    total = 0
+    for i in range(0, rgb.shape[0], stride):
+        for j in range(0, rgb.shape[1], stride):
+            r, g, b = np.int32(rgb[i, j, 0]), np.int32(rgb[i, j, 1]), np.int32(rgb[i, j, 2])
+            value = max(r, g, b)
+            value_range = value - min(r, g, b)
+            if value_range > 0 and 510 * value_range >= 61 * value:
+                saturated += 1
+            total += 1
+    return saturated / total if total > 0 else 0.0
+
+
+def _box_area_mask(xyxy: np.ndarray, min_area: float, max_area: float) -> np.ndarray:
+    """Маска боксов [x1, y1, x2, y2] с площадью в [min_area, max_area]"""
+    keep = np.empty(xyxy.shape[0], dtype=np.bool_)
+    for i in range(xyxy.shape[0]):
+        area = (xyxy[i, 2] - xyxy[i, 0]) * (xyxy[i, 3] - xyxy[i, 1])
+        keep[i] = min_area <= area <= max_area
+    return keep
+
+
+if NUMBA_AVAILABLE:
+    _saturated_fraction = njit(cache=True)(_saturated_fraction)
+    _box_area_mask = njit(cache=True)(_box_area_mask)
+
+
+# Интервал, с которым заблокированные на очереди потоки проверяют флаг остановки
+_QUEUE_POLL_TIMEOUT = 0.1
+
+
+def _queue_put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Кладет item в очередь, пока не выставлен stop; False, если поток остановлен"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_QUEUE_POLL_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _queue_get(q: queue.Queue, stop: threading.Event):
+    """Берет элемент из очереди; None, если очередь пуста и выставлен stop"""
+    while True:
+        try:
+            return q.get(timeout=_QUEUE_POLL_TIMEOUT)
+        except queue.Empty:
+            if stop.is_set():
+                return None
+
 
 class ImprovedWSIYOLOPipeline:
     """Улучшенный WSI YOLO Pipeline с оптимизациями"""
@@ -34,35 +147,97 @@ class ImprovedWSIYOLOPipeline:
                  model_paths: Dict[str, str],
                  patch_size: int = 512,
                  overlap: int = 0,
-                 batch_size: int = 32,
+                 batch_size: Optional[int] = None,
                  max_workers: int = 4,
-                 device: str = "cuda" if torch.cuda.is_available() else "cpu"):
+                 device: str = "cuda" if torch.cuda.is_available() else "cpu",
+                 use_tensorrt: bool = True,
+                 use_cuda_graphs: bool = True,
+                 compile_models: bool = True,
+                 imgsz: int = 640):
         """
         Инициализация улучшенного pipeline
         
         Args:
-            model_paths: Словарь путей к моделям {class_name: model_path}
+            model_paths: Словарь путей к моделям {class_name: model_path};
+                одна мультиклассовая модель указывается для всех классов одним путем
             patch_size: Размер патча
             overlap: Перекрытие между патчами
-            batch_size: Размер батча для инференса
+            batch_size: Размер батча для инференса; None - подобрать замером
+                пропускной способности на GPU (на CPU используется 32)
             max_workers: Максимальное количество потоков
             device: Устройство для вычислений
+            use_tensorrt: Использовать TensorRT движки (FP16) на GPU
+            use_cuda_graphs: Запускать PyTorch модели через захваченные CUDA graphs
+            compile_models: Компилировать модели torch.compile перед захватом CUDA graphs
+            imgsz: Размер входа моделей; патч масштабируется до него, как ultralytics
+                масштабирует массивы numpy (imgsz по умолчанию 640)
         """
+        # Расширяемые сегменты уменьшают фрагментацию кэширующего аллокатора CUDA
+        # (действует, если CUDA еще не инициализирована)
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+        
         self.model_paths = model_paths
         self.patch_size = patch_size
+        self.imgsz = imgsz
         self.overlap = overlap
         self.batch_size = batch_size
         self.max_workers = max_workers
         self.device = device
+        self.use_tensorrt = use_tensorrt and str(device).startswith("cuda")
+        self.half = str(device).startswith("cuda")
+        self.compile_models = compile_models and hasattr(torch, "compile")
+        # Патчи читаются CuCIM сразу в видеопамять и не проходят через NumPy
+        self.read_on_gpu = self.half and CUPY_AVAILABLE
+        # Шаг прореживания пикселей при оценке доли ткани в патче
+        self.tissue_sample_stride = 4
+        # Запас окна маски вокруг box: YOLO обрезает маску по box на сетке прототипов
+        # (шаг 4 пикселя) и затем интерполирует, поэтому маска выходит за box на 2-3 пикселя
+        self.mask_crop_margin = 5
+        if self.half:
+            # Форма батча постоянна, поэтому cuDNN один раз выбирает самые быстрые
+            # алгоритмы сверток; оставшиеся FP32 операции используют TF32 на Ampere+
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
+        # Количество патчей в одном пакетном вызове read_region cuCIM
+        self.read_chunk_size = 64
+        # Сбрасывается, если установленный cuCIM не читает список координат
+        self._batched_reads = True
         
         # Инициализируем компоненты
         self.models = {}
+        # Модели, загруженные из TensorRT движков со статической формой входа
+        self.engine_models = set()
+        self._reader = CuCIMWSIReader(num_workers=self.max_workers)
+        self._wsi_handles = {}
+        self._enable_tile_cache()
         self.polygon_merger = ImprovedPolygonMerger()
         self.polygon_simplifier = AdaptivePolygonSimplifier()
         
-        # Загружаем модели
+        # Загружаем модели (при batch_size=None здесь же подбирается размер батча)
         self._load_models()
         
+        # Батчи на устройстве пишутся в заранее выделенные буферы (B, 3, H, W) FP16:
+        # до prefetch_batches ждут в очереди, один в инференсе и один заполняется
+        self.prefetch_batches = 2
+        self._device_buffers = []
+        if self.half:
+            self._device_buffers = [
+                torch.empty((self.batch_size, 3, imgsz, imgsz), dtype=torch.float16,
+                            device=self.device).contiguous(memory_format=torch.channels_last)
+                for _ in range(self.prefetch_batches + 2)
+            ]
+        
+        # Общий CUDA graph прямого прохода моделей для батча фиксированной формы,
+        # его вход и выходы с сетями по моделям
+        self.cuda_graph = None
+        self.cuda_graphs = {}
+        self.graph_input = None
+        # Нормализация /255 перенесена в веса первой свертки сетей CUDA graph
+        self.input_scale_folded = False
+        if use_cuda_graphs and self.half:
+            self._capture_cuda_graphs()
+            self.input_scale_folded = self._fold_input_scale()
+        
         # Статистика производительности
         self.performance_stats = {
             'total_patches': 0,
@@ -74,19 +249,307 @@ class ImprovedWSIYOLOPipeline:
         }
     
     def _load_models(self):
-        """Загружает все модели"""
+        """
+        Загружает все модели
+        
+        Классы с одинаковым файлом модели (одна мультиклассовая модель) загружаются
+        и прогоняются один раз: backbone считается на каждом батче только однажды
+        """
         print("🔄 Загрузка моделей...")
+        
+        # Группируем классы по файлу модели, сохраняя порядок конфигурации
+        classes_by_path = {}
         for class_name, model_path in self.model_paths.items():
+            classes_by_path.setdefault(os.path.realpath(model_path), []).append(class_name)
+        
+        if self.batch_size is None:
+            # Размер батча нужен до экспорта TensorRT движков со статической формой
+            existing_paths = [path for path in classes_by_path if os.path.exists(path)]
+            self.batch_size = self._autotune_batch_size(existing_paths[0]) if existing_paths else 32
+        
+        for model_path, class_names in classes_by_path.items():
+            model_name = "+".join(class_names)
             if os.path.exists(model_path):
                 try:
+                    if self.use_tensorrt:
+                        model_path = self._get_tensorrt_engine(model_path)
+                        if model_path.endswith('.engine'):
+                            self.engine_models.add(model_name)
                     model = YOLO(model_path)
-                    self.models[class_name] = model
-                    print(f"   ✅ {class_name}: {model_path}")
+                    if self.half and isinstance(model.model, torch.nn.Module):
+                        # NHWC веса: cuDNN выбирает channels-last ядра для FP16 сверток
+                        model.model.to(memory_format=torch.channels_last)
+                    self.models[model_name] = model
+                    print(f"   ✅ {model_name}: {model_path}")
                 except Exception as e:
-                    print(f"   ❌ Ошибка загрузки {class_name}: {e}")
+                    print(f"   ❌ Ошибка загрузки {model_name}: {e}")
             else:
                 print(f"   ❌ Модель не найдена: {model_path}")
     
+    def _autotune_batch_size(self, model_path: str, candidates: Tuple[int, ...] = (4, 8, 16, 32, 64)) -> int:
+        """
+        Подбирает размер батча с минимальным временем прямого прохода на патч
+        
+        Оптимальный батч зависит от GPU, поэтому PyTorch модель прогоняется на
+        нулевом FP16 входе для каждого кандидата по возрастанию (3 прогревочных
+        и 10 замеряемых проходов). Нехватка видеопамяти завершает перебор.
+        
+        Args:
+            model_path: Путь к PyTorch модели (.pt)
+            candidates: Проверяемые размеры батча
+            
+        Returns:
+            int: Выбранный размер батча (32, если замер на устройстве невозможен)
+        """
+        if not self.half:
+            return 32
+        
+        print("🔄 Подбор размера батча...")
+        timings = {}
+        try:
+            network = YOLO(model_path).model.to(self.device).half().eval()
+            network.to(memory_format=torch.channels_last)
+            with torch.no_grad():
+                for batch_size in candidates:
+                    try:
+                        dummy = torch.zeros(
+                            (batch_size, 3, self.imgsz, self.imgsz),
+                            device=self.device, dtype=torch.float16
+                        ).contiguous(memory_format=torch.channels_last)
+                        for _ in range(3):
+                            network(dummy)
+                        torch.cuda.synchronize()
+                        
+                        start_time = time.perf_counter()
+                        for _ in range(10):
+                            network(dummy)
+                        torch.cuda.synchronize()
+                        timings[batch_size] = (time.perf_counter() - start_time) / (10 * batch_size)
+                        print(f"   Батч {batch_size}: {timings[batch_size] * 1000:.2f} мс/патч")
+                    except torch.cuda.OutOfMemoryError:
+                        print(f"   Батч {batch_size}: недостаточно видеопамяти")
+                        break
+                    finally:
+                        dummy = None
+                        torch.cuda.empty_cache()
+        except Exception as e:
+            print(f"   ⚠️  Замер размера батча не удался: {e}")
+        finally:
+            network = None
+            torch.cuda.empty_cache()
+        
+        batch_size = min(timings, key=timings.get) if timings else 32
+        print(f"   ✅ Размер батча: {batch_size}")
+        return batch_size
+    
+    def _capture_cuda_graphs(self):
+        """
+        Захватывает прямой проход всех PyTorch моделей в один CUDA graph
+        
+        Сети моделей собираются в nn.ModuleList и захватываются одним графом над
+        общим входом self.graph_input: повтор графа запускает ядра всех сетей
+        одним вызовом на батч, без накладных расходов на запуск каждого ядра и
+        без отдельного повтора для каждой модели. TensorRT движки и сети, не
+        прошедшие прогрев, пропускаются. Граф захватывается на копиях сетей,
+        поэтому изменения их весов (_fold_input_scale) не затрагивают сами модели.
+        """
+        self.graph_input = torch.zeros(
+            (self.batch_size, 3, self.imgsz, self.imgsz),
+            device=self.device, dtype=torch.float16
+        ).contiguous(memory_format=torch.channels_last)
+        static_input = self.graph_input
+        
+        networks = torch.nn.ModuleList()
+        model_names = []
+        for model_name, model in self.models.items():
+            if not isinstance(model.model, torch.nn.Module):
+                continue
+            
+            try:
+                network = copy.deepcopy(model.model).to(self.device).half().eval()
+                
+                if self.compile_models:
+                    network = self._compile_network(model_name, network, static_input)
+                
+                with torch.no_grad():
+                    # Прогрев в отдельном stream перед захватом (требование CUDA graphs)
+                    warmup_stream = torch.cuda.Stream()
+                    warmup_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(warmup_stream):
+                        for _ in range(3):
+                            network(static_input)
+                    torch.cuda.current_stream().wait_stream(warmup_stream)
+                
+                networks.append(network)
+                model_names.append(model_name)
+            except Exception as e:
+                print(f"   ⚠️  CUDA graph для {model_name} не захвачен: {e}")
+        
+        if not networks:
+            return
+        
+        try:
+            graph = torch.cuda.CUDAGraph()
+            with torch.no_grad(), torch.cuda.graph(graph):
+                static_outputs = [network(static_input) for network in networks]
+        except Exception as e:
+            print(f"   ⚠️  CUDA graph моделей не захвачен: {e}")
+            return
+        
+        self.cuda_graph = graph
+        for model_name, network, static_output in zip(model_names, networks, static_outputs):
+            self.cuda_graphs[model_name] = (static_output, network)
+        print(f"   ✅ CUDA graph: {', '.join(model_names)}")
+    
+    def _compile_network(self, model_name: str, network: torch.nn.Module,
+                         static_input: torch.Tensor) -> torch.nn.Module:
+        """
+        Компилирует сеть torch.compile под фиксированную форму батча
+        
+        Inductor объединяет поэлементные операции с соседними свертками. Свои
+        CUDA graphs torch.compile не строит: граф всей сети захватывается
+        в _capture_cuda_graphs уже поверх скомпилированных ядер.
+        
+        Args:
+            model_name: Название модели (для сообщений)
+            network: Сеть YOLO на устройстве в FP16
+            static_input: Вход формы (B, 3, H, W), на котором выполняется компиляция
+            
+        Returns:
+            torch.nn.Module: Скомпилированная сеть или исходная, если компиляция не удалась
+        """
+        try:
+            compiled = torch.compile(network, mode="max-autotune-no-cudagraphs", dynamic=False)
+            with torch.no_grad():
+                # Компиляция выполняется при первом вызове
+                compiled(static_input)
+            print(f"   ✅ torch.compile: {model_name}")
+            return compiled
+        except Exception as e:
+            print(f"   ⚠️  torch.compile для {model_name} недоступен: {e}")
+            return network
+    
+    def _fold_input_scale(self) -> bool:
+        """
+        Переносит деление входа на 255 в веса первой свертки каждой сети CUDA graph
+        
+        Свертка линейна, а нулевой padding не меняется от масштаба, поэтому
+        conv(x / 255) = conv'(x) при весах conv' = conv / 255 и том же bias.
+        Это убирает отдельный проход по батчу на устройстве. Меняются только
+        копии сетей, захваченные в граф; модели вне графа получают батч,
+        нормализованный отдельно (_eager_input). Перенос возможен, только если
+        масштабированные веса не уходят в денормализованные числа FP16.
+        
+        Returns:
+            bool: True если нормализация перенесена во все сети графа
+        """
+        if not self.cuda_graphs:
+            return False
+        
+        scaled_weights = []
+        for _, network in self.cuda_graphs.values():
+            first_conv = next((m for m in network.modules() if isinstance(m, torch.nn.Conv2d)), None)
+            if first_conv is None or first_conv.padding_mode != 'zeros':
+                return False
+            
+            weight = first_conv.weight.detach().float() / 255.0
+            nonzero = weight.abs()[weight != 0]
+            if nonzero.numel() and nonzero.min() < torch.finfo(torch.float16).tiny:
+                return False
+            scaled_weights.append((first_conv, weight))
+        
+        # Графы читают веса при каждом повторе, поэтому достаточно обновить их на месте
+        with torch.no_grad():
+            for first_conv, weight in scaled_weights:
+                first_conv.weight.copy_(weight)
+        print("   ✅ Нормализация входа перенесена в первую свертку")
+        return True
+    
+    def _replay_cuda_graph(self, batch_tensor: torch.Tensor):
+        """
+        Копирует батч в общий вход CUDA graph и повторяет граф один раз для всех моделей
+        
+        Args:
+            batch_tensor: Батч (B, 3, H, W), B не больше batch_size
+        """
+        batch_len = batch_tensor.shape[0]
+        self.graph_input[:batch_len].copy_(batch_tensor, non_blocking=True)
+        if batch_len < self.graph_input.shape[0]:
+            # Неполный последний батч дополняется нулями до формы захваченного графа
+            self.graph_input[batch_len:].zero_()
+        self.cuda_graph.replay()
+    
+    def _run_cuda_graph(self, model_name: str, model: YOLO, batch_len: int) -> list:
+        """
+        Постобработка как в YOLO выходов модели из общего CUDA graph
+        
+        Граф должен быть заранее повторен на батче (_replay_cuda_graph).
+        
+        Args:
+            model_name: Название модели
+            model: YOLO модель (для имен классов)
+            batch_len: Количество изображений в батче
+            
+        Returns:
+            list: Результаты ultralytics Results для каждого изображения батча
+        """
+        from ultralytics.engine.results import Results
+        from ultralytics.utils import ops
+        
+        static_output, _ = self.cuda_graphs[model_name]
+        
+        # Выход сегментационной головы: (предсказания, (..., прототипы масок))
+        predictions = static_output[0][:batch_len]
+        protos = static_output[1][-1] if isinstance(static_output[1], (tuple, list)) else static_output[1]
+        
+        detections = ops.non_max_suppression(predictions, conf_thres=0.7, iou_thres=0.7, nc=len(model.names))
+        
+        # Как и при вызове модели с тензором, боксы и маски остаются в координатах входа сети
+        blank_image = np.empty((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        results = []
+        for detection, proto in zip(detections, protos[:batch_len]):
+            masks = None
+            if len(detection):
+                masks = ops.process_mask(proto, detection[:, 6:], detection[:, :4],
+                                         (self.imgsz, self.imgsz), upsample=True)
+            results.append(Results(blank_image, path="", names=model.names, boxes=detection[:, :6], masks=masks))
+        return results
+    
+    def _get_tensorrt_engine(self, model_path: str) -> str:
+        """
+        Возвращает путь к TensorRT движку модели, экспортируя его при первом запуске
+        
+        Args:
+            model_path: Путь к .pt модели
+            
+        Движок собирается со статической формой (batch_size, 3, imgsz, imgsz),
+        поэтому TensorRT выбирает ядра под конкретный размер. Параметры формы входят
+        в имя файла движка, а движок старее .pt модели экспортируется заново.
+        
+        Returns:
+            str: Путь к .engine (или исходный путь, если экспорт не удался)
+        """
+        model_file = Path(model_path)
+        engine_path = model_file.with_name(f"{model_file.stem}_b{self.batch_size}_p{self.imgsz}_fp16.engine")
+        if engine_path.exists() and engine_path.stat().st_mtime >= model_file.stat().st_mtime:
+            return str(engine_path)
+        
+        try:
+            print(f"   🔧 Экспорт в TensorRT (FP16): {model_path}")
+            exported_path = YOLO(model_path).export(
+                format="engine",
+                half=True,
+                dynamic=False,
+                batch=self.batch_size,
+                imgsz=self.imgsz,
+                device=self.device
+            )
+            os.replace(exported_path, engine_path)
+            return str(engine_path)
+        except Exception as e:
+            print(f"   ⚠️  Экспорт в TensorRT не удался, используем PyTorch модель: {e}")
+            return model_path
+    
     def process_wsi(self, wsi_path: str, output_dir: str = "results") -> Dict[str, Any]:
         """
         Обрабатывает WSI с улучшенным pipeline
@@ -113,16 +576,13 @@ class ImprovedWSIYOLOPipeline:
         if not wsi_info:
             return {'error': 'Failed to load WSI'}
         
-        # Извлекаем патчи
-        patches = self._extract_patches(wsi_info)
-        print(f"📊 Извлечено {len(patches)} патчей")
-        
-        # Батчинг инференс
-        all_predictions = self._batch_inference(patches)
-        print(f"🔍 Получено {len(all_predictions)} предсказаний")
+        # Потоковый инференс: чтение патчей и подготовка батчей идут параллельно с моделью
+        records, polygons, total_patches = self._streaming_inference(wsi_info)
+        print(f"📊 Обработано {total_patches} патчей")
+        print(f"🔍 Получено {len(records)} предсказаний")
         
         # Улучшенное объединение
-        merged_predictions = self._improved_merge_predictions(all_predictions)
+        merged_predictions = self._improved_merge_predictions(records, polygons)
         print(f"🔗 После объединения: {len(merged_predictions)} предсказаний")
         
         # Адаптивное упрощение полигонов
@@ -135,7 +595,7 @@ class ImprovedWSIYOLOPipeline:
         # Обновляем статистику
         total_time = time.time() - start_time
         self.performance_stats.update({
-            'total_patches': len(patches),
+            'total_patches': total_patches,
             'total_predictions': len(final_predictions),
             'processing_time': total_time
         })
@@ -145,18 +605,33 @@ class ImprovedWSIYOLOPipeline:
         
         return results
     
+    def _enable_tile_cache(self):
+        """Включает общий кэш тайлов cuCIM, если он поддерживается установленной версией"""
+        if not CUCIM_AVAILABLE or not hasattr(CuImage, 'cache'):
+            return
+        
+        try:
+            CuImage.cache("per_process", memory_capacity=2048)
+        except Exception as e:
+            print(f"⚠️  Кэш тайлов cuCIM не включен: {e}")
+    
     def _load_wsi(self, wsi_path: str) -> Optional[Dict[str, Any]]:
         """Загружает WSI файл"""
         try:
-            # Используем правильную инициализацию CuCIMWSIReader
-            reader = CuCIMWSIReader()
-            wsi_data = reader.read(wsi_path)
+            # Разбор метаданных WSI дорогой, поэтому читатель и открытые файлы переиспользуются
+            reader = self._reader
+            wsi_data = self._wsi_handles.get(wsi_path)
+            if wsi_data is None:
+                wsi_data = reader.read(wsi_path)
+                self._wsi_handles[wsi_path] = wsi_data
             
             # CuImage объект имеет другие методы
             width = wsi_data.shape[1]  # ширина
             height = wsi_data.shape[0]  # высота
             levels = wsi_data.num_levels if hasattr(wsi_data, 'num_levels') else 1
             
+            tissue_mask, tissue_mask_downsample = self._build_tissue_mask(wsi_data)
+            
             return {
                 'path': wsi_path,
                 'width': width,
@@ -164,15 +639,42 @@ class ImprovedWSIYOLOPipeline:
                 'levels': levels,
                 'mpp': None,  # MPP может быть недоступен
                 'reader': reader,
-                'wsi_data': wsi_data
+                'wsi_data': wsi_data,
+                'tissue_mask': tissue_mask,
+                'tissue_mask_downsample': tissue_mask_downsample
             }
         except Exception as e:
             print(f"❌ Ошибка загрузки WSI: {e}")
             return None
     
-    def _extract_patches(self, wsi_info: Dict[str, Any]) -> List[PatchInfo]:
-        """Извлекает патчи из WSI"""
-        patches = []
+    def _build_tissue_mask(self, wsi_data) -> Tuple[Optional[np.ndarray], float]:
+        """
+        Строит маску ткани по уменьшенному уровню пирамиды WSI (см. build_tissue_mask)
+        
+        Тайлы, под которыми в маске нет ни одного пикселя ткани, не
+        декодируются вовсе. Без подходящего уровня пирамиды маска не строится.
+        
+        Args:
+            wsi_data: Открытый CuImage
+            
+        Returns:
+            Tuple: (маска (h, w) bool или None, коэффициент уменьшения уровня маски)
+        """
+        try:
+            return build_tissue_mask(wsi_data)
+        except Exception as e:
+            logger.warning("Маска ткани по уменьшенному уровню не построена: %s", e)
+            return None, 1.0
+    
+    def _iter_patches(self, wsi_info: Dict[str, Any]) -> Iterator[PatchInfo]:
+        """
+        Извлекает патчи с тканью из WSI в порядке сетки
+        
+        Координаты читаются частями по read_chunk_size патчей: каждая часть
+        передается в cuCIM одним вызовом read_region со списком координат,
+        который декодирует тайлы в max_workers потоках. В памяти одновременно
+        находится не больше одной части
+        """
         wsi_data = wsi_info['wsi_data']
         width = wsi_info['width']
         height = wsi_info['height']
@@ -180,64 +682,159 @@ class ImprovedWSIYOLOPipeline:
         print(f"   🔍 Извлечение патчей: WSI {width}x{height}, патч {self.patch_size}x{self.patch_size}")
         
         patch_count = 0
-        total_possible_patches = ((width - self.patch_size) // (self.patch_size - self.overlap) + 1) * ((height - self.patch_size) // (self.patch_size - self.overlap) + 1)
-        print(f"   📈 Всего возможных патчей: {total_possible_patches}")
+        coords = self._patch_grid(width, height, wsi_info.get('tissue_mask'), wsi_info.get('tissue_mask_downsample', 1.0))
         
-        for y in range(0, height - self.patch_size + 1, self.patch_size - self.overlap):
-            for x in range(0, width - self.patch_size + 1, self.patch_size - self.overlap):
-                    
-                try:
-                    # Извлекаем патч используя CuImage API
-                    patch_data = wsi_data.read_region(
-                        location=(x, y),
-                        size=(self.patch_size, self.patch_size),
-                        level=0
-                    )
-                    
-                    # Конвертируем в numpy array если нужно
-                    if hasattr(patch_data, 'numpy'):
-                        patch_array = patch_data.numpy()
-                    else:
-                        patch_array = np.array(patch_data)
-                    
-                    if patch_array is not None and patch_array.shape[:2] == (self.patch_size, self.patch_size):
-                        # Проверяем, содержит ли патч ткань (как в оригинальном pipeline)
-                        if self._has_tissue(patch_array):
-                            patch_info = PatchInfo(
-                                patch_id=patch_count,
-                                x=x,
-                                y=y,
-                                size=self.patch_size,
-                                image=patch_array
-                            )
-                            patches.append(patch_info)
-                            patch_count += 1
-                        
-                except Exception as e:
-                    print(f"⚠️  Ошибка извлечения патча ({x}, {y}): {e}")
-                    continue
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as executor:
+            for start in range(0, len(coords), self.read_chunk_size):
+                chunk = coords[start:start + self.read_chunk_size].tolist()
+                for (x, y), patch_array in zip(chunk, self._read_tissue_chunk(wsi_data, chunk, executor)):
+                    if patch_array is not None:
+                        yield PatchInfo(
+                            patch_id=patch_count,
+                            x=x,
+                            y=y,
+                            size=self.patch_size,
+                            image=patch_array
+                        )
+                        patch_count += 1
+    
+    def _patch_grid(self, width: int, height: int, tissue_mask: Optional[np.ndarray],
+                    downsample: float) -> np.ndarray:
+        """
+        Координаты патчей сетки в порядке строк, отфильтрованные по грубой маске ткани
+        
+        Тайл остается, если под его окном в маске есть хотя бы один пиксель ткани
+        (см. tissue_window_counts).
+        
+        Args:
+            width, height: Размеры WSI
+            tissue_mask: Маска (h, w) bool уменьшенного уровня или None
+            downsample: Коэффициент уменьшения уровня маски
+            
+        Returns:
+            np.ndarray: Координаты (N, 2) [x, y] левых верхних углов патчей
+        """
+        step = self.patch_size - self.overlap
+        xs = np.arange(0, width - self.patch_size + 1, step)
+        ys = np.arange(0, height - self.patch_size + 1, step)
+        print(f"   📈 Всего возможных патчей: {len(xs) * len(ys)}")
+        
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        coords = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)
+        if tissue_mask is None:
+            return coords
+        
+        # Тайлы без ткани в грубой маске не читаем
+        counts = tissue_window_counts(tissue_mask, downsample, coords[:, 0], coords[:, 1], self.patch_size)[0]
+        return coords[counts > 0]
+    
+    def _read_tissue_chunk(self, wsi_data, chunk: List[Tuple[int, int]],
+                           executor: concurrent.futures.ThreadPoolExecutor
+                           ) -> List[Optional[Union[np.ndarray, "cupy.ndarray"]]]:
+        """
+        Читает часть патчей одним пакетным вызовом read_region
+        
+        Если установленный cuCIM не принимает список координат (TypeError
+        вызова), эта и все следующие части читаются по одному патчу в потоках
+        executor; при другой ошибке по одному перечитывается только эта часть.
+        
+        Args:
+            wsi_data: Открытый CuImage
+            chunk: Координаты левых верхних углов патчей
+            executor: Пул потоков для чтения по одному патчу
+            
+        Returns:
+            List: Для каждой координаты RGB изображение патча с тканью или None
+        """
+        if self._batched_reads:
+            regions = None
+            try:
+                regions = wsi_data.read_region(
+                    location=chunk,
+                    size=(self.patch_size, self.patch_size),
+                    level=0,
+                    num_workers=max(self.max_workers, 1),
+                    **({'device': 'cuda'} if self.read_on_gpu else {})
+                )
+                return [self._select_tissue_patch(region, x, y) for (x, y), region in zip(chunk, regions)]
+            except Exception as e:
+                if regions is None and isinstance(e, TypeError):
+                    # Установленный cuCIM не принимает список координат или num_workers
+                    logger.warning("Пакетное чтение cuCIM недоступно, патчи читаются по одному: %s", e)
+                    self._batched_reads = False
+                else:
+                    # Ошибка чтения самой части не отключает пакетное чтение: часть
+                    # повторяется по одному патчу, нечитаемые патчи пропускаются
+                    logger.warning("Ошибка пакетного чтения части, патчи читаются по одному: %s", e)
+        
+        xs, ys = zip(*chunk)
+        return list(executor.map(self._read_tissue_patch, itertools.repeat(wsi_data), xs, ys))
+    
+    def _read_tissue_patch(self, wsi_data, x: int, y: int) -> Optional[Union[np.ndarray, "cupy.ndarray"]]:
+        """
+        Читает патч и возвращает его, только если он содержит ткань
         
-        return patches
+        Args:
+            wsi_data: Открытый CuImage
+            x, y: Координаты левого верхнего угла патча
+            
+        Returns:
+            Optional[np.ndarray]: RGB изображение патча (CuPy на GPU-пути) или None
+        """
+        try:
+            # Извлекаем патч используя CuImage API
+            patch_data = wsi_data.read_region(
+                location=(x, y),
+                size=(self.patch_size, self.patch_size),
+                level=0,
+                **({'device': 'cuda'} if self.read_on_gpu else {})
+            )
+        except Exception as e:
+            logger.warning("Ошибка извлечения патча (%d, %d): %s", x, y, e)
+            return None
+        
+        return self._select_tissue_patch(patch_data, x, y)
+    
+    def _select_tissue_patch(self, patch_data, x: int, y: int) -> Optional[Union[np.ndarray, "cupy.ndarray"]]:
+        """
+        Переводит прочитанный регион в RGB массив и возвращает его, только если он содержит ткань
+        
+        Args:
+            patch_data: Регион CuImage, прочитанный read_region
+            x, y: Координаты левого верхнего угла патча (для сообщений)
+            
+        Returns:
+            Optional[np.ndarray]: RGB изображение патча (CuPy на GPU-пути) или None
+        """
+        try:
+            if self.read_on_gpu:
+                patch_array = cupy.asarray(patch_data)[:, :, :3]
+            else:
+                # Буфер CuImage отображается в numpy без копирования; альфа-канал
+                # отрезается срезом, а копия делается уже в буфер батча
+                patch_array = np.asarray(patch_data)
+                if patch_array.ndim == 3 and patch_array.shape[2] == 4:
+                    patch_array = patch_array[:, :, :3]
+            
+            # Дальше по конвейеру идут только RGB патчи полного размера с тканью
+            # (проверка ткани как в оригинальном pipeline)
+            if (patch_array.shape == (self.patch_size, self.patch_size, 3)
+                    and self._has_tissue(patch_array)):
+                return patch_array
+                
+        except Exception as e:
+            logger.warning("Ошибка извлечения патча (%d, %d): %s", x, y, e)
+        
+        return None
     
     def _has_tissue(self, patch_array: np.ndarray) -> bool:
         """Проверяет, содержит ли патч ткань (адаптировано из оригинального pipeline)"""
         try:
-            # Конвертируем в HSV для анализа
+            if CUPY_AVAILABLE and isinstance(patch_array, cupy.ndarray):
+                return self._has_tissue_gpu(patch_array)
+            
             if len(patch_array.shape) == 3 and patch_array.shape[2] == 3:
-                import cv2
-                hsv = cv2.cvtColor(patch_array, cv2.COLOR_RGB2HSV)
-                
-                # Анализируем насыщенность (S канал)
-                saturation = hsv[:, :, 1]
-                
-                # Порог насыщенности для определения ткани
-                tissue_threshold = 30
-                tissue_pixels = np.sum(saturation > tissue_threshold)
-                total_pixels = saturation.size
-                
-                # Если более 10% пикселей имеют высокую насыщенность, считаем это тканью
-                tissue_ratio = tissue_pixels / total_pixels
-                return tissue_ratio > 0.1
+                return self._tissue_ratio(patch_array, np) > 0.1
             else:
                 # Если не RGB изображение, считаем что это ткань
                 return True
@@ -246,174 +843,499 @@ class ImprovedWSIYOLOPipeline:
             # В случае ошибки считаем что это ткань
             return True
     
-    def _batch_inference(self, patches: List[PatchInfo]) -> List[Prediction]:
-        """Батчинг инференс для всех моделей"""
-        print("🔍 Запуск батчинг инференса...")
+    def _has_tissue_gpu(self, patch_array: "cupy.ndarray") -> bool:
+        """Та же проверка ткани по насыщенности HSV, но на GPU без копирования патча в RAM"""
+        return self._tissue_ratio(patch_array, cupy) > 0.1
+    
+    def _tissue_ratio(self, patch_array, xp) -> float:
+        """
+        Доля пикселей с насыщенностью S > 30 (S канал HSV для uint8)
+        
+        Вместо полного перевода в HSV считается только S = 255 * (max - min) / max,
+        причем в целых числах: S, округленное до целого, больше 30 ровно когда
+        2 * 255 * (max - min) >= 61 * max при max > min. Насыщенность оценивается
+        по каждому tissue_sample_stride-му пикселю по обеим осям.
+        
+        Args:
+            patch_array: RGB патч (H, W, 3) uint8
+            xp: Модуль массивов (numpy или cupy)
+            
+        Returns:
+            float: Доля насыщенных пикселей
+        """
+        stride = self.tissue_sample_stride
+        if xp is np and NUMBA_AVAILABLE:
+            # Один скомпилированный проход без промежуточных массивов max/min/маски
+            return _saturated_fraction(patch_array, stride)
+        return float(self._saturation_mask(patch_array[::stride, ::stride], xp).mean())
+    
+    def _saturation_mask(self, rgb, xp):
+        """Маска пикселей RGB uint8 изображения с насыщенностью S > 30"""
+        value = rgb.max(axis=2).astype(xp.int32)
+        value_range = value - rgb.min(axis=2)
+        return (510 * value_range >= 61 * value) & (value_range > 0)
+    
+    def _patch_producer(self, wsi_info: Dict[str, Any], q_patches: queue.Queue, stop: threading.Event):
+        """Читает патчи из WSI в очередь; None в конце означает окончание потока"""
+        try:
+            for patch in self._iter_patches(wsi_info):
+                if not _queue_put(q_patches, patch, stop):
+                    return
+        finally:
+            _queue_put(q_patches, None, stop)
+    
+    def _preprocess_worker(self, q_patches: queue.Queue, q_tensors: queue.Queue, released: list,
+                           stop: threading.Event):
+        """
+        Собирает патчи в батчи и заранее копирует их на устройство
+        
+        Args:
+            q_patches: Очередь патчей от _patch_producer
+            q_tensors: Очередь готовых батчей (патчи, тензор, событие готовности,
+                индекс буфера устройства)
+            released: События освобождения буферов устройства, записываемые после инференса
+            stop: Флаг остановки всех потоков инференса (выставляется при ошибке или завершении)
+        """
+        # Копирование на GPU идет в отдельном CUDA stream, не блокируя инференс
+        stream = torch.cuda.Stream() if self.half else None
+        
+        # Патчи с CPU копируются прямо в один из двух чередующихся буферов (B, H, W, 3):
+        # один заполняется, пока второй копируется на GPU
+        host_buffers = []
+        if not self.read_on_gpu:
+            for _ in range(2):
+                buffer = torch.empty((self.batch_size, self.patch_size, self.patch_size, 3), dtype=torch.uint8)
+                host_buffers.append(buffer.pin_memory() if self.half else buffer)
+        host_views = [buffer.numpy() for buffer in host_buffers]
+        copy_done = [None, None]
+        buffer_idx = 0
+        device_idx = 0
+        
+        def push(batch_patches: List[PatchInfo]) -> bool:
+            nonlocal buffer_idx, device_idx
+            if host_buffers:
+                batch_images = host_buffers[buffer_idx][:len(batch_patches)]
+            else:
+                batch_images = [patch.image.astype(np.uint8, copy=False) for patch in batch_patches]
+            
+            if stream is None:
+                if not _queue_put(q_tensors, (batch_patches, self._images_to_tensor(batch_images), None, None), stop):
+                    return False
+            else:
+                with torch.cuda.stream(stream):
+                    if released[device_idx] is not None:
+                        # Буфер устройства еще может читаться инференсом прошлого батча
+                        stream.wait_event(released[device_idx])
+                    batch_tensor = self._images_to_tensor(batch_images, out=self._device_buffers[device_idx])
+                    ready = torch.cuda.Event()
+                    ready.record(stream)
+                copy_done[buffer_idx] = ready
+                if not _queue_put(q_tensors, (batch_patches, batch_tensor, ready, device_idx), stop):
+                    return False
+                device_idx = (device_idx + 1) % len(self._device_buffers)
+            buffer_idx ^= 1
+            return True
+        
+        try:
+            batch_patches = []
+            while True:
+                # None - конец потока патчей или остановка инференса
+                patch = _queue_get(q_patches, stop)
+                if patch is None:
+                    break
+                
+                # Форму (patch_size, patch_size, 3) гарантирует _select_tissue_patch
+                if host_buffers:
+                    if not batch_patches and copy_done[buffer_idx] is not None:
+                        # Буфер еще копируется на GPU с прошлого раза
+                        copy_done[buffer_idx].synchronize()
+                    host_views[buffer_idx][len(batch_patches)] = patch.image
+                    # Изображение уже в буфере батча, патчу достаточно координат
+                    patch.image = None
+                
+                batch_patches.append(patch)
+                if len(batch_patches) == self.batch_size:
+                    if not push(batch_patches):
+                        return
+                    batch_patches = []
+            
+            if batch_patches:
+                push(batch_patches)
+        except Exception:
+            # Останавливаем поток чтения: он не заблокируется на put в очередь, которую никто не читает
+            stop.set()
+            raise
+        finally:
+            _queue_put(q_tensors, None, stop)
+    
+    def _streaming_inference(self, wsi_info: Dict[str, Any]) -> Tuple[np.ndarray, List[Optional[np.ndarray]], int]:
+        """
+        Потоковый инференс всех моделей: чтение патчей, подготовка батчей
+        и инференс выполняются одновременно в разных потоках
+        
+        Args:
+            wsi_info: Информация о загруженном WSI
+            
+        Returns:
+            Tuple: (предсказания - массив PREDICTION_DTYPE, точки их полигонов,
+                количество обработанных патчей)
+        """
+        print("🔍 Запуск потокового батчинг инференса...")
         start_time = time.time()
         
-        all_predictions = []
+        all_rows = []
+        all_polygons = []
+        predictions_per_model = {model_name: 0 for model_name in self.models}
+        total_patches = 0
         
-        # Группируем патчи по батчам
-        patch_batches = [patches[i:i + self.batch_size] for i in range(0, len(patches), self.batch_size)]
+        # Ограниченные очереди держат в памяти лишь несколько батчей
+        q_patches = queue.Queue(maxsize=2 * self.batch_size)
+        q_tensors = queue.Queue(maxsize=self.prefetch_batches)
+        released = [None] * len(self._device_buffers)
+        # Потоки чтения и подготовки ждут на очередях с таймаутом и выходят по этому флагу
+        stop = threading.Event()
         
-        # Параллельная обработка моделей
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # Создаем задачи для каждой модели
-            model_tasks = {}
-            for model_name, model in self.models.items():
-                future = executor.submit(self._process_model_batches, model_name, model, patch_batches)
-                model_tasks[model_name] = future
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            producer = executor.submit(self._patch_producer, wsi_info, q_patches, stop)
+            preprocessor = executor.submit(self._preprocess_worker, q_patches, q_tensors, released, stop)
             
-            # Собираем результаты
-            for model_name, future in model_tasks.items():
-                try:
-                    model_predictions = future.result()
-                    all_predictions.extend(model_predictions)
-                    print(f"   ✅ {model_name}: {len(model_predictions)} предсказаний")
-                except Exception as e:
-                    print(f"   ❌ Ошибка {model_name}: {e}")
+            batch_idx = 0
+            try:
+                # Без учета версий тензоров и записи графа autograd на всем цикле инференса
+                with torch.inference_mode():
+                    while True:
+                        # None - конец потока батчей (или остановка после ошибки подготовки)
+                        batch = _queue_get(q_tensors, stop)
+                        if batch is None:
+                            break
+                        
+                        batch_patches, batch_tensor, ready, device_idx = batch
+                        if ready is not None:
+                            # Ждем окончания копирования в буфер устройства
+                            torch.cuda.current_stream().wait_event(ready)
+                        
+                        if self.cuda_graph is not None:
+                            self._replay_cuda_graph(batch_tensor)
+                        
+                        for model_name, model in self.models.items():
+                            rows, polygons = self._run_model_on_batch(
+                                model_name, model, batch_patches, batch_tensor, batch_idx
+                            )
+                            predictions_per_model[model_name] += len(rows)
+                            all_rows.extend(rows)
+                            all_polygons.extend(polygons)
+                        
+                        if device_idx is not None:
+                            # Буфер можно заполнять снова после завершения уже поставленных ядер
+                            done = torch.cuda.Event()
+                            done.record()
+                            released[device_idx] = done
+                        
+                        total_patches += len(batch_patches)
+                        batch_idx += 1
+            finally:
+                # При ошибке цикла инференса потоки чтения и подготовки иначе ждали бы
+                # на очередях вечно, и выход из executor никогда бы не завершился
+                stop.set()
+            
+            # Пробрасываем ошибки потоков чтения и подготовки
+            producer.result()
+            preprocessor.result()
+        
+        for model_name, count in predictions_per_model.items():
+            print(f"   ✅ {model_name}: {count} предсказаний")
         
         inference_time = time.time() - start_time
         self.performance_stats['inference_time'] = inference_time
         
         print(f"⏱️  Инференс завершен за {inference_time:.2f}с")
-        return all_predictions
+        return np.array(all_rows, dtype=PREDICTION_DTYPE), all_polygons, total_patches
     
-    def _process_model_batches(self, model_name: str, model: YOLO, patch_batches: List[List[PatchInfo]]) -> List[Prediction]:
-        """Обрабатывает батчи патчей для одной модели"""
-        predictions = []
+    def _run_model_on_batch(self, model_name: str, model: YOLO, batch_patches: List[PatchInfo],
+                            batch_tensor: torch.Tensor,
+                            batch_idx: int) -> Tuple[List[tuple], List[Optional[np.ndarray]]]:
+        """Инференс одной модели на подготовленном батче"""
+        rows = []
+        polygons = []
         
-        for batch_idx, patch_batch in enumerate(patch_batches):
-            try:
-                # Подготавливаем батч изображений
-                batch_images = []
-                batch_patches = []
-                
-                for patch in patch_batch:
-                    if patch.image is not None:
-                        # Конвертируем в формат для YOLO
-                        image = patch.image.astype(np.uint8)
-                        if len(image.shape) == 3 and image.shape[2] == 3:
-                            batch_images.append(image)
-                            batch_patches.append(patch)
-                
-                if not batch_images:
-                    continue
-                
-                # Инференс батча с повышенным confidence threshold
-                results = model(batch_images, verbose=False, conf=0.7, iou=0.7)
-                
-                # Очищаем память GPU после каждого батча
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+        try:
+            # Инференс батча с повышенным confidence threshold
+            if model_name in self.cuda_graphs:
+                results = self._run_cuda_graph(model_name, model, len(batch_patches))
+            elif model_name in self.engine_models:
+                results = model(self._to_engine_batch(self._eager_input(batch_tensor)), verbose=False,
+                                conf=0.7, iou=0.7, half=self.half)[:len(batch_patches)]
+            else:
+                results = model(self._eager_input(batch_tensor), verbose=False, conf=0.7, iou=0.7, half=self.half)
+            
+            # Обрабатываем результаты
+            for patch, result in zip(batch_patches, results):
+                patch_rows, patch_polygons = self._process_yolo_result(result, patch, model_name)
+                rows.extend(patch_rows)
+                polygons.extend(patch_polygons)
                 
-                # Обрабатываем результаты
-                for i, result in enumerate(results):
-                    if i < len(batch_patches):
-                        patch = batch_patches[i]
-                        patch_predictions = self._process_yolo_result(
-                            result, patch, model_name
-                        )
-                        predictions.extend(patch_predictions)
-                        
-            except Exception as e:
-                print(f"⚠️  Ошибка батча {batch_idx} для {model_name}: {e}")
-                continue
+        except torch.cuda.OutOfMemoryError as e:
+            # Память статических графов и движков выделена заранее, делить батч
+            # имеет смысл только для обычного PyTorch инференса
+            if (len(batch_patches) == 1 or model_name in self.cuda_graphs
+                    or model_name in self.engine_models):
+                logger.warning("Ошибка батча %d для %s: %s", batch_idx, model_name, e)
+                return rows, polygons
+            
+            # Освобождаем кэш аллокатора только здесь, а не после каждого батча,
+            # и повторяем инференс двумя половинами батча
+            torch.cuda.empty_cache()
+            rows, polygons = [], []
+            half = len(batch_patches) // 2
+            logger.warning("Нехватка памяти GPU на батче %d для %s, повтор частями по %d патчей",
+                           batch_idx, model_name, half)
+            for part in (slice(0, half), slice(half, None)):
+                part_rows, part_polygons = self._run_model_on_batch(
+                    model_name, model, batch_patches[part], batch_tensor[part], batch_idx
+                )
+                rows.extend(part_rows)
+                polygons.extend(part_polygons)
+        except Exception as e:
+            logger.warning("Ошибка батча %d для %s: %s", batch_idx, model_name, e)
         
-        return predictions
+        return rows, polygons
     
-    def _process_yolo_result(self, result, patch: PatchInfo, model_name: str) -> List[Prediction]:
-        """Обрабатывает результат YOLO инференса"""
-        predictions = []
+    def _eager_input(self, batch_tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Батч для модели вне CUDA graphs
+        
+        Если нормализация перенесена в сети графов (_fold_input_scale), батч
+        остается в [0, 255] и для остальных моделей делится на 255 в новый
+        тензор, не трогая общий батч.
+        
+        Args:
+            batch_tensor: Батч (B, 3, H, W) из _images_to_tensor
+            
+        Returns:
+            torch.Tensor: Батч в [0, 1]
+        """
+        return batch_tensor / 255.0 if self.input_scale_folded else batch_tensor
+    
+    def _to_engine_batch(self, batch_tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Приводит батч к статической форме входа TensorRT движка
+        
+        Движок читает вход по указателю как непрерывный NCHW тензор формы
+        (batch_size, 3, H, W), поэтому channels_last раскладка переводится
+        в NCHW, а неполный последний батч дополняется нулевыми патчами.
+        
+        Args:
+            batch_tensor: Батч (B, 3, H, W), B не больше batch_size
+            
+        Returns:
+            torch.Tensor: Непрерывный тензор (batch_size, 3, H, W)
+        """
+        padding = self.batch_size - batch_tensor.shape[0]
+        if padding > 0:
+            batch_tensor = torch.cat([batch_tensor, batch_tensor.new_zeros((padding,) + batch_tensor.shape[1:])])
+        return batch_tensor.contiguous()
+    
+    def _images_to_tensor(self, batch_images: Union[torch.Tensor, List["cupy.ndarray"]],
+                          out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Собирает батч RGB изображений в один тензор (B, 3, imgsz, imgsz) на устройстве
+        
+        Args:
+            batch_images: Буфер (B, H, W, 3) uint8 в памяти хоста или список
+                изображений (H, W, 3) CuPy, уже находящихся на GPU
+            out: Заранее выделенный буфер (B_max, 3, imgsz, imgsz) FP16 на GPU для результата
+            
+        Returns:
+            torch.Tensor: Вход моделей (_to_model_layout), нормализованный в [0, 1]
+                (channels_last на GPU); в буфере out значения остаются в [0, 255], если
+                нормализация перенесена в сети CUDA graphs (остальные модели получают
+                его через _eager_input)
+        """
+        if out is not None:
+            batch_tensor = out[:len(batch_images)]
+            if isinstance(batch_images, torch.Tensor):
+                # Буфер хоста закреплен: копирование на устройство асинхронное
+                images = batch_images.to(self.device, non_blocking=True)
+            else:
+                images = torch.stack([torch.as_tensor(image, device=self.device) for image in batch_images])
+            batch_tensor.copy_(self._to_model_layout(images.permute(0, 3, 1, 2)))
+            return batch_tensor if self.input_scale_folded else batch_tensor.div_(255.0)
+        
+        if CUPY_AVAILABLE and isinstance(batch_images[0], cupy.ndarray):
+            # Патчи уже в видеопамяти: собираем их в один буфер в текущем CUDA stream
+            with cupy.cuda.ExternalStream(torch.cuda.current_stream().cuda_stream):
+                buffer = cupy.empty((len(batch_images),) + batch_images[0].shape, dtype=cupy.uint8)
+                for i, image in enumerate(batch_images):
+                    cupy.copyto(buffer[i], image)
+            batch_tensor = torch.as_tensor(buffer, device=self.device).permute(0, 3, 1, 2)
+        else:
+            # Буфер хоста на GPU-пути закреплен, поэтому копирование асинхронное
+            batch_tensor = batch_images.to(self.device, non_blocking=True).permute(0, 3, 1, 2)
+        batch_tensor = self._to_model_layout(batch_tensor)
+        if self.half:
+            batch_tensor = batch_tensor.to(dtype=torch.float16, memory_format=torch.channels_last)
+        else:
+            batch_tensor = batch_tensor.float()
+        return batch_tensor.div_(255.0)
+    
+    def _to_model_layout(self, batch_tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Приводит батч RGB патчей к тому входу, который ultralytics готовит из массивов numpy
+        
+        Массив numpy ultralytics считает BGR и переставляет каналы, а затем
+        масштабирует до imgsz (LetterBox квадратного патча - это билинейное
+        изменение размера без полей). Модели работают с таким входом, поэтому
+        каналы патча идут в сеть в обратном порядке, а патч масштабируется до
+        imgsz тем же билинейным ресемплингом.
+        
+        Args:
+            batch_tensor: Батч (B, 3, H, W) uint8 на устройстве
+            
+        Returns:
+            torch.Tensor: Батч (B, 3, imgsz, imgsz) со значениями в [0, 255]
+        """
+        batch_tensor = batch_tensor.flip(1)
+        if tuple(batch_tensor.shape[-2:]) != (self.imgsz, self.imgsz):
+            batch_tensor = torch.nn.functional.interpolate(
+                batch_tensor.to(torch.float16 if self.half else torch.float32),
+                size=(self.imgsz, self.imgsz), mode='bilinear', align_corners=False
+            )
+        return batch_tensor
+    
+    def _process_yolo_result(self, result, patch: PatchInfo,
+                             model_name: str) -> Tuple[List[tuple], List[Optional[np.ndarray]]]:
+        """
+        Обрабатывает результат YOLO инференса
+        
+        Returns:
+            Tuple: (строки PREDICTION_DTYPE, точки полигонов для каждой строки)
+        """
+        rows = []
+        polygons = []
         
         try:
             if result.boxes is not None and len(result.boxes) > 0:
                 boxes = result.boxes
                 
-                for i in range(len(boxes)):
-                    # Извлекаем данные из box
-                    box = boxes.xyxy[i].cpu().numpy()  # [x1, y1, x2, y2]
-                    conf = boxes.conf[i].cpu().numpy()
-                    cls = int(boxes.cls[i].cpu().numpy())
-                    
-                    # Получаем имя класса
-                    class_name = result.names[cls]
-                    
-                    # Создаем Box объект
-                    box_obj = Box(
-                        start=Coords(x=float(box[0]), y=float(box[1])),
-                        end=Coords(x=float(box[2]), y=float(box[3]))
-                    )
-                    
+                # Все боксы переносим с GPU одним копированием на тензор, а не по боксу.
+                # Боксы и маски даны в координатах входа сети (imgsz), а не патча
+                scale = self.patch_size / self.imgsz
+                model_xyxy = boxes.xyxy.cpu().numpy()
+                xyxy = model_xyxy * scale  # [x1, y1, x2, y2] в пикселях патча
+                confs = boxes.conf.cpu().numpy()
+                classes = boxes.cls.cpu().numpy().astype(np.int32)
+                
+                # Минимальный и максимальный размер объектов
+                min_area = 100  # Минимум 10x10 пикселей
+                max_area = 50000  # Максимум 224x224 пикселей
+                
+                # Фильтр по размеру одной маской, цикл ниже идет только по прошедшим объектам
+                if NUMBA_AVAILABLE:
+                    area_mask = _box_area_mask(xyxy, min_area, max_area)
+                else:
+                    box_areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+                    area_mask = (box_areas >= min_area) & (box_areas <= max_area)
+                keep = np.flatnonzero(area_mask)
+                
+                if logger.isEnabledFor(logging.DEBUG):
+                    # Логируем отфильтрованные объекты (только первые 10 для отладки)
+                    box_areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+                    for i in np.flatnonzero(~area_mask)[:10].tolist():
+                        logger.debug("Отфильтрован объект %s: размер %.0f (conf=%.3f)",
+                                     result.names[int(classes[i])], box_areas[i], confs[i])
+                
+                # Маски нужны только для объектов, прошедших фильтр по размеру
+                masks = {}
+                if len(keep) and hasattr(result, 'masks') and result.masks is not None:
+                    keep_masks = keep[keep < len(result.masks)].tolist()
+                    if keep_masks:
+                        masks = dict(zip(keep_masks, result.masks.data[keep_masks].cpu().numpy()))
+                
+                for i, (x1, y1, x2, y2), conf, class_id in zip(keep.tolist(), xyxy[keep].tolist(),
+                                                               confs[keep].tolist(), classes[keep].tolist()):
                     # Создаем полигон из маски (как в оригинальном pipeline)
-                    polygon = self._create_polygon_from_mask(result, i, patch)
-                    
-                    # Фильтрация по размеру объекта
-                    box_width = box[2] - box[0]
-                    box_height = box[3] - box[1]
-                    box_area = box_width * box_height
+                    polygon_xy = (self._create_polygon_from_mask(masks[i], patch, tuple(model_xyxy[i].tolist()),
+                                                                 scale)
+                                  if i in masks else None)
                     
-                    # Минимальный и максимальный размер объектов
-                    min_area = 100  # Минимум 10x10 пикселей
-                    max_area = 50000  # Максимум 224x224 пикселей
-                    
-                    if min_area <= box_area <= max_area:
-                        # Создаем предсказание
-                        prediction = Prediction(
-                            class_name=class_name,
-                            box=box_obj,
-                            conf=float(conf),
-                            polygon=polygon
-                        )
-                        
-                        predictions.append(prediction)
-                    else:
-                        # Логируем отфильтрованные объекты
-                        if len(predictions) < 10:  # Только первые 10 для отладки
-                            print(f"   🔍 Отфильтрован объект {class_name}: размер {box_area:.0f} (conf={conf:.3f})")
+                    # Предсказание - строка структурированного массива, без объектов
+                    rows.append((result.names[class_id], conf, x1, y1, x2, y2))
+                    polygons.append(polygon_xy)
                     
         except Exception as e:
-            print(f"⚠️  Ошибка обработки результата YOLO: {e}")
+            logger.warning("Ошибка обработки результата YOLO: %s", e)
         
-        return predictions
+        return rows, polygons
     
-    def _create_polygon_from_mask(self, result, box_idx: int, patch: PatchInfo) -> Optional[List[Coords]]:
-        """Создает полигон из маски (адаптировано из оригинального pipeline)"""
+    def _create_polygon_from_mask(self, mask: np.ndarray, patch: PatchInfo,
+                                  box: Optional[Tuple[float, float, float, float]] = None,
+                                  scale: float = 1.0) -> Optional[np.ndarray]:
+        """
+        Создает полигон из маски (адаптировано из оригинального pipeline)
+        
+        YOLO обнуляет маску вне bounding box объекта на сетке прототипов, после
+        интерполяции маска выходит за box на несколько пикселей. Поэтому контуры
+        ищутся в окне box с запасом mask_crop_margin; если маска все же касается
+        внутреннего края окна, запас удваивается. Так контуры совпадают с
+        контурами на всей маске, а работы меньше в (H * W) / (bw * bh) раз.
+        
+        Args:
+            mask: Маска объекта (height, width)
+            patch: Патч, в координатах которого задана маска
+            box: Bounding box объекта (x1, y1, x2, y2) в пикселях маски
+            scale: Размер пикселя маски в пикселях патча (patch_size / imgsz)
+            
+        Returns:
+            Optional[np.ndarray]: Точки полигона (N, 2) в абсолютных координатах WSI
+        """
         try:
-            # Проверяем, есть ли маски в результате
-            if hasattr(result, 'masks') and result.masks is not None and len(result.masks) > box_idx:
-                mask = result.masks.data[box_idx].cpu().numpy()
+            offset_x, offset_y = 0, 0
+            if box is not None:
+                height, width = mask.shape
+                margin = self.mask_crop_margin
+                while True:
+                    x0 = max(int(np.floor(box[0])) - margin, 0)
+                    y0 = max(int(np.floor(box[1])) - margin, 0)
+                    x1 = min(int(np.ceil(box[2])) + margin, width)
+                    y1 = min(int(np.ceil(box[3])) + margin, height)
+                    window = mask[y0:y1, x0:x1] > 0.5
+                    if not window.size:
+                        break
+                    
+                    # Края окна, проходящие внутри маски, не должны пересекать объект
+                    cut = ((x0 > 0 and window[:, 0].any()) or (x1 < width and window[:, -1].any())
+                           or (y0 > 0 and window[0].any()) or (y1 < height and window[-1].any()))
+                    if not cut:
+                        break
+                    margin *= 2
                 
-                # Конвертируем маску в полигон
-                from skimage import measure
-                contours = measure.find_contours(mask, 0.5)
+                offset_x, offset_y = x0, y0
+                mask = mask[y0:y1, x0:x1]
+            
+            # Конвертируем маску в полигон
+            contours = measure.find_contours(mask, 0.5)
+            
+            if contours:
+                # Берем самый большой контур
+                largest_contour = max(contours, key=len)
+                
+                # YOLO маски в формате (height, width), конвертируем в абсолютные (x, y)
+                return ((largest_contour[:, ::-1] + np.array([offset_x, offset_y], dtype=np.float64)) * scale
+                        + np.array([patch.x, patch.y], dtype=np.float64))
                 
-                if contours:
-                    # Берем самый большой контур
-                    largest_contour = max(contours, key=len)
-                    
-                    # Конвертируем в абсолютные координаты
-                    polygon_coords = []
-                    for point in largest_contour:
-                        # YOLO маски в формате (height, width), конвертируем в (x, y)
-                        x = point[1] + patch.x  # Абсолютная X координата
-                        y = point[0] + patch.y  # Абсолютная Y координата
-                        polygon_coords.append(Coords(x=float(x), y=float(y)))
-                    
-                    return polygon_coords
-                    
         except Exception as e:
-            print(f"⚠️  Ошибка создания полигона: {e}")
+            logger.warning("Ошибка создания полигона: %s", e)
             
         return None
     
-    def _improved_merge_predictions(self, predictions: List[Prediction]) -> List[Prediction]:
-        """Улучшенное объединение предсказаний"""
+    def _improved_merge_predictions(self, records: np.ndarray,
+                                    polygons: List[Optional[np.ndarray]]) -> List[Prediction]:
+        """Улучшенное объединение предсказаний (массив PREDICTION_DTYPE и точки полигонов)"""
         print("🔗 Улучшенное объединение предсказаний...")
         start_time = time.time()
         
         try:
-            merged_predictions = self.polygon_merger.merge_predictions(predictions)
+            merged_predictions = self.polygon_merger.merge_predictions(records, polygons)
             merging_time = time.time() - start_time
             self.performance_stats['merging_time'] = merging_time
             
@@ -422,64 +1344,74 @@ class ImprovedWSIYOLOPipeline:
             
         except Exception as e:
             print(f"❌ Ошибка объединения: {e}")
-            return predictions
+            return records_to_predictions(records, polygons)
     
     def _adaptive_simplify_predictions(self, predictions: List[Prediction]) -> List[Prediction]:
         """Адаптивное упрощение полигонов"""
         print("✂️  Адаптивное упрощение полигонов...")
         start_time = time.time()
         
-        simplified_predictions = []
+        # Собираем замкнутые кольца валидных полигонов для пакетного упрощения.
+        # Полигоны объединения берутся готовыми от merger, остальные строятся,
+        # а валидность проверяется одним вызовом GEOS на все полигоны
+        batch_predictions = []
+        batch_rings = []
+        candidates = [pred for pred in predictions if pred.num_points > 3]
+        try:
+            polygons = np.empty(len(candidates), dtype=object)
+            polygons[:] = [self.polygon_merger.cached_polygon(pred) for pred in candidates]
+            missing = np.flatnonzero(shapely.is_missing(polygons))
+            if len(missing):
+                polygons[missing] = rings_to_polygons(*pack_rings([candidates[i].polygon_xy for i in missing]))
+            valid = shapely.is_valid(polygons)
+            if valid.any():
+                batch_predictions = [pred for pred, is_valid in zip(candidates, valid.tolist()) if is_valid]
+                coords, ring_ids = shapely.get_coordinates(shapely.get_exterior_ring(polygons[valid]),
+                                                           return_index=True)
+                batch_rings = np.split(coords, np.flatnonzero(np.diff(ring_ids)) + 1)
+        except Exception as e:
+            print(f"⚠️  Ошибка упрощения полигона: {e}")
         
-        for pred in predictions:
-            try:
-                if pred.polygon and len(pred.polygon) > 3:
-                    # Создаем Shapely полигон
-                    coords = [(p.x, p.y) for p in pred.polygon]
-                    polygon = Polygon(coords)
-                    
-                    if polygon.is_valid:
-                        original_points = len(pred.polygon)
-                        
-                        # Адаптивное упрощение
-                        simplified_polygon, metrics = self.polygon_simplifier.simplify_polygon(polygon)
-                        
-                        # Обновляем полигон в предсказании
-                        if simplified_polygon.is_valid:
-                            simplified_coords = list(simplified_polygon.exterior.coords)
-                            pred.polygon = [Coords(x=float(x), y=float(y)) for x, y in simplified_coords]
-                            
-                            # Добавляем метрики в предсказание
-                            pred.simplification_metrics = {
-                                'original_points': metrics['original_points'],
-                                'simplified_points': metrics['simplified_points'],
-                                'area_preserved': metrics['area_preserved'],
-                                'method': metrics['method']
-                            }
-                            
-                            # Отладочная информация для первых нескольких полигонов
-                            if len(simplified_predictions) < 5:
-                                print(f"   🔍 Полигон {len(simplified_predictions)}: {original_points} → {len(simplified_coords)} точек, метод: {metrics['method']}")
-                        else:
-                            # Если упрощение не удалось, добавляем базовые метрики
-                            pred.simplification_metrics = {
-                                'original_points': original_points,
-                                'simplified_points': original_points,
-                                'area_preserved': 1.0,
-                                'method': 'no_simplification_needed'
-                            }
+        try:
+            batch_results = self.polygon_simplifier.simplify_batch_parallel(batch_rings, self.max_workers)
+        except Exception as e:
+            print(f"⚠️  Ошибка упрощения полигонов: {e}")
+            batch_results = []
+        
+        for debug_index, (pred, (simplified_polygon, metrics)) in enumerate(zip(batch_predictions, batch_results)):
+            original_points = len(pred.polygon_xy)
+            
+            # Обновляем полигон в предсказании
+            if simplified_polygon.is_valid:
+                simplified_coords = np.asarray(simplified_polygon.exterior.coords)
+                pred.polygon_xy = simplified_coords
                 
-                simplified_predictions.append(pred)
+                # Добавляем метрики в предсказание
+                pred.simplification_metrics = {
+                    'original_points': metrics['original_points'],
+                    'simplified_points': metrics['simplified_points'],
+                    'area_preserved': metrics['area_preserved'],
+                    'method': metrics['method']
+                }
                 
-            except Exception as e:
-                print(f"⚠️  Ошибка упрощения полигона: {e}")
-                simplified_predictions.append(pred)
+                # Отладочная информация для первых нескольких полигонов
+                if debug_index < 5:
+                    logger.debug("Полигон %d: %d → %d точек, метод: %s",
+                                 debug_index, original_points, len(simplified_coords), metrics['method'])
+            else:
+                # Если упрощение не удалось, добавляем базовые метрики
+                pred.simplification_metrics = {
+                    'original_points': original_points,
+                    'simplified_points': original_points,
+                    'area_preserved': 1.0,
+                    'method': 'no_simplification_needed'
+                }
         
         simplification_time = time.time() - start_time
         self.performance_stats['simplification_time'] = simplification_time
         
         print(f"   ⏱️  Упрощение завершено за {simplification_time:.2f}с")
-        return simplified_predictions
+        return list(predictions)
     
     def _save_results(self, wsi_info: Dict[str, Any], predictions: List[Prediction], output_dir: str) -> Dict[str, Any]:
         """Сохраняет результаты"""
@@ -499,25 +1431,37 @@ class ImprovedWSIYOLOPipeline:
             'pipeline_version': 'improved_v1.0'
         }
         
-        # Конвертируем предсказания
+        # Конвертируем предсказания напрямую из полей, без asdict и без создания Coords
         for pred in predictions:
+            box = pred.box
             pred_dict = {
                 'class_name': pred.class_name,
                 'confidence': pred.conf,
-                'box': asdict(pred.box),
-                'polygon': [asdict(coord) for coord in pred.polygon] if pred.polygon else None
+                'box': {
+                    'start': {'x': box.start.x, 'y': box.start.y},
+                    'end': {'x': box.end.x, 'y': box.end.y}
+                },
+                'polygon': (
+                    [{'x': x, 'y': y} for x, y in pred.polygon_xy.tolist()]
+                    if pred.polygon_xy is not None and len(pred.polygon_xy) else None
+                )
             }
             
             # Добавляем метрики упрощения если есть
-            if hasattr(pred, 'simplification_metrics'):
+            if pred.simplification_metrics is not None:
                 pred_dict['simplification_metrics'] = pred.simplification_metrics
             
             results['predictions'].append(pred_dict)
         
-        # Сохраняем JSON
+        # Сохраняем JSON (orjson кодирует в C, если установлен)
         output_path = os.path.join(output_dir, 'improved_predictions.json')
-        with open(output_path, 'w') as f:
-            json.dump(results, f, indent=2)
+        if ORJSON_AVAILABLE:
+            Path(output_path).write_bytes(
+                orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2)
+            )
+        else:
+            with open(output_path, 'w') as f:
+                json.dump(results, f, indent=2)
         
         print(f"   ✅ Результаты сохранены: {output_path}")
         return results
@@ -567,4 +1511,8 @@ def main():
         print(f"❌ WSI файл не найден: {wsi_path}")
 
 if __name__ == "__main__":
-    main()
+    log_listener = configure_logging()
+    try:
+        main()
+    finally:
+        log_listener.stop()
@@ -4,13 +4,13 @@
 """
 
 import os
-import json
+import itertools
 from typing import List, Dict, Any
 from pathlib import Path
 import time
 from tqdm import tqdm
 
-from .data_structures import Model, WSIInfo, Prediction
+from .data_structures import Model, WSIInfo, Prediction, write_predictions_json
 from .monai_pipeline import WSIPipeline
 from .yolo_inference import YOLOInference
 from .polygon_merger import PolygonMerger
@@ -22,7 +22,8 @@ class WSIYOLOPipeline:
     def __init__(self, models_config: List[Dict[str, Any]], 
                  tile_size: int = 512, 
                  overlap_ratio: float = 0.5,
-                 iou_threshold: float = 0.5):
+                 iou_threshold: float = 0.5,
+                 batch_size: int = 32):
         """
         Инициализация pipeline
         
@@ -31,9 +32,11 @@ class WSIYOLOPipeline:
             tile_size: Размер патча
             overlap_ratio: Коэффициент перекрытия
             iou_threshold: Порог IoU для объединения
+            batch_size: Количество патчей в одном вызове YOLO моделей
         """
         self.tile_size = tile_size
         self.overlap_ratio = overlap_ratio
+        self.batch_size = batch_size
         
         # Создаем модели
         self.models = [Model(**config) for config in models_config]
@@ -73,27 +76,32 @@ class WSIYOLOPipeline:
         print(f"   Размер: {wsi_info.width}x{wsi_info.height}")
         print(f"   Уровни: {wsi_info.levels}")
         
-        # 2. Извлекаем патчи
-        print("🔧 Извлечение патчей...")
-        patches = self.wsi_pipeline.extract_patches(wsi_path)
-        print(f"   Найдено патчей: {len(patches)}")
-        
-        if not patches:
-            print("⚠️  Патчи не найдены")
-            return []
-        
-        # 3. Выполняем предсказания
-        print("🤖 Выполнение YOLO инференса...")
+        # 2-3. Извлекаем патчи и сразу выполняем предсказания: патчи обрабатываются
+        # по мере извлечения и не накапливаются в памяти
+        print("🔧 Извлечение патчей и выполнение YOLO инференса...")
         all_predictions = []
-        
-        for patch in tqdm(patches, desc="Обработка патчей"):
+        num_patches = 0
+        
+        # Патчи передаются моделям батчами по batch_size
+        patches = tqdm(self.wsi_pipeline.iter_patches(wsi_path), desc="Обработка патчей")
+        while True:
+            batch = list(itertools.islice(patches, self.batch_size))
+            if not batch:
+                break
+            num_patches += len(batch)
             try:
-                predictions = self.yolo_inference.predict_patch(patch)
+                predictions = self.yolo_inference.predict_batch(batch, self.batch_size)
                 all_predictions.extend(predictions)
             except Exception as e:
-                print(f"⚠️  Ошибка обработки патча {patch.patch_id}: {e}")
+                print(f"⚠️  Ошибка обработки патчей {batch[0].patch_id}-{batch[-1].patch_id}: {e}")
                 continue
         
+        print(f"   Найдено патчей: {num_patches}")
+        
+        if not num_patches:
+            print("⚠️  Патчи не найдены")
+            return []
+        
         print(f"   Найдено предсказаний: {len(all_predictions)}")
         
         # 4. Объединяем перекрывающиеся предсказания
@@ -123,38 +131,17 @@ class WSIYOLOPipeline:
         # Создаем директорию если не существует
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        # Подготавливаем данные для сохранения
-        results = {
+        # Предсказания кодируются и пишутся в файл по одному (orjson, если установлен)
+        header = {
             'wsi_info': {
                 'path': wsi_info.path,
                 'width': wsi_info.width,
                 'height': wsi_info.height,
                 'levels': wsi_info.levels,
                 'mpp': wsi_info.mpp
-            },
-            'predictions': []
-        }
-        
-        for pred in predictions:
-            pred_data = {
-                'class_name': pred.class_name,
-                'confidence': pred.conf,
-                'box': {
-                    'start': {'x': pred.box.start.x, 'y': pred.box.start.y},
-                    'end': {'x': pred.box.end.x, 'y': pred.box.end.y}
-                }
             }
-            
-            if pred.polygon:
-                pred_data['polygon'] = [
-                    {'x': p.x, 'y': p.y} for p in pred.polygon
-                ]
-            
-            results['predictions'].append(pred_data)
-        
-        # Сохраняем в JSON
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        }
+        write_predictions_json(output_path, header, predictions)
         
         print(f"💾 Результаты сохранены: {output_path}")
     
@@ -4,12 +4,13 @@ MONAI pipeline для работы с WSI и извлечения патчей.
 """
 
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional
 from monai.data import CuCIMWSIReader
 from monai.transforms import Compose, LoadImaged, EnsureChannelFirstd, GridPatchd
 import torch
 
-from .data_structures import PatchInfo, WSIInfo, Coords
+from .data_structures import PatchInfo, WSIInfo, Coords, morton_order
+from .tissue_mask import build_tissue_mask, tissue_window_counts
 
 
 class WSIPipeline:
@@ -26,6 +27,12 @@ class WSIPipeline:
         self.tile_size = tile_size
         self.overlap_ratio = overlap_ratio
         self.step_size = int(tile_size * (1 - overlap_ratio))
+        # Шаг прореживания пикселей при проверке ткани (по обеим осям)
+        self.tissue_stride = 8
+        
+        # Разбор метаданных WSI дорогой, поэтому читатель и открытые файлы переиспользуются
+        self._reader = CuCIMWSIReader(level=0)
+        self._wsi_handles = {}
         
         # Создаем transforms для MONAI
         self.transforms = Compose([
@@ -40,6 +47,21 @@ class WSIPipeline:
             )
         ])
     
+    def _get_wsi(self, wsi_path: str):
+        """Открытый CuImage для WSI: файл открывается и разбирается один раз на путь"""
+        wsi = self._wsi_handles.get(wsi_path)
+        if wsi is None:
+            wsi = self._reader.read(wsi_path)
+            self._wsi_handles[wsi_path] = wsi
+        return wsi
+    
+    def close(self):
+        """Закрывает все открытые WSI"""
+        for wsi in self._wsi_handles.values():
+            if hasattr(wsi, 'close'):
+                wsi.close()
+        self._wsi_handles.clear()
+    
     def load_wsi(self, wsi_path: str) -> WSIInfo:
         """
         Загружает информацию о WSI
@@ -51,11 +73,8 @@ class WSIPipeline:
             WSIInfo: Информация о WSI
         """
         try:
-            # Создаем reader для получения метаданных
-            reader = CuCIMWSIReader(level=0)
-            
             # Получаем метаданные без загрузки изображения
-            wsi = reader.read(wsi_path)
+            wsi = self._get_wsi(wsi_path)
             
             # Извлекаем информацию о размерах
             width = wsi.shape[1] if len(wsi.shape) > 1 else 0
@@ -104,41 +123,38 @@ class WSIPipeline:
         Returns:
             List[PatchInfo]: Список патчей с информацией
         """
+        return list(self.iter_patches(wsi_path))
+    
+    def iter_patches(self, wsi_path: str) -> Iterator[PatchInfo]:
+        """
+        Последовательно выдает патчи из результата GridPatchd
+        
+        Args:
+            wsi_path: Путь к WSI файлу
+            
+        Yields:
+            PatchInfo: Патч с тканью
+        """
         # Подготавливаем данные для transforms
         data = {"image": wsi_path}
         
         # Применяем transforms
         result = self.transforms(data)
         
-        patches = []
-        patch_id = 0
-        
         # Извлекаем патчи из результата
-        if "image" in result:
-            patches_array = result["image"]
-            
-            # Получаем координаты патчей
-            if "image_location" in result:
-                locations = result["image_location"]
-                
-                for i, (patch_img, location) in enumerate(zip(patches_array, locations)):
-                    # location содержит координаты патча
-                    x, y = location[0], location[1]  # Координаты в WSI
-                    
-                    # Создаем PatchInfo
-                    patch_info = PatchInfo(
-                        patch_id=patch_id,
-                        x=x,
-                        y=y,
-                        size=self.tile_size,
-                        image=patch_img,
-                        has_tissue=True  # GridPatchd уже отфильтровал пустые патчи
-                    )
-                    
-                    patches.append(patch_info)
-                    patch_id += 1
-        
-        return patches
+        if "image" not in result or "image_location" not in result:
+            return
+        
+        # location содержит координаты патча в WSI
+        for patch_id, (patch_img, location) in enumerate(zip(result["image"], result["image_location"])):
+            yield PatchInfo(
+                patch_id=patch_id,
+                x=location[0],
+                y=location[1],
+                size=self.tile_size,
+                image=patch_img,
+                has_tissue=True  # GridPatchd уже отфильтровал пустые патчи
+            )
     
     def extract_patches_with_overlap(self, wsi_path: str) -> List[PatchInfo]:
         """
@@ -150,37 +166,71 @@ class WSIPipeline:
         Returns:
             List[PatchInfo]: Список патчей с информацией
         """
-        # Загружаем WSI
-        reader = CuCIMWSIReader(level=0)
-        img_array, metadata = reader.get_data(wsi_path)
+        return list(self.iter_patches_with_overlap(wsi_path))
+    
+    def iter_patches_with_overlap(self, wsi_path: str) -> Iterator[PatchInfo]:
+        """
+        Последовательно читает патчи с перекрытием и выдает патчи с тканью
+        
+        Каждый патч читается из WSI отдельным read_region, поэтому в памяти
+        находится один патч, а не весь слайд. Клетки сетки без ткани на маске
+        уменьшенного уровня (порог Оцу) не читаются с уровня 0 вовсе.
+        
+        Args:
+            wsi_path: Путь к WSI файлу
+            
+        Yields:
+            PatchInfo: Патч с тканью
+        """
+        # Открываем WSI без чтения пикселей (или берем уже открытый)
+        wsi = self._get_wsi(wsi_path)
         
-        patches = []
         patch_id = 0
         
         # Вычисляем сетку патчей с перекрытием
-        height, width = img_array.shape[:2]
-        
-        for y in range(0, height - self.tile_size + 1, self.step_size):
-            for x in range(0, width - self.tile_size + 1, self.step_size):
-                # Извлекаем патч
-                patch_img = img_array[y:y+self.tile_size, x:x+self.tile_size]
-                
-                # Проверяем, содержит ли патч ткань (простая проверка)
-                has_tissue = self._has_tissue(patch_img)
-                
-                if has_tissue:
-                    patch_info = PatchInfo(
-                        patch_id=patch_id,
-                        x=x,
-                        y=y,
-                        size=self.tile_size,
-                        image=patch_img,
-                        has_tissue=True
-                    )
-                    patches.append(patch_info)
-                    patch_id += 1
-        
-        return patches
+        height, width = wsi.shape[:2]
+        ys, xs = np.mgrid[0:height - self.tile_size + 1:self.step_size,
+                          0:width - self.tile_size + 1:self.step_size].reshape(2, -1)
+        
+        # Отбрасываем клетки без ткани по уменьшенному уровню
+        tissue_mask, downsample = self._build_tissue_mask(wsi)
+        if tissue_mask is not None:
+            keep = tissue_window_counts(tissue_mask, downsample, xs, ys, self.tile_size)[0] > 0
+            xs, ys = xs[keep], ys[keep]
+        
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            # Извлекаем патч
+            patch_img = np.asarray(wsi.read_region((x, y), (self.tile_size, self.tile_size)))[:, :, :3]
+            
+            # Проверяем, содержит ли патч ткань (простая проверка)
+            if self._has_tissue(patch_img):
+                yield PatchInfo(
+                    patch_id=patch_id,
+                    x=x,
+                    y=y,
+                    size=self.tile_size,
+                    image=patch_img,
+                    has_tissue=True
+                )
+                patch_id += 1
+    
+    def _build_tissue_mask(self, wsi, max_size: int = 5000) -> Tuple[Optional[np.ndarray], float]:
+        """
+        Строит маску ткани по уменьшенному уровню пирамиды WSI (см. build_tissue_mask)
+        
+        Args:
+            wsi: Открытый CuImage
+            max_size: Максимальный размер уровня маски по большей стороне
+            
+        Returns:
+            Tuple: (маска (h, w) bool или None без подходящего уровня,
+                коэффициент уменьшения уровня маски)
+        """
+        try:
+            return build_tissue_mask(wsi, max_size)
+        except Exception as e:
+            print(f"⚠️  Маска ткани по уменьшенному уровню не построена: {e}")
+            return None, 1.0
     
     def _has_tissue(self, patch: np.ndarray) -> bool:
         """
@@ -192,11 +242,9 @@ class WSIPipeline:
         Returns:
             bool: True если патч содержит ткань
         """
-        # Простая проверка: если средняя яркость меньше 240, то есть ткань
-        if len(patch.shape) == 3:
-            mean_brightness = np.mean(patch)
-        else:
-            mean_brightness = np.mean(patch)
+        # Простая проверка: если средняя яркость меньше 240, то есть ткань.
+        # Для средней яркости достаточно каждого tissue_stride-го пикселя по обеим осям
+        mean_brightness = np.mean(patch[::self.tissue_stride, ::self.tissue_stride])
         
         return mean_brightness < 240  # Порог для определения ткани
     
@@ -208,12 +256,10 @@ class WSIPipeline:
             wsi_info: Информация о WSI
             
         Returns:
-            List[Tuple[int, int]]: Список координат (x, y) патчей
+            List[Tuple[int, int]]: Список координат (x, y) патчей в порядке кривой
+                Мортона: соседние патчи идут подряд, что бережет кэш тайлов декодера
         """
-        coordinates = []
-        
-        for y in range(0, wsi_info.height - self.tile_size + 1, self.step_size):
-            for x in range(0, wsi_info.width - self.tile_size + 1, self.step_size):
-                coordinates.append((x, y))
-        
-        return coordinates
+        ys, xs = np.mgrid[0:wsi_info.height - self.tile_size + 1:self.step_size,
+                          0:wsi_info.width - self.tile_size + 1:self.step_size].reshape(2, -1)
+        order = morton_order(xs // self.step_size, ys // self.step_size)
+        return list(zip(xs[order].tolist(), ys[order].tolist()))
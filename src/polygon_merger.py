@@ -3,13 +3,88 @@
 Использует shapely для геометрических операций.
 """
 
-from typing import List, Tuple
+import concurrent.futures
+import os
+from typing import List, Optional, Tuple
 import numpy as np
-from shapely.geometry import Polygon, MultiPolygon
-from shapely.ops import unary_union
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
 from shapely.validation import make_valid
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-from data_structures import Prediction, Coords, Box
+from data_structures import Prediction, Coords, Box, boxes_to_array, box_iou_matrix, box_iou_pairs, morton_order
+from adaptive_polygon_simplifier import fast_simplify, pack_rings, rings_to_polygons, visvalingam_ring
+
+
+def union_polygons(polygons: np.ndarray,
+                   executor: Optional[concurrent.futures.Executor] = None,
+                   chunk_size: int = 256) -> List[Polygon]:
+    """
+    Объединяет полигоны по компонентам связности графа пересечений
+    
+    Полигоны из разных компонент не пересекаются, поэтому объединение каждой
+    компоненты отдельно дает те же части, что и unary_union всего набора.
+    Одиночные полигоны возвращаются без вызова GEOS. Компоненты больше
+    chunk_size объединяются каскадом: сначала части по chunk_size в порядке
+    кривой Мортона по центрам bounding box (части компактны, и их результаты
+    почти не пересекаются), затем результаты частей.
+    
+    Объединения одного этапа выполняются в executor: shapely 2.x отпускает GIL
+    на время вызовов GEOS, поэтому пул потоков загружает все ядра. Пул создает
+    вызывающий код и передает сюда, вложенных пулов нет. Без executor каждая
+    компонента объединяется одним unary_union - на одном ядре каскад не дает
+    выигрыша.
+    
+    Args:
+        polygons: Массив валидных shapely полигонов
+        executor: Пул потоков для объединения (None - последовательно)
+        chunk_size: Полигонов в одной части каскадного объединения
+        
+    Returns:
+        List[Polygon]: Части объединения в порядке первого полигона компоненты
+    """
+    pair_i, pair_j = STRtree(polygons).query(polygons, predicate='intersects')
+    graph = coo_matrix((np.ones(len(pair_i), dtype=bool), (pair_i, pair_j)),
+                       shape=(len(polygons), len(polygons)))
+    _, labels = connected_components(graph, directed=False)
+    
+    # Номера компонент идут в порядке их первого полигона
+    order = np.argsort(labels, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(labels))[:-1])
+    
+    map_fn = executor.map if executor is not None else map
+    
+    # Этап 1: компоненты из нескольких полигонов (крупные - частями по кривой Мортона)
+    chunks, owners = [], []
+    for k, group in enumerate(groups):
+        if len(group) == 1:
+            continue
+        members = polygons[group]
+        if executor is not None and len(members) > chunk_size:
+            bounds = shapely.bounds(members)
+            centers = np.clip((bounds[:, :2] + bounds[:, 2:]) / 2, 0, None).astype(np.int64)
+            members = members[morton_order(centers[:, 0], centers[:, 1])]
+        step = chunk_size if executor is not None else len(members)
+        for start in range(0, len(members), step):
+            chunks.append(members[start:start + step])
+            owners.append(k)
+    
+    partials = [[] for _ in groups]
+    for k, union in zip(owners, list(map_fn(shapely.union_all, chunks))):
+        partials[k].append(union)
+    
+    # Этап 2: результаты частей крупных компонент
+    cascaded = [k for k, group_partials in enumerate(partials) if len(group_partials) > 1]
+    for k, union in zip(cascaded, list(map_fn(shapely.union_all, [partials[k] for k in cascaded]))):
+        partials[k] = [union]
+    
+    parts = []
+    for group, group_partials in zip(groups, partials):
+        group_parts = polygons[group] if len(group) == 1 else shapely.get_parts(group_partials[0])
+        parts.extend(part for part in group_parts.tolist() if not part.is_empty)
+    return parts
 
 
 class PolygonMerger:
@@ -25,6 +100,8 @@ class PolygonMerger:
         """
         self.iou_threshold = iou_threshold
         self.min_area = min_area
+        # Полигонов в одной части каскадного объединения
+        self.union_chunk_size = 256
     
     def merge_predictions(self, predictions: List[Prediction]) -> List[Prediction]:
         """
@@ -42,12 +119,18 @@ class PolygonMerger:
         # Группируем предсказания по классам
         grouped_predictions = self._group_by_class(predictions)
         
+        # Один пул потоков на вызов; параллельно идет только объединение полигонов (см. union_polygons)
+        max_workers = os.cpu_count() or 1
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        
         merged_predictions = []
         
-        for class_name, class_predictions in grouped_predictions.items():
-            # Объединяем предсказания одного класса
-            merged_class_predictions = self._merge_class_predictions(class_predictions)
-            merged_predictions.extend(merged_class_predictions)
+        try:
+            for class_predictions in grouped_predictions.values():
+                merged_predictions.extend(self._merge_class_predictions(class_predictions, executor))
+        finally:
+            if executor is not None:
+                executor.shutdown()
         
         return merged_predictions
     
@@ -61,19 +144,29 @@ class PolygonMerger:
         Returns:
             dict: Словарь {class_name: [predictions]}
         """
+        class_names = np.array([pred.class_name for pred in predictions])
+        unique_names, first_indices, class_indices, counts = np.unique(
+            class_names, return_index=True, return_inverse=True, return_counts=True
+        )
+        
+        # Индексы предсказаний, отсортированные по классу (внутри класса - исходный порядок)
+        order = np.argsort(class_indices, kind='stable')
+        class_groups = np.split(order, np.cumsum(counts)[:-1])
+        
+        # Классы в порядке первого появления, как при группировке словарем
         grouped = {}
-        for pred in predictions:
-            if pred.class_name not in grouped:
-                grouped[pred.class_name] = []
-            grouped[pred.class_name].append(pred)
+        for k in np.argsort(first_indices):
+            grouped[str(unique_names[k])] = [predictions[i] for i in class_groups[k]]
         return grouped
     
-    def _merge_class_predictions(self, predictions: List[Prediction]) -> List[Prediction]:
+    def _merge_class_predictions(self, predictions: List[Prediction],
+                                 executor: Optional[concurrent.futures.Executor] = None) -> List[Prediction]:
         """
         Объединяет предсказания одного класса
         
         Args:
             predictions: Список предсказаний одного класса
+            executor: Пул потоков для объединения полигонов (None - последовательно)
             
         Returns:
             List[Prediction]: Объединенные предсказания
@@ -83,39 +176,34 @@ class PolygonMerger:
         
         print(f"   Объединение {len(predictions)} предсказаний класса {predictions[0].class_name}")
         
-        # Создаем полигоны из предсказаний
-        polygons = []
+        # Кольца предсказаний с полигонами (минимум 3 точки для полигона)
+        num_points = np.array([pred.num_points for pred in predictions])
+        rings = [pred.polygon_xy for pred, n in zip(predictions, num_points.tolist()) if n >= 3]
+        num_short = int(np.count_nonzero((num_points > 0) & (num_points < 3)))
         
-        for i, pred in enumerate(predictions):
-            if pred.polygon:
-                try:
-                    # Создаем shapely полигон
-                    coords = [(p.x, p.y) for p in pred.polygon]
-                    if len(coords) >= 3:  # Минимум 3 точки для полигона
-                        poly = Polygon(coords)
-                        if poly.is_valid:
-                            polygons.append(poly)
-                        else:
-                            print(f"⚠️  Невалидный полигон для предсказания {i}: {pred.class_name}")
-                    else:
-                        print(f"⚠️  Недостаточно точек для полигона {i}: {len(coords)}")
-                except Exception as e:
-                    print(f"⚠️  Ошибка создания полигона {i} (класс: {pred.class_name}): {e}")
-                    print(f"   Количество точек: {len(pred.polygon) if pred.polygon else 0}")
-                    print(f"   Тип ошибки: {type(e).__name__}")
-                    import traceback
-                    print(f"   Стек ошибки: {traceback.format_exc()}")
-                    continue
+        # Строим все полигоны и проверяем их валидность пакетными вызовами GEOS
+        try:
+            polygons = rings_to_polygons(*pack_rings(rings))
+        except Exception as e:
+            print(f"⚠️  Ошибка создания полигонов (класс: {predictions[0].class_name}): {e}")
+            return predictions
         
-        if not polygons:
+        valid = shapely.is_valid(polygons)
+        num_invalid = len(valid) - int(np.count_nonzero(valid))
+        if num_short or num_invalid:
+            print(f"⚠️  Отброшено полигонов класса {predictions[0].class_name}: "
+                  f"{num_short} с числом точек меньше трех, {num_invalid} невалидных")
+        polygons = polygons[valid]
+        
+        if not len(polygons):
             return predictions
         
         # Объединяем полигоны
         try:
-            merged_polygons = unary_union(polygons)
+            merged_polygons = union_polygons(polygons, executor, self.union_chunk_size)
             
             # Обрабатываем результат объединения
-            if merged_polygons.is_empty:
+            if not merged_polygons:
                 return predictions
             
             # Создаем новые предсказания из объединенных полигонов
@@ -124,15 +212,9 @@ class PolygonMerger:
             # Получаем класс из первого предсказания (все должны быть одного класса)
             class_name = predictions[0].class_name if predictions else "unknown"
             
-            if isinstance(merged_polygons, MultiPolygon):
-                for poly in merged_polygons.geoms:
-                    if poly.area >= self.min_area:
-                        merged_pred = self._polygon_to_prediction(poly, class_name)
-                        if merged_pred:
-                            merged_predictions.append(merged_pred)
-            else:
-                if merged_polygons.area >= self.min_area:
-                    merged_pred = self._polygon_to_prediction(merged_polygons, class_name)
+            for poly, area in zip(merged_polygons, shapely.area(merged_polygons).tolist()):
+                if area >= self.min_area:
+                    merged_pred = self._polygon_to_prediction(poly, class_name)
                     if merged_pred:
                         merged_predictions.append(merged_pred)
             
@@ -171,8 +253,7 @@ class PolygonMerger:
             )
             
             # Создаем полигон из координат (исключаем последнюю дублирующуюся точку)
-            coords = list(polygon.exterior.coords[:-1])
-            polygon_coords = [Coords(x=x, y=y) for x, y in coords]
+            polygon_xy = np.asarray(polygon.exterior.coords)[:-1]
             
             # Вычисляем среднюю уверенность (можно улучшить)
             confidence = 0.8  # По умолчанию
@@ -181,7 +262,7 @@ class PolygonMerger:
                 class_name=class_name,
                 box=box,
                 conf=confidence,
-                polygon=polygon_coords
+                polygon_xy=polygon_xy
             )
             
         except Exception as e:
@@ -204,23 +285,28 @@ class PolygonMerger:
         # Сортируем по уверенности (убывание)
         sorted_predictions = sorted(predictions, key=lambda x: x.conf, reverse=True)
         
-        filtered = []
+        # IoU > 0 только у пересекающихся bbox, поэтому пары кандидатов дает STRtree,
+        # а не перебор всех пар. Берем пары (i, более уверенный j < i) одного класса
+        # с IoU выше порога, сгруппированные по i
+        boxes = boxes_to_array(sorted_predictions)
+        class_names = np.array([pred.class_name for pred in sorted_predictions])
+        tree = STRtree(shapely.box(boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]))
+        pair_i, pair_j = tree.query(tree.geometries, predicate='intersects')
+        candidates = (pair_j < pair_i) & (class_names[pair_i] == class_names[pair_j])
+        pair_i, pair_j = pair_i[candidates], pair_j[candidates]
+        duplicates = box_iou_pairs(boxes[pair_i], boxes[pair_j]) > self.iou_threshold
+        pair_i, pair_j = pair_i[duplicates], pair_j[duplicates]
+        pair_order = np.argsort(pair_i, kind='stable')
+        pair_i, pair_j = pair_i[pair_order], pair_j[pair_order]
         
-        for pred in sorted_predictions:
-            # Проверяем IoU с уже отфильтрованными предсказаниями
-            is_duplicate = False
-            
-            for filtered_pred in filtered:
-                if pred.class_name == filtered_pred.class_name:
-                    iou = pred.box.iou(filtered_pred.box)
-                    if iou > self.iou_threshold:
-                        is_duplicate = True
-                        break
-            
-            if not is_duplicate:
-                filtered.append(pred)
+        # Предсказание - дубликат, если похоже хотя бы на одно уже оставленное
+        pair_starts = np.searchsorted(pair_i, np.arange(len(sorted_predictions)), side='left')
+        pair_ends = np.searchsorted(pair_i, np.arange(len(sorted_predictions)), side='right')
+        is_kept = np.zeros(len(sorted_predictions), dtype=bool)
+        for i in range(len(sorted_predictions)):
+            is_kept[i] = not is_kept[pair_j[pair_starts[i]:pair_ends[i]]].any()
         
-        return filtered
+        return [pred for pred, kept in zip(sorted_predictions, is_kept) if kept]
     
     def merge_overlapping_boxes(self, predictions: List[Prediction]) -> List[Prediction]:
         """
@@ -244,30 +330,31 @@ class PolygonMerger:
             sorted_preds = sorted(class_predictions, key=lambda x: x.conf, reverse=True)
             
             merged_class_preds = []
+            # Bounding boxes объединенных предсказаний [x1, y1, x2, y2] в порядке merged_class_preds
+            merged_boxes = np.empty((len(sorted_preds), 4))
             
             for pred in sorted_preds:
-                # Проверяем пересечение с уже объединенными
-                should_merge = False
-                merge_with = None
+                # IoU с уже объединенными одним вызовом; объединяем с первым пересекающимся
+                # (IoU > 0) предсказанием выше порога
+                pred_box = np.array([[pred.box.start.x, pred.box.start.y, pred.box.end.x, pred.box.end.y]])
+                iou = box_iou_matrix(pred_box, merged_boxes[:len(merged_class_preds)])[0]
+                matches = np.flatnonzero((iou > 0) & (iou > self.iou_threshold))
                 
-                for merged_pred in merged_class_preds:
-                    if pred.box.intersects(merged_pred.box):
-                        iou = pred.box.iou(merged_pred.box)
-                        if iou > self.iou_threshold:
-                            should_merge = True
-                            merge_with = merged_pred
-                            break
-                
-                if should_merge and merge_with:
+                if len(matches):
                     # Объединяем с существующим предсказанием
+                    merge_index = int(matches[0])
+                    merge_with = merged_class_preds[merge_index]
                     merged_box = self._merge_boxes(pred.box, merge_with.box)
                     merged_conf = max(pred.conf, merge_with.conf)
                     
                     # Обновляем существующее предсказание
                     merge_with.box = merged_box
                     merge_with.conf = merged_conf
+                    merged_boxes[merge_index] = (merged_box.start.x, merged_box.start.y,
+                                                 merged_box.end.x, merged_box.end.y)
                 else:
                     # Добавляем новое предсказание
+                    merged_boxes[len(merged_class_preds)] = pred_box[0]
                     merged_class_preds.append(pred)
             
             merged_predictions.extend(merged_class_preds)
@@ -313,6 +400,13 @@ class PolygonMerger:
             if current_points <= max_points:
                 return current_poly
             
+            # Ровно max_points точек (с замыкающей) за один проход Visvalingam-Whyatt;
+            # поиск tolerance ниже нужен, только если результат невалиден
+            coords = np.asarray(current_poly.exterior.coords)[:-1]
+            simplified = Polygon(coords[visvalingam_ring(coords, max_points - 1)])
+            if simplified.is_valid:
+                return simplified
+            
             # Адаптивное упрощение с бинарным поиском tolerance
             min_tolerance = 0.1
             max_tolerance = 10.0
@@ -321,7 +415,7 @@ class PolygonMerger:
             # Бинарный поиск оптимального tolerance
             for _ in range(10):  # Максимум 10 итераций
                 tolerance = (min_tolerance + max_tolerance) / 2
-                simplified = current_poly.simplify(tolerance, preserve_topology=True)
+                simplified = fast_simplify(current_poly, tolerance)
                 
                 if simplified.is_valid and len(simplified.exterior.coords) > 3:
                     points_count = len(simplified.exterior.coords)
@@ -341,12 +435,14 @@ class PolygonMerger:
             
             # Если все еще слишком много точек, используем равномерную выборку
             if len(best_poly.exterior.coords) > max_points:
-                coords = list(best_poly.exterior.coords)
-                step = len(coords) // max_points
-                sampled_coords = coords[::max(1, step)]
+                # Ровно max_points индексов по замкнутому кольцу: первая и последняя
+                # точки совпадают, поэтому кольцо остается замкнутым
+                coords = np.asarray(best_poly.exterior.coords)
+                indices = np.linspace(0, len(coords) - 1, max_points, dtype=np.int64)
+                sampled_coords = coords[indices]
                 
                 # Создаем новый полигон из выбранных точек
-                if len(sampled_coords) >= 3:
+                if len(sampled_coords) >= 4:
                     sampled_poly = Polygon(sampled_coords)
                     if sampled_poly.is_valid:
                         best_poly = sampled_poly
@@ -3,28 +3,84 @@
 Использует cuCIM напрямую для извлечения патчей.
 """
 
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import os
+from pathlib import Path
+
 import numpy as np
-from typing import List, Tuple
+from scipy import ndimage
+from typing import Iterator, List, Optional, Tuple
 import cucim
 from cucim import CuImage
 
-from data_structures import PatchInfo, WSIInfo, Coords
+from data_structures import PatchInfo, WSIInfo, Coords, morton_order
+from tissue_mask import read_tissue_mask, tissue_window_counts
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import cupy
+    CUPY_AVAILABLE = True
+except ImportError:
+    CUPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def _patch_moments(flat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Суммы значений и их квадратов для каждой строки (N, M) uint8 за один проход"""
+    sums = np.empty(flat.shape[0], dtype=np.int64)
+    squares = np.empty(flat.shape[0], dtype=np.int64)
+    for i in range(flat.shape[0]):
+        total = 0
+        total_squares = 0
+        for j in range(flat.shape[1]):
+            value = np.int64(flat[i, j])
+            total += value
+            total_squares += value * value
+        sums[i] = total
+        squares[i] = total_squares
+    return sums, squares
+
+
+if NUMBA_AVAILABLE:
+    _patch_moments = njit(cache=True)(_patch_moments)
 
 
 class SimplePatchLoader:
     """Простой загрузчик патчей из WSI"""
     
-    def __init__(self, tile_size: int = 512, overlap_ratio: float = 0.5):
+    def __init__(self, tile_size: int = 512, overlap_ratio: float = 0.5, max_workers: Optional[int] = None,
+                 cache_dir: Optional[str] = "~/.cache/wsiyolo", read_on_gpu: bool = False):
         """
         Инициализация загрузчика
         
         Args:
             tile_size: Размер патча
             overlap_ratio: Коэффициент перекрытия (0.5 = 50% перекрытие)
+            max_workers: Количество потоков чтения патчей (None - по числу CPU)
+            cache_dir: Каталог кэша масок ткани (None - не кэшировать)
+            read_on_gpu: Читать патчи сразу в видеопамять и проверять ткань на GPU
+                (нужен CuPy; изображения патчей - массивы CuPy)
         """
         self.tile_size = tile_size
         self.overlap_ratio = overlap_ratio
         self.step_size = int(tile_size * (1 - overlap_ratio))
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Минимальная доля ткани в окне патча по маске уменьшенного уровня
+        self.min_tissue_fraction = 0.1
+        # Патчей в одной задаче чтения: ткань в них проверяется одной редукцией
+        self.tissue_batch_size = 16
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir else None
+        self.read_on_gpu = read_on_gpu and CUPY_AVAILABLE
     
     def load_wsi_info(self, wsi_path: str) -> WSIInfo:
         """
@@ -82,80 +138,277 @@ class SimplePatchLoader:
         Returns:
             List[PatchInfo]: Список патчей с информацией
         """
+        patches = list(self.iter_patches(wsi_path, max_patches))
+        print(f"✅ Извлечено патчей с тканью: {len(patches)}")
+        return patches
+    
+    def iter_patches(self, wsi_path: str, max_patches: int = None) -> Iterator[PatchInfo]:
+        """
+        Последовательно извлекает патчи с тканью из WSI в Z-порядке сетки
+        
+        Если у WSI есть уменьшенный уровень, фон отсеивается по маске ткани
+        (порог Оцу) до чтения патчей; каждый прочитанный патч затем проверяется
+        _has_tissue_batch. Патчи читаются частями по tissue_batch_size в
+        max_workers потоках (cuCIM отпускает GIL на время декодирования), при
+        этом вперед читается не больше max_workers + 1 частей, поэтому
+        обработка полного WSI не требует хранения всех изображений.
+        
+        Args:
+            wsi_path: Путь к WSI файлу
+            max_patches: Максимальное количество патчей (None - без ограничения)
+            
+        Yields:
+            PatchInfo: Патч с тканью
+        """
         print(f"🔍 Извлечение патчей из WSI: {wsi_path}")
         
         try:
             # Загружаем WSI
             wsi = CuImage(wsi_path)
-            
-            patches = []
-            patch_id = 0
-            
-            # Вычисляем сетку патчей с перекрытием
-            height, width = wsi.shape[:2]
-            
-            print(f"📊 Размер WSI: {width}x{height}")
-            print(f"🔧 Параметры: tile_size={self.tile_size}, step_size={self.step_size}")
-            
-            # Вычисляем общее количество патчей для прогресс-бара
-            total_patches = 0
-            for y in range(0, height - self.tile_size + 1, self.step_size):
-                for x in range(0, width - self.tile_size + 1, self.step_size):
-                    total_patches += 1
-            
-            print(f"   Всего патчей для проверки: {total_patches}")
-            
-            # Извлекаем патчи с перекрытием
-            from tqdm import tqdm
-            
-            patch_coords = []
-            for y in range(0, height - self.tile_size + 1, self.step_size):
-                for x in range(0, width - self.tile_size + 1, self.step_size):
-                    patch_coords.append((x, y))
-            
-            for x, y in tqdm(patch_coords, desc="Извлечение патчей"):
-                # Извлекаем патч
-                patch_img = wsi.read_region((x, y), (self.tile_size, self.tile_size))
-                
-                # Конвертируем в numpy array и RGB формат
-                if hasattr(patch_img, 'numpy'):
-                    patch_img = patch_img.numpy()
-                else:
-                    patch_img = np.array(patch_img)
-                
-                # Убеждаемся, что это RGB изображение
-                if len(patch_img.shape) == 3 and patch_img.shape[2] == 4:
-                    # RGBA -> RGB
-                    patch_img = patch_img[:, :, :3]
-                elif len(patch_img.shape) == 2:
-                    # Grayscale -> RGB
-                    patch_img = np.stack([patch_img] * 3, axis=-1)
-                
-                # Проверяем, содержит ли патч ткань
-                has_tissue = self._has_tissue(patch_img)
-                
-                if has_tissue:
-                    patch_info = PatchInfo(
-                        patch_id=patch_id,
-                        x=x,
-                        y=y,
-                        size=self.tile_size,
-                        image=patch_img,
-                        has_tissue=True
-                    )
-                    patches.append(patch_info)
-                    patch_id += 1
+        except Exception as e:
+            print(f"❌ Ошибка извлечения патчей: {e}")
+            return
+        
+        # Вычисляем сетку патчей с перекрытием; обходим ее по кривой Мортона,
+        # чтобы соседние патчи читались из уже декодированных тайлов WSI
+        height, width = wsi.shape[:2]
+        ys, xs = np.mgrid[0:height - self.tile_size + 1:self.step_size,
+                          0:width - self.tile_size + 1:self.step_size].reshape(2, -1)
+        order = morton_order(xs // self.step_size, ys // self.step_size)
+        xs, ys = xs[order], ys[order]
+        
+        print(f"📊 Размер WSI: {width}x{height}")
+        print(f"🔧 Параметры: tile_size={self.tile_size}, step_size={self.step_size}")
+        print(f"   Всего патчей для проверки: {len(xs)}")
+        
+        tissue_mask, downsample = self._load_tissue_mask(wsi_path, wsi)
+        if tissue_mask is not None:
+            # Маска миниатюры только отсеивает заведомо пустые патчи,
+            # отобранные все равно проверяются по пикселям при чтении
+            keep = self._tissue_fraction(tissue_mask, downsample, xs, ys) >= self.min_tissue_fraction
+            xs, ys = xs[keep], ys[keep]
+            print(f"   Патчей с тканью по маске: {len(xs)}")
+        
+        # Извлекаем патчи с перекрытием
+        from tqdm import tqdm
+        
+        patch_id = 0
+        chunks = ((xs[start:start + self.tissue_batch_size], ys[start:start + self.tissue_batch_size])
+                  for start in range(0, len(xs), self.tissue_batch_size))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                tqdm(total=len(xs), desc="Извлечение патчей") as progress:
+            pending = collections.deque()
+            try:
+                while True:
+                    # Держим очередь чтений заполненной, результаты забираем по порядку обхода
+                    for chunk_xs, chunk_ys in itertools.islice(chunks, self.max_workers + 1 - len(pending)):
+                        pending.append((chunk_xs, chunk_ys, executor.submit(
+                            self._read_tissue_chunk, wsi, chunk_xs, chunk_ys)))
+                    if not pending:
+                        return
+                    
+                    chunk_xs, chunk_ys, future = pending.popleft()
+                    kept, images = future.result()
+                    progress.update(len(chunk_xs))
                     
-                    # Ограничиваем количество патчей
-                    if max_patches and len(patches) >= max_patches:
-                        break
+                    for x, y, patch_img in zip(chunk_xs[kept].tolist(), chunk_ys[kept].tolist(), images):
+                        yield PatchInfo(
+                            patch_id=patch_id,
+                            x=x,
+                            y=y,
+                            size=self.tile_size,
+                            image=patch_img,
+                            has_tissue=True
+                        )
+                        patch_id += 1
+                        
+                        # Ограничиваем количество патчей
+                        if max_patches and patch_id >= max_patches:
+                            return
+            finally:
+                # При досрочном выходе не дочитываем уже поставленные части
+                for _, _, future in pending:
+                    future.cancel()
+    
+    def _read_tissue_chunk(self, wsi: CuImage, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Читает часть патчей в один массив и оставляет только патчи с тканью
+        
+        Args:
+            wsi: Открытый CuImage
+            xs, ys: Координаты левых верхних углов патчей (n,)
             
-            print(f"✅ Извлечено патчей с тканью: {len(patches)}")
-            return patches
+        Returns:
+            Tuple: (индексы оставленных патчей в части, их RGB изображения (k, T, T, 3);
+                при read_on_gpu - массив CuPy в видеопамяти)
+        """
+        if self.read_on_gpu:
+            # Своя очередь CUDA на каждую часть: копирования и редукции частей,
+            # читаемых в разных потоках, не сериализуются в очереди по умолчанию
+            stream = cupy.cuda.Stream(non_blocking=True)
+            with stream:
+                kept, images = self._read_chunk_images(wsi, xs, ys, cupy, {'device': 'cuda'})
+            stream.synchronize()
+            return kept, images
+        return self._read_chunk_images(wsi, xs, ys, np, {})
+    
+    def _read_chunk_images(self, wsi: CuImage, xs: np.ndarray, ys: np.ndarray,
+                           xp, read_kwargs: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """Читает часть патчей в массив модуля xp (numpy или cupy), см. _read_tissue_chunk"""
+        images = xp.empty((len(xs), self.tile_size, self.tile_size, 3), dtype=xp.uint8)
+        is_read = np.zeros(len(xs), dtype=bool)
+        
+        for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+            try:
+                # Буфер CuImage отображается в numpy (или CuPy) без копирования
+                patch_img = xp.asarray(wsi.read_region((x, y), (self.tile_size, self.tile_size), **read_kwargs))
+                if patch_img.ndim == 2:
+                    # Grayscale -> RGB при копировании
+                    patch_img = patch_img[:, :, None]
+                # Единственное копирование (RGBA -> RGB) - сразу в массив части
+                images[i] = patch_img[:, :, :3]
+                is_read[i] = True
+            except Exception as e:
+                logger.warning("Ошибка извлечения патча (%d, %d): %s", x, y, e)
+        
+        keep = is_read & self._has_tissue_batch(images)
+        kept = np.flatnonzero(keep)
+        return kept, images[xp.asarray(kept)]
+    
+    def _tissue_cache_path(self, wsi_path: str) -> Optional[Path]:
+        """
+        Путь файла кэша маски ткани для WSI
+        
+        Ключ - sha1 от абсолютного пути, размера и времени изменения файла,
+        поэтому замененный на месте слайд не получит чужую маску.
+        
+        Args:
+            wsi_path: Путь к WSI файлу
             
+        Returns:
+            Optional[Path]: Путь .npz файла или None, если кэш отключен
+        """
+        if self.cache_dir is None:
+            return None
+        
+        stat = os.stat(wsi_path)
+        key = f"{os.path.abspath(wsi_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}_tissue.npz"
+    
+    def _load_tissue_mask(self, wsi_path: str, wsi: CuImage) -> Tuple[Optional[np.ndarray], float]:
+        """
+        Возвращает маску ткани из кэша на диске или строит ее и сохраняет в кэш
+        
+        Маска не зависит от параметров сетки, поэтому повторные запуски с любым
+        tile_size и overlap_ratio не читают уменьшенный уровень и не считают порог Оцу.
+        
+        Args:
+            wsi_path: Путь к WSI файлу
+            wsi: Открытый CuImage
+            
+        Returns:
+            Tuple: (маска (h, w) bool или None, коэффициент уменьшения уровня маски)
+        """
+        try:
+            cache_path = self._tissue_cache_path(wsi_path)
+        except OSError as e:
+            logger.warning("Кэш маски ткани недоступен: %s", e)
+            cache_path = None
+        
+        if cache_path is not None and cache_path.exists():
+            try:
+                with np.load(cache_path) as cached:
+                    shape = tuple(cached['shape'])
+                    mask = np.unpackbits(cached['mask'], count=shape[0] * shape[1]).reshape(shape).astype(bool)
+                    return mask, float(cached['downsample'])
+            except Exception as e:
+                logger.warning("Кэш маски ткани %s не прочитан: %s", cache_path, e)
+        
+        tissue_mask, downsample = self._build_tissue_mask(wsi)
+        
+        if cache_path is not None and tissue_mask is not None:
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                np.savez(cache_path, mask=np.packbits(tissue_mask), shape=np.array(tissue_mask.shape),
+                         downsample=np.array(downsample))
+            except OSError as e:
+                logger.warning("Кэш маски ткани %s не сохранен: %s", cache_path, e)
+        
+        return tissue_mask, downsample
+    
+    def _build_tissue_mask(self, wsi: CuImage) -> Tuple[Optional[np.ndarray], float]:
+        """
+        Строит маску ткани по самому малому уровню пирамиды WSI
+        
+        Ткань темнее фона: пиксели яркости не выше порога Оцу считаются тканью,
+        затем маска расширяется на один пиксель (8-связность), чтобы не терять
+        края ткани. Без пирамиды (или при слабом уменьшении) маска не строится.
+        
+        Args:
+            wsi: Открытый CuImage
+            
+        Returns:
+            Tuple: (маска (h, w) bool или None, коэффициент уменьшения уровня маски)
+        """
+        try:
+            resolutions = wsi.resolutions
+            level = resolutions['level_count'] - 1
+            downsample = float(resolutions['level_downsamples'][level])
+            if level == 0 or downsample < 8:
+                return None, 1.0
+            
+            mask = read_tissue_mask(wsi, level)
+            return ndimage.binary_dilation(mask, structure=np.ones((3, 3), dtype=bool)), downsample
         except Exception as e:
-            print(f"❌ Ошибка извлечения патчей: {e}")
-            return []
+            logger.warning("Маска ткани по уменьшенному уровню не построена: %s", e)
+            return None, 1.0
+    
+    def _tissue_fraction(self, tissue_mask: np.ndarray, downsample: float,
+                         xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Доля ткани в окне маски под каждым патчем (по интегральному изображению маски)
+        
+        Args:
+            tissue_mask: Маска ткани (h, w) уменьшенного уровня
+            downsample: Коэффициент уменьшения уровня маски
+            xs, ys: Координаты левых верхних углов патчей (N,)
+            
+        Returns:
+            np.ndarray: Доля ткани (N,) для каждого патча
+        """
+        counts, areas = tissue_window_counts(tissue_mask, downsample, xs, ys, self.tile_size)
+        return np.divide(counts, areas, out=np.zeros(len(xs)), where=areas > 0)
+    
+    def _has_tissue_batch(self, patches: np.ndarray) -> np.ndarray:
+        """
+        Проверяет наличие ткани сразу в наборе патчей
+        
+        Среднее и дисперсия считаются по целочисленным суммам значений и их
+        квадратов для каждого патча, без отдельных проходов mean и std (с numba -
+        за один скомпилированный проход по памяти). Проверка "все пиксели > 240"
+        не нужна: она влечет среднее > 240.
+        
+        Args:
+            patches: Изображения патчей (N, ...) uint8 (numpy или CuPy)
+            
+        Returns:
+            np.ndarray: Маска (N,) патчей с тканью (как у _has_tissue)
+        """
+        flat = patches.reshape(len(patches), -1)
+        if CUPY_AVAILABLE and isinstance(flat, cupy.ndarray):
+            # На GPU хватает встроенных редукций; в RAM копируется только маска
+            return cupy.asnumpy((flat.mean(axis=1) < 240) & (flat.std(axis=1) > 10))
+        
+        num_values = flat.shape[1]
+        if NUMBA_AVAILABLE:
+            sums, squares = _patch_moments(flat)
+        else:
+            sums = flat.sum(axis=1, dtype=np.int64)
+            squares = np.einsum('ij,ij->i', flat, flat, dtype=np.int64)
+        
+        mean_brightness = sums / num_values
+        variance = squares / num_values - mean_brightness ** 2
+        return (mean_brightness < 240) & (variance > 100)
     
     def _has_tissue(self, patch: np.ndarray) -> bool:
         """
@@ -198,13 +451,17 @@ class SimplePatchLoader:
         try:
             import cv2
             
+            image = patch_info.image
+            if CUPY_AVAILABLE and isinstance(image, cupy.ndarray):
+                image = cupy.asnumpy(image)
+            
             # Конвертируем в формат для сохранения
-            if len(patch_info.image.shape) == 3:
+            if len(image.shape) == 3:
                 # RGB изображение
-                img_to_save = cv2.cvtColor(patch_info.image, cv2.COLOR_RGB2BGR)
+                img_to_save = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
             else:
                 # Grayscale
-                img_to_save = patch_info.image
+                img_to_save = image
             
             cv2.imwrite(output_path, img_to_save)
             
@@ -0,0 +1,98 @@
+"""
+Маска ткани WSI по уменьшенному уровню пирамиды.
+Используется загрузчиками патчей, чтобы не читать тайлы фона.
+"""
+
+from typing import Optional, Tuple
+import numpy as np
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """
+    Порог Оцу для uint8 изображения: межклассовая дисперсия считается сразу
+    для всех 256 порогов по кумулятивным суммам гистограммы
+    
+    Args:
+        gray: Изображение в оттенках серого uint8
+        
+    Returns:
+        int: Порог t (класс 0 - пиксели <= t)
+    """
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    cum_mean = np.cumsum(hist * np.arange(256))
+    
+    mean_low = np.divide(cum_mean, weight_low, out=np.zeros(256), where=weight_low > 0)
+    mean_high = np.divide(cum_mean[-1] - cum_mean, weight_high, out=np.zeros(256), where=weight_high > 0)
+    between_variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return int(np.argmax(between_variance))
+
+
+def read_tissue_mask(wsi, level: int) -> np.ndarray:
+    """
+    Маска ткани по уровню level пирамиды WSI
+    
+    Ткань темнее фона: тканью считаются пиксели яркости не выше порога Оцу.
+    
+    Args:
+        wsi: Открытый CuImage
+        level: Уровень пирамиды, читаемый целиком
+        
+    Returns:
+        np.ndarray: Маска (h, w) bool размера уровня
+    """
+    thumbnail = np.asarray(wsi.read_region(
+        location=(0, 0),
+        size=tuple(wsi.resolutions['level_dimensions'][level]),
+        level=level
+    ))[:, :, :3]
+    gray = (thumbnail @ np.array([0.299, 0.587, 0.114])).astype(np.uint8)
+    return gray <= otsu_threshold(gray)
+
+
+def build_tissue_mask(wsi, max_size: int = 5000) -> Tuple[Optional[np.ndarray], float]:
+    """
+    Маска ткани по самому детальному уровню WSI, помещающемуся в max_size
+    пикселей по большей стороне
+    
+    Args:
+        wsi: Открытый CuImage
+        max_size: Максимальный размер уровня маски по большей стороне
+        
+    Returns:
+        Tuple: (маска (h, w) bool или None без подходящего уровня,
+            коэффициент уменьшения уровня маски)
+    """
+    resolutions = wsi.resolutions
+    levels = [level for level in range(1, resolutions['level_count'])
+              if max(resolutions['level_dimensions'][level]) <= max_size]
+    if not levels:
+        return None, 1.0
+    return read_tissue_mask(wsi, levels[0]), float(resolutions['level_downsamples'][levels[0]])
+
+
+def tissue_window_counts(tissue_mask: np.ndarray, downsample: float, xs: np.ndarray, ys: np.ndarray,
+                         size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Число пикселей ткани в окне маски под каждым патчем (по интегральному изображению маски)
+    
+    Args:
+        tissue_mask: Маска ткани (h, w) уменьшенного уровня
+        downsample: Коэффициент уменьшения уровня маски
+        xs, ys: Координаты левых верхних углов патчей (N,)
+        size: Размер патча на уровне 0
+        
+    Returns:
+        Tuple: (число пикселей ткани (N,), площадь окна маски (N,))
+    """
+    integral = np.zeros((tissue_mask.shape[0] + 1, tissue_mask.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = tissue_mask.cumsum(axis=0).cumsum(axis=1)
+    
+    x0 = np.minimum(np.floor(xs / downsample), tissue_mask.shape[1]).astype(np.int64)
+    x1 = np.minimum(np.ceil((xs + size) / downsample), tissue_mask.shape[1]).astype(np.int64)
+    y0 = np.minimum(np.floor(ys / downsample), tissue_mask.shape[0]).astype(np.int64)
+    y1 = np.minimum(np.ceil((ys + size) / downsample), tissue_mask.shape[0]).astype(np.int64)
+    
+    counts = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return counts, (x1 - x0) * (y1 - y0)
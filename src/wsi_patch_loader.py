@@ -1,19 +1,20 @@
 """
-WSI Patch Loader с использованием MONAI GridPatchd.
-Извлекает патчи из WSI с отсевом пустых областей.
+WSI Patch Loader на основе cuCIM (через MONAI CuCIMWSIReader).
+Извлекает патчи из WSI с отсевом пустых областей по маске ткани.
 """
 
+import os
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional
 from monai.data import CuCIMWSIReader
-from monai.transforms import Compose, LoadImaged, EnsureChannelFirstd, GridPatchd
 import torch
 
-from .data_structures import PatchInfo, WSIInfo, Coords
+from .data_structures import PatchInfo, WSIInfo, Coords, morton_order
+from .tissue_mask import build_tissue_mask, tissue_window_counts
 
 
 class WSIPatchLoader:
-    """Загрузчик патчей из WSI с использованием MONAI GridPatchd"""
+    """Загрузчик патчей из WSI с отсевом фона по маске ткани уменьшенного уровня"""
     
     def __init__(self, tile_size: int = 512, overlap_ratio: float = 0.5):
         """
@@ -26,19 +27,35 @@ class WSIPatchLoader:
         self.tile_size = tile_size
         self.overlap_ratio = overlap_ratio
         self.step_size = int(tile_size * (1 - overlap_ratio))
+        # Шаг прореживания пикселей при проверке ткани (по обеим осям)
+        self.tissue_stride = 8
         
-        # Создаем transforms для MONAI
-        self.transforms = Compose([
-            LoadImaged(keys=["image"], reader=CuCIMWSIReader, level=0),
-            EnsureChannelFirstd(keys=["image"]),
-            GridPatchd(
-                keys=["image"],
-                patch_size=(tile_size, tile_size),
-                threshold=0.999 * 3 * 255 * tile_size * tile_size,
-                pad_mode=None,
-                constant_values=255,
-            )
-        ])
+        # Разбор метаданных WSI дорогой, поэтому читатель и открытые файлы переиспользуются
+        self._reader = CuCIMWSIReader(level=0)
+        self._wsi_handles = {}
+        
+        # Количество патчей в одном пакетном вызове read_region cuCIM и потоков декодирования
+        self.read_chunk_size = 64
+        self.num_workers = os.cpu_count() or 1
+        # Сбрасывается, если установленный cuCIM не читает список координат
+        self._batched_reads = True
+        # Патч без перекрытия пустой, если его сумма яркости не меньше порога (как в GridPatchd)
+        self.background_sum_threshold = 0.999 * 3 * 255 * tile_size * tile_size
+    
+    def _get_wsi(self, wsi_path: str):
+        """Открытый CuImage для WSI: файл открывается и разбирается один раз на путь"""
+        wsi = self._wsi_handles.get(wsi_path)
+        if wsi is None:
+            wsi = self._reader.read(wsi_path)
+            self._wsi_handles[wsi_path] = wsi
+        return wsi
+    
+    def close(self):
+        """Закрывает все открытые WSI"""
+        for wsi in self._wsi_handles.values():
+            if hasattr(wsi, 'close'):
+                wsi.close()
+        self._wsi_handles.clear()
     
     def load_wsi_info(self, wsi_path: str) -> WSIInfo:
         """
@@ -51,11 +68,9 @@ class WSIPatchLoader:
             WSIInfo: Информация о WSI
         """
         try:
-            # Создаем reader для получения метаданных
-            reader = CuCIMWSIReader(level=0)
-            
             # Получаем базовую информацию о WSI
-            wsi = reader.read(wsi_path)
+            reader = self._reader
+            wsi = self._get_wsi(wsi_path)
             
             # Извлекаем размеры
             if hasattr(wsi, 'shape'):
@@ -103,7 +118,7 @@ class WSIPatchLoader:
     
     def extract_patches(self, wsi_path: str) -> List[PatchInfo]:
         """
-        Извлекает патчи из WSI с использованием GridPatchd
+        Извлекает патчи с тканью из WSI по сетке без перекрытия
         
         Args:
             wsi_path: Путь к WSI файлу
@@ -114,50 +129,51 @@ class WSIPatchLoader:
         print(f"🔍 Извлечение патчей из WSI: {wsi_path}")
         
         try:
-            # Подготавливаем данные для transforms
-            data = {"image": wsi_path}
-            
-            # Применяем transforms
-            result = self.transforms(data)
-            
-            patches = []
-            patch_id = 0
-            
-            # Извлекаем патчи из результата
-            if "image" in result:
-                patches_array = result["image"]
-                
-                # Получаем координаты патчей
-                if "image_location" in result:
-                    locations = result["image_location"]
-                    
-                    for i, (patch_img, location) in enumerate(zip(patches_array, locations)):
-                        # location содержит координаты патча
-                        x, y = location[0], location[1]  # Координаты в WSI
-                        
-                        # Создаем PatchInfo
-                        patch_info = PatchInfo(
-                            patch_id=patch_id,
-                            x=x,
-                            y=y,
-                            size=self.tile_size,
-                            image=patch_img,
-                            has_tissue=True  # GridPatchd уже отфильтровал пустые патчи
-                        )
-                        
-                        patches.append(patch_info)
-                        patch_id += 1
-                
-                print(f"✅ Извлечено патчей: {len(patches)}")
-            else:
-                print("⚠️  Патчи не найдены в результате")
-            
+            patches = list(self.iter_patches(wsi_path))
+            print(f"✅ Извлечено патчей: {len(patches)}")
             return patches
             
         except Exception as e:
             print(f"❌ Ошибка извлечения патчей: {e}")
             return []
     
+    def iter_patches(self, wsi_path: str) -> Iterator[PatchInfo]:
+        """
+        Последовательно выдает патчи с тканью по сетке без перекрытия
+        
+        С уровня 0 пакетно читаются только клетки сетки с тканью на маске
+        уменьшенного уровня; среди них отбрасываются почти белые патчи (порог
+        суммы яркости, как в GridPatchd).
+        
+        Args:
+            wsi_path: Путь к WSI файлу
+            
+        Yields:
+            PatchInfo: Патч с тканью (RGB, H x W x 3)
+        """
+        wsi = self._get_wsi(wsi_path)
+        coords = self._tissue_grid(wsi, self.tile_size)
+        
+        patch_id = 0
+        for start in range(0, len(coords), self.read_chunk_size):
+            chunk = coords[start:start + self.read_chunk_size]
+            
+            patches = self._read_patches(wsi, chunk)
+            sums = patches.reshape(len(patches), -1).sum(axis=1, dtype=np.int64)
+            
+            for k in np.flatnonzero(sums < self.background_sum_threshold).tolist():
+                x, y = chunk[k]
+                yield PatchInfo(
+                    patch_id=patch_id,
+                    x=x,
+                    y=y,
+                    size=self.tile_size,
+                    # Копия: срез держал бы в памяти весь буфер части
+                    image=patches[k].copy(),
+                    has_tissue=True
+                )
+                patch_id += 1
+    
     def extract_patches_manual(self, wsi_path: str) -> List[PatchInfo]:
         """
         Альтернативный метод извлечения патчей вручную с перекрытием
@@ -171,46 +187,143 @@ class WSIPatchLoader:
         print(f"🔍 Ручное извлечение патчей из WSI: {wsi_path}")
         
         try:
-            # Загружаем WSI
-            reader = CuCIMWSIReader(level=0)
-            img_array, metadata = reader.get_data(wsi_path)
+            patches = list(self.iter_patches_manual(wsi_path))
+            print(f"✅ Извлечено патчей с тканью: {len(patches)}")
+            return patches
             
-            patches = []
-            patch_id = 0
+        except Exception as e:
+            print(f"❌ Ошибка ручного извлечения патчей: {e}")
+            return []
+    
+    def iter_patches_manual(self, wsi_path: str) -> Iterator[PatchInfo]:
+        """
+        Последовательно читает патчи с перекрытием и выдает патчи с тканью
+        
+        Координаты читаются частями по read_chunk_size патчей: каждая часть
+        передается в cuCIM одним вызовом read_region со списком координат,
+        который декодирует тайлы в num_workers потоках. В памяти находится
+        одна часть, а не весь слайд. Клетки без ткани на маске уменьшенного
+        уровня не читаются вовсе.
+        
+        Args:
+            wsi_path: Путь к WSI файлу
             
-            # Вычисляем сетку патчей с перекрытием
-            height, width = img_array.shape[:2]
+        Yields:
+            PatchInfo: Патч с тканью
+        """
+        # Открываем WSI без чтения пикселей (или берем уже открытый)
+        wsi = self._get_wsi(wsi_path)
+        
+        patch_id = 0
+        
+        # Вычисляем сетку патчей с перекрытием
+        height, width = wsi.shape[:2]
+        
+        print(f"📊 Размер WSI: {width}x{height}")
+        print(f"🔧 Параметры: tile_size={self.tile_size}, step_size={self.step_size}")
+        
+        # Извлекаем патчи с перекрытием
+        coords = self._tissue_grid(wsi, self.step_size)
+        
+        for start in range(0, len(coords), self.read_chunk_size):
+            chunk = coords[start:start + self.read_chunk_size]
             
-            print(f"📊 Размер WSI: {width}x{height}")
-            print(f"🔧 Параметры: tile_size={self.tile_size}, step_size={self.step_size}")
+            patches = self._read_patches(wsi, chunk)
             
-            # Извлекаем патчи с перекрытием
-            for y in range(0, height - self.tile_size + 1, self.step_size):
-                for x in range(0, width - self.tile_size + 1, self.step_size):
-                    # Извлекаем патч
-                    patch_img = img_array[y:y+self.tile_size, x:x+self.tile_size]
-                    
-                    # Проверяем, содержит ли патч ткань
-                    has_tissue = self._has_tissue(patch_img)
-                    
-                    if has_tissue:
-                        patch_info = PatchInfo(
-                            patch_id=patch_id,
-                            x=x,
-                            y=y,
-                            size=self.tile_size,
-                            image=patch_img,
-                            has_tissue=True
-                        )
-                        patches.append(patch_info)
-                        patch_id += 1
+            # Проверяем наличие ткани сразу во всей части
+            for k in np.flatnonzero(self._has_tissue_batch(patches)).tolist():
+                x, y = chunk[k]
+                yield PatchInfo(
+                    patch_id=patch_id,
+                    x=x,
+                    y=y,
+                    size=self.tile_size,
+                    # Копия: срез держал бы в памяти весь буфер части
+                    image=patches[k].copy(),
+                    has_tissue=True
+                )
+                patch_id += 1
+    
+    def _tissue_grid(self, wsi, step: int) -> List[Tuple[int, int]]:
+        """
+        Координаты клеток сетки с тканью на маске уменьшенного уровня
+        
+        Args:
+            wsi: Открытый CuImage
+            step: Шаг сетки
             
-            print(f"✅ Извлечено патчей с тканью: {len(patches)}")
-            return patches
+        Returns:
+            List[Tuple[int, int]]: Координаты (x, y) левых верхних углов патчей по строкам
+                сетки; без маски ткани - все клетки сетки
+        """
+        height, width = wsi.shape[:2]
+        ys, xs = np.mgrid[0:height - self.tile_size + 1:step,
+                          0:width - self.tile_size + 1:step].reshape(2, -1)
+        
+        tissue_mask, downsample = self._build_tissue_mask(wsi)
+        if tissue_mask is not None:
+            keep = tissue_window_counts(tissue_mask, downsample, xs, ys, self.tile_size)[0] > 0
+            xs, ys = xs[keep], ys[keep]
+        
+        return list(zip(xs.tolist(), ys.tolist()))
+    
+    def _build_tissue_mask(self, wsi, max_size: int = 5000) -> Tuple[Optional[np.ndarray], float]:
+        """
+        Строит маску ткани по уменьшенному уровню пирамиды WSI (см. build_tissue_mask)
+        
+        Args:
+            wsi: Открытый CuImage
+            max_size: Максимальный размер уровня маски по большей стороне
             
+        Returns:
+            Tuple: (маска (h, w) bool или None без подходящего уровня,
+                коэффициент уменьшения уровня маски)
+        """
+        try:
+            return build_tissue_mask(wsi, max_size)
         except Exception as e:
-            print(f"❌ Ошибка ручного извлечения патчей: {e}")
-            return []
+            print(f"⚠️  Маска ткани по уменьшенному уровню не построена: {e}")
+            return None, 1.0
+    
+    def _read_patches(self, wsi, chunk: List[Tuple[int, int]]) -> np.ndarray:
+        """
+        Читает часть патчей одним пакетным вызовом read_region
+        
+        Патчи копируются в один заранее выделенный массив, чтобы проверка
+        ткани шла одним проходом по непрерывной памяти. Если установленный
+        cuCIM не принимает список координат (TypeError вызова), эта и все
+        следующие части читаются по одному патчу; при другой ошибке по одному
+        перечитывается только эта часть.
+        
+        Args:
+            wsi: Открытый CuImage
+            chunk: Координаты левых верхних углов патчей
+            
+        Returns:
+            np.ndarray: RGB изображения патчей (N, tile_size, tile_size, 3) в порядке координат
+        """
+        size = (self.tile_size, self.tile_size)
+        patches = np.empty((len(chunk), self.tile_size, self.tile_size, 3), dtype=np.uint8)
+        
+        if self._batched_reads:
+            regions = None
+            try:
+                regions = wsi.read_region(location=chunk, size=size, level=0, num_workers=self.num_workers)
+                for k, region in enumerate(regions):
+                    patches[k] = np.asarray(region)[:, :, :3]
+                return patches
+            except Exception as e:
+                if regions is None and isinstance(e, TypeError):
+                    # Установленный cuCIM не принимает список координат или num_workers
+                    print(f"⚠️  Пакетное чтение cuCIM недоступно, патчи читаются по одному: {e}")
+                    self._batched_reads = False
+                else:
+                    # Ошибка чтения самой части не отключает пакетное чтение
+                    print(f"⚠️  Ошибка пакетного чтения части, патчи читаются по одному: {e}")
+        
+        for k, location in enumerate(chunk):
+            patches[k] = np.asarray(wsi.read_region(location, size))[:, :, :3]
+        return patches
     
     def _has_tissue(self, patch: np.ndarray) -> bool:
         """
@@ -222,14 +335,29 @@ class WSIPatchLoader:
         Returns:
             bool: True если патч содержит ткань
         """
-        # Простая проверка: если средняя яркость меньше 240, то есть ткань
-        if len(patch.shape) == 3:
-            mean_brightness = np.mean(patch)
-        else:
-            mean_brightness = np.mean(patch)
+        # Простая проверка: если средняя яркость меньше 240, то есть ткань.
+        # Для средней яркости достаточно каждого tissue_stride-го пикселя по обеим осям
+        mean_brightness = np.mean(patch[::self.tissue_stride, ::self.tissue_stride])
         
         return mean_brightness < 240  # Порог для определения ткани
     
+    def _has_tissue_batch(self, patches: np.ndarray) -> np.ndarray:
+        """
+        Проверяет наличие ткани сразу в наборе патчей
+        
+        Средняя яркость сравнивается через целочисленную сумму каждого патча,
+        одной редукцией numpy для всего набора; как и в _has_tissue, берется
+        каждый tissue_stride-й пиксель по обеим осям.
+        
+        Args:
+            patches: Изображения патчей (N, H, W, 3) uint8
+            
+        Returns:
+            np.ndarray: Маска (N,) патчей с тканью (как у _has_tissue)
+        """
+        sub = patches[:, ::self.tissue_stride, ::self.tissue_stride]
+        return sub.sum(axis=(1, 2, 3), dtype=np.int64) < 240 * sub[0].size
+    
     def get_patch_coordinates(self, wsi_info: WSIInfo) -> List[Tuple[int, int]]:
         """
         Вычисляет координаты всех патчей в WSI
@@ -238,15 +366,13 @@ class WSIPatchLoader:
             wsi_info: Информация о WSI
             
         Returns:
-            List[Tuple[int, int]]: Список координат (x, y) патчей
+            List[Tuple[int, int]]: Список координат (x, y) патчей в порядке кривой
+                Мортона: соседние патчи идут подряд, что бережет кэш тайлов декодера
         """
-        coordinates = []
-        
-        for y in range(0, wsi_info.height - self.tile_size + 1, self.step_size):
-            for x in range(0, wsi_info.width - self.tile_size + 1, self.step_size):
-                coordinates.append((x, y))
-        
-        return coordinates
+        ys, xs = np.mgrid[0:wsi_info.height - self.tile_size + 1:self.step_size,
+                          0:wsi_info.width - self.tile_size + 1:self.step_size].reshape(2, -1)
+        order = morton_order(xs // self.step_size, ys // self.step_size)
+        return list(zip(xs[order].tolist(), ys[order].tolist()))
     
     def save_patch(self, patch_info: PatchInfo, output_path: str):
         """
@@ -4,13 +4,13 @@
 """
 
 import os
-import json
+import itertools
 from typing import List, Dict, Any
 from pathlib import Path
 import time
-from tqdm import tqdm
+import numpy as np
 
-from data_structures import Model, WSIInfo, Prediction
+from data_structures import Model, WSIInfo, Prediction, boxes_to_array, write_predictions_json
 from simple_patch_loader import SimplePatchLoader
 from yolo_inference import YOLOInference
 from polygon_merger import PolygonMerger
@@ -22,7 +22,9 @@ class WSIYOLOPipeline:
     def __init__(self, models_config: List[Dict[str, Any]], 
                  tile_size: int = 512, 
                  overlap_ratio: float = 0.5,
-                 iou_threshold: float = 0.5):
+                 iou_threshold: float = 0.5,
+                 read_on_gpu: bool = False,
+                 batch_size: int = 32):
         """
         Инициализация pipeline
         
@@ -31,15 +33,18 @@ class WSIYOLOPipeline:
             tile_size: Размер патча
             overlap_ratio: Коэффициент перекрытия
             iou_threshold: Порог IoU для объединения
+            read_on_gpu: Читать патчи и проверять ткань на GPU (нужны CuPy и cuCIM с CUDA)
+            batch_size: Количество патчей в одном вызове YOLO моделей
         """
         self.tile_size = tile_size
         self.overlap_ratio = overlap_ratio
+        self.batch_size = batch_size
         
         # Создаем модели
         self.models = [Model(**config) for config in models_config]
         
         # Инициализируем компоненты
-        self.patch_loader = SimplePatchLoader(tile_size, overlap_ratio)
+        self.patch_loader = SimplePatchLoader(tile_size, overlap_ratio, read_on_gpu=read_on_gpu)
         self.yolo_inference = YOLOInference(self.models)
         self.polygon_merger = PolygonMerger(iou_threshold)
         
@@ -74,29 +79,31 @@ class WSIYOLOPipeline:
         print(f"   Размер: {wsi_info.width}x{wsi_info.height}")
         print(f"   Уровни: {wsi_info.levels}")
         
-        # 2. Извлекаем патчи
-        print("🔧 Извлечение патчей...")
-        patches = self.patch_loader.extract_patches(wsi_path, max_patches)
-        print(f"   Найдено патчей: {len(patches)}")
-        
-        if not patches:
-            print("⚠️  Патчи не найдены")
-            return []
-        
-        # Количество патчей уже ограничено в extract_patches
-        
-        # 3. Выполняем предсказания
-        print("🤖 Выполнение YOLO инференса...")
+        # 2-3. Извлекаем патчи потоком и сразу выполняем предсказания
+        print("🤖 Извлечение патчей и выполнение YOLO инференса...")
         all_predictions = []
-        
-        for patch in tqdm(patches, desc="Обработка патчей"):
+        total_patches = 0
+        
+        # Патчи передаются моделям батчами по batch_size
+        patches = self.patch_loader.iter_patches(wsi_path, max_patches)
+        while True:
+            batch = list(itertools.islice(patches, self.batch_size))
+            if not batch:
+                break
+            total_patches += len(batch)
             try:
-                predictions = self.yolo_inference.predict_patch(patch)
+                predictions = self.yolo_inference.predict_batch(batch, self.batch_size)
                 all_predictions.extend(predictions)
             except Exception as e:
-                print(f"⚠️  Ошибка обработки патча {patch.patch_id}: {e}")
+                print(f"⚠️  Ошибка обработки патчей {batch[0].patch_id}-{batch[-1].patch_id}: {e}")
                 continue
         
+        print(f"   Найдено патчей: {total_patches}")
+        
+        if total_patches == 0:
+            print("⚠️  Патчи не найдены")
+            return []
+        
         print(f"   Найдено предсказаний: {len(all_predictions)}")
         
         # 4. Фильтруем предсказания (исключаем только excl)
@@ -137,34 +144,22 @@ class WSIYOLOPipeline:
         if not predictions:
             return []
         
-        # Группируем предсказания по патчам (по координатам)
-        patch_predictions = {}
+        # Группируем предсказания по патчам: клетка 512x512 по левому верхнему углу bbox
+        cells = np.floor_divide(boxes_to_array(predictions)[:, :2], 512).astype(np.int64)
+        _, first_indices, cell_ids = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+        cell_ids = cell_ids.ravel()
         
-        for pred in predictions:
-            # Используем координаты bbox для группировки по патчам
-            patch_key = (int(pred.box.start.x // 512), int(pred.box.start.y // 512))
-            
-            if patch_key not in patch_predictions:
-                patch_predictions[patch_key] = []
-            patch_predictions[patch_key].append(pred)
+        # Если в патче есть только 'excl' - исключаем весь патч, иначе сохраняем все его предсказания
+        not_excl = np.array([pred.class_name != 'excl' for pred in predictions])
+        keep_cell = np.bincount(cell_ids, weights=not_excl, minlength=len(first_indices)) > 0
         
-        # Фильтруем патчи
-        filtered_predictions = []
+        num_kept = int(np.count_nonzero(keep_cell))
+        print(f"   Сохранено патчей: {num_kept}, исключено патчей только с фоном (excl): {len(keep_cell) - num_kept}")
         
-        for patch_key, patch_preds in patch_predictions.items():
-            # Получаем уникальные классы в этом патче
-            classes_in_patch = set(pred.class_name for pred in patch_preds)
-            
-            # Если есть только 'excl' - исключаем весь патч
-            if classes_in_patch == {'excl'}:
-                print(f"   Исключен патч {patch_key}: только фон (excl)")
-                continue
-            
-            # Если есть другие классы - сохраняем все предсказания патча
-            filtered_predictions.extend(patch_preds)
-            print(f"   Сохранен патч {patch_key}: классы {classes_in_patch}")
-        
-        return filtered_predictions
+        # Патчи в порядке первого предсказания, внутри патча - исходный порядок
+        order = np.argsort(first_indices[cell_ids], kind='stable')
+        order = order[keep_cell[cell_ids[order]]]
+        return [predictions[i] for i in order.tolist()]
     
     def _save_predictions(self, predictions: List[Prediction], 
                          output_path: str, wsi_info: WSIInfo):
@@ -179,38 +174,17 @@ class WSIYOLOPipeline:
         # Создаем директорию если не существует
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        # Подготавливаем данные для сохранения
-        results = {
+        # Предсказания кодируются и пишутся в файл по одному (orjson, если установлен)
+        header = {
             'wsi_info': {
                 'path': wsi_info.path,
                 'width': wsi_info.width,
                 'height': wsi_info.height,
                 'levels': wsi_info.levels,
                 'mpp': wsi_info.mpp
-            },
-            'predictions': []
-        }
-        
-        for pred in predictions:
-            pred_data = {
-                'class_name': pred.class_name,
-                'confidence': pred.conf,
-                'box': {
-                    'start': {'x': pred.box.start.x, 'y': pred.box.start.y},
-                    'end': {'x': pred.box.end.x, 'y': pred.box.end.y}
-                }
             }
-            
-            if pred.polygon:
-                pred_data['polygon'] = [
-                    {'x': p.x, 'y': p.y} for p in pred.polygon
-                ]
-            
-            results['predictions'].append(pred_data)
-        
-        # Сохраняем в JSON
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        }
+        write_predictions_json(output_path, header, predictions)
         
         print(f"💾 Результаты сохранены: {output_path}")
     
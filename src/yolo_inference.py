@@ -4,12 +4,19 @@ YOLO11-seg инференс для патчей WSI.
 """
 
 import numpy as np
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 from ultralytics import YOLO
 import torch
 from shapely.geometry import Polygon
 
 from data_structures import PatchInfo, Prediction, Model, Coords, Box
+from adaptive_polygon_simplifier import fast_simplify
+
+try:
+    import cupy
+    CUPY_AVAILABLE = True
+except ImportError:
+    CUPY_AVAILABLE = False
 
 
 class YOLOInference:
@@ -24,6 +31,8 @@ class YOLOInference:
         """
         self.models = models
         self.loaded_models = {}
+        # На GPU инференс идет в FP16: ultralytics переводит веса и вход в half
+        self.half = torch.cuda.is_available()
         
         # Загружаем все модели
         for model_config in models:
@@ -57,6 +66,46 @@ class YOLOInference:
             print(f"❌ Ошибка загрузки модели {model_config.model_path}: {e}")
             raise
     
+    def _model_input(self, image):
+        """
+        Вход модели для изображения патча
+        
+        Патч CuPy (прочитанный сразу в видеопамять) передается тензором
+        (1, 3, H, W) в [0, 1] на том же устройстве через DLPack, без копирования
+        в RAM и с тем же порядком каналов, что ultralytics дает массивам numpy.
+        Уже подготовленный тензор torch (3, H, W) или (N, 3, H, W) в [0, 1]
+        передается без преобразований (только с добавлением оси батча); массивы
+        numpy передаются как есть.
+        
+        Args:
+            image: RGB изображение патча (H, W, 3) uint8 или тензор (3, H, W) float
+            
+        Returns:
+            np.ndarray или torch.Tensor для вызова модели
+        """
+        if isinstance(image, torch.Tensor):
+            return image.unsqueeze(0) if image.dim() == 3 else image
+        if CUPY_AVAILABLE and isinstance(image, cupy.ndarray):
+            return self._rgb_to_model_tensor(torch.from_dlpack(image))
+        return image
+    
+    def _rgb_to_model_tensor(self, image: "torch.Tensor") -> "torch.Tensor":
+        """
+        Переводит RGB тензор (H, W, 3) uint8 во вход сети (1, 3, H, W) в [0, 1]
+        
+        Массив numpy ultralytics считает BGR и переставляет каналы перед сетью,
+        а тензор передает в сеть как есть. Поэтому каналы здесь тоже
+        переставляются: сеть получает одинаковый вход для патчей из RAM и из
+        видеопамяти.
+        
+        Args:
+            image: RGB изображение патча (H, W, 3) uint8
+            
+        Returns:
+            torch.Tensor: Вход сети (1, 3, H, W) float
+        """
+        return image.permute(2, 0, 1).flip(0).unsqueeze(0).float().div_(255.0)
+    
     def predict_patch(self, patch_info: PatchInfo) -> List[Prediction]:
         """
         Выполняет предсказания на одном патче для всех моделей
@@ -64,50 +113,118 @@ class YOLOInference:
         Args:
             patch_info: Информация о патче
             
+        Returns:
+            List[Prediction]: Список предсказаний
+        """
+        return self.predict_batch([patch_info], batch_size=1)
+    
+    def predict_batch(self, patches: List[PatchInfo], batch_size: int = 32) -> List[Prediction]:
+        """
+        Выполняет предсказания на наборе патчей для всех моделей
+        
+        Патчи передаются модели батчами по batch_size одним вызовом (один прямой
+        проход сети на батч) вместо вызова на каждый патч. Результаты
+        сопоставляются патчам по порядку; предсказания возвращаются в том же
+        порядке, что и при вызове predict_patch для каждого патча.
+        
+        Args:
+            patches: Список патчей
+            batch_size: Количество патчей в одном вызове модели
+            
         Returns:
             List[Prediction]: Список предсказаний
         """
         all_predictions = []
         
-        for model_path, model_data in self.loaded_models.items():
-            model = model_data['model']
-            config = model_data['config']
-            class_names = model_data['class_names']
-            
-            # Проверяем размер патча
-            if patch_info.size != config.window_size:
-                print(f"⚠️  Размер патча {patch_info.size} не соответствует размеру модели {config.window_size}")
-                continue
-            
-            try:
-                # Выполняем предсказание с NMS параметрами
-                results = model(patch_info.image, 
-                              conf=config.min_conf, 
-                              iou=0.5,  # NMS IoU threshold
-                              max_det=100,  # Максимум детекций
-                              verbose=False)
+        for start in range(0, len(patches), batch_size):
+            batch = patches[start:start + batch_size]
+            inputs = []
+            for patch in batch:
+                try:
+                    inputs.append(self._model_input(patch.image))
+                except Exception as e:
+                    # Патч с неподходящим изображением пропускается, остальной батч обрабатывается
+                    print(f"❌ Ошибка подготовки патча {patch.patch_id}: {e}")
+                    inputs.append(None)
+            patch_predictions = [[] for _ in batch]
+            
+            for model_path, model_data in self.loaded_models.items():
+                config = model_data['config']
                 
-                # Обрабатываем результаты
-                for result in results:
-                    if result.masks is not None:
-                        # Обрабатываем маски сегментации
-                        predictions = self._process_segmentation_results(
-                            result, patch_info, class_names
-                        )
-                        all_predictions.extend(predictions)
-                    else:
-                        # Обрабатываем только bounding boxes
-                        predictions = self._process_detection_results(
-                            result, patch_info, class_names
-                        )
-                        all_predictions.extend(predictions)
-                        
-            except Exception as e:
-                print(f"❌ Ошибка предсказания для модели {model_path}: {e}")
-                continue
+                # Проверяем размер патчей
+                indices = [k for k, patch in enumerate(batch) if patch.size == config.window_size]
+                if len(indices) < len(batch):
+                    print(f"⚠️  Размер {len(batch) - len(indices)} патчей не соответствует размеру модели "
+                          f"{config.window_size}")
+                indices = [k for k in indices if inputs[k] is not None]
+                if not indices:
+                    continue
+                
+                try:
+                    results = self._predict_model_batch(model_data, batch, inputs, indices)
+                except Exception as e:
+                    print(f"❌ Ошибка предсказания для модели {model_path}: {e}")
+                    if len(indices) == 1:
+                        continue
+                    # Повторяем батч по одному патчу: ошибка одного патча не теряет остальные
+                    results = []
+                    for k in indices:
+                        try:
+                            results.extend(self._predict_model_batch(model_data, batch, inputs, [k]))
+                        except Exception as e:
+                            print(f"❌ Ошибка предсказания патча {batch[k].patch_id} для модели {model_path}: {e}")
+                            results.append([])
+                
+                for k, predictions in zip(indices, results):
+                    patch_predictions[k].extend(predictions)
+            
+            for predictions in patch_predictions:
+                all_predictions.extend(predictions)
         
         return all_predictions
     
+    def _predict_model_batch(self, model_data: Dict, batch: List[PatchInfo], inputs: list,
+                             indices: List[int]) -> List[List[Prediction]]:
+        """
+        Один вызов модели на патчах batch[indices]
+        
+        Args:
+            model_data: Загруженная модель с конфигурацией и именами классов
+            batch: Патчи батча
+            inputs: Входы модели для патчей батча (_model_input)
+            indices: Индексы патчей батча, передаваемых модели
+            
+        Returns:
+            List[List[Prediction]]: Предсказания для каждого индекса из indices
+        """
+        config = model_data['config']
+        class_names = model_data['class_names']
+        
+        # Тензоры склеиваются в один батч (N, 3, H, W), массивы numpy передаются списком
+        model_input = [inputs[k] for k in indices]
+        if all(isinstance(x, torch.Tensor) for x in model_input):
+            model_input = torch.cat(model_input)
+        
+        # Выполняем предсказание с NMS параметрами
+        with torch.inference_mode():
+            results = model_data['model'](model_input, 
+                                          conf=config.min_conf, 
+                                          iou=0.5,  # NMS IoU threshold
+                                          max_det=100,  # Максимум детекций
+                                          half=self.half,
+                                          verbose=False)
+        
+        # Обрабатываем результаты
+        predictions = []
+        for k, result in zip(indices, results):
+            if result.masks is not None:
+                # Обрабатываем маски сегментации
+                predictions.append(self._process_segmentation_results(result, batch[k], class_names))
+            else:
+                # Обрабатываем только bounding boxes
+                predictions.append(self._process_detection_results(result, batch[k], class_names))
+        return predictions
+    
     def _process_segmentation_results(self, result, patch_info: PatchInfo, class_names: Dict) -> List[Prediction]:
         """
         Обрабатывает результаты сегментации
@@ -143,7 +260,7 @@ class YOLOInference:
             )
             
             # Создаем полигон из маски
-            polygon = self._mask_to_polygon(mask, patch_info.x, patch_info.y)
+            polygon_xy = self._mask_to_polygon(mask, patch_info.x, patch_info.y)
             
             # Фильтруем по минимальному размеру bbox
             bbox_width = x2 - x1
@@ -156,7 +273,7 @@ class YOLOInference:
                     class_name=class_name,
                     box=absolute_box,
                     conf=float(conf),
-                    polygon=polygon
+                    polygon_xy=polygon_xy
                 )
                 
                 predictions.append(prediction)
@@ -208,8 +325,7 @@ class YOLOInference:
                 prediction = Prediction(
                     class_name=class_name,
                     box=absolute_box,
-                    conf=float(conf),
-                    polygon=None
+                    conf=float(conf)
                 )
                 
                 predictions.append(prediction)
@@ -218,7 +334,7 @@ class YOLOInference:
         
         return predictions
     
-    def _mask_to_polygon(self, mask: np.ndarray, offset_x: int, offset_y: int) -> List[Coords]:
+    def _mask_to_polygon(self, mask: np.ndarray, offset_x: int, offset_y: int) -> Optional[np.ndarray]:
         """
         Преобразует маску в полигон с упрощением
         
@@ -228,7 +344,7 @@ class YOLOInference:
             offset_y: Смещение по Y
             
         Returns:
-            List[Coords]: Полигон в абсолютных координатах
+            Optional[np.ndarray]: Точки полигона (N, 2) в абсолютных координатах
         """
         try:
             from skimage import measure
@@ -237,16 +353,13 @@ class YOLOInference:
             contours = measure.find_contours(mask, 0.5)
             
             if not contours:
-                return []
+                return None
             
             # Берем самый большой контур
             largest_contour = max(contours, key=len)
             
-            # Преобразуем в абсолютные координаты
-            coords = []
-            for point in largest_contour:
-                x, y = point[1], point[0]  # skimage использует (row, col)
-                coords.append((offset_x + x, offset_y + y))
+            # Преобразуем в абсолютные координаты (skimage использует (row, col))
+            coords = largest_contour[:, ::-1] + np.array([offset_x, offset_y], dtype=np.float64)
             
             # Создаем Shapely полигон для умного упрощения
             if len(coords) >= 3:
@@ -256,28 +369,26 @@ class YOLOInference:
                         # Умное упрощение до максимум 60 точек
                         simplified = self._smart_simplify_polygon(poly, max_points=60)
                         
-                        # Преобразуем обратно в Coords
-                        polygon = []
-                        for x, y in simplified.exterior.coords[:-1]:  # Исключаем последнюю дублирующуюся точку
-                            polygon.append(Coords(x=x, y=y))
+                        # Исключаем последнюю дублирующуюся точку
+                        polygon = np.asarray(simplified.exterior.coords)[:-1]
                         
                         print(f"   Умное упрощение полигона: {len(coords)} -> {len(polygon)} точек")
                         return polygon
                     else:
                         print(f"⚠️  Невалидный полигон, используем исходный")
-                        return [Coords(x=x, y=y) for x, y in coords]
+                        return coords
                 except Exception as e:
                     print(f"⚠️  Ошибка упрощения полигона: {e}, используем исходный")
-                    return [Coords(x=x, y=y) for x, y in coords]
+                    return coords
             else:
-                return []
+                return None
             
         except ImportError:
             print("⚠️  scikit-image не установлен, полигоны не будут созданы")
-            return []
+            return None
         except Exception as e:
             print(f"⚠️  Ошибка создания полигона: {e}")
-            return []
+            return None
     
     def _smart_simplify_polygon(self, polygon: Polygon, max_points: int = 60) -> Polygon:
         """
@@ -305,7 +416,7 @@ class YOLOInference:
             # Бинарный поиск оптимального tolerance
             for _ in range(10):  # Максимум 10 итераций
                 tolerance = (min_tolerance + max_tolerance) / 2
-                simplified = current_poly.simplify(tolerance, preserve_topology=True)
+                simplified = fast_simplify(current_poly, tolerance)
                 
                 if simplified.is_valid and len(simplified.exterior.coords) > 3:
                     points_count = len(simplified.exterior.coords)
@@ -325,12 +436,14 @@ class YOLOInference:
             
             # Если все еще слишком много точек, используем равномерную выборку
             if len(best_poly.exterior.coords) > max_points:
-                coords = list(best_poly.exterior.coords)
-                step = len(coords) // max_points
-                sampled_coords = coords[::max(1, step)]
+                # Ровно max_points индексов по замкнутому кольцу: первая и последняя
+                # точки совпадают, поэтому кольцо остается замкнутым
+                coords = np.asarray(best_poly.exterior.coords)
+                indices = np.linspace(0, len(coords) - 1, max_points, dtype=np.int64)
+                sampled_coords = coords[indices]
                 
                 # Создаем новый полигон из выбранных точек
-                if len(sampled_coords) >= 3:
+                if len(sampled_coords) >= 4:
                     sampled_poly = Polygon(sampled_coords)
                     if sampled_poly.is_valid:
                         best_poly = sampled_poly
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Тесты пакетного адаптивного упрощения полигонов
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+from shapely.geometry import Polygon
+
+# Добавляем src в путь
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import adaptive_polygon_simplifier
+from adaptive_polygon_simplifier import AdaptivePolygonSimplifier, fast_simplify, simplify_rings, pack_rings, visvalingam_ring
+
+
+def _random_rings(count: int, seed: int = 0) -> list:
+    """Замкнутые кольца случайных валидных звездообразных полигонов"""
+    rng = np.random.default_rng(seed)
+    rings = []
+    while len(rings) < count:
+        n = int(rng.integers(8, 400))
+        angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+        radius = 40 + rng.normal(0, 2, n).cumsum() * 0.2 + rng.uniform(0, 6, n)
+        polygon = Polygon(np.c_[500 + radius * np.cos(angles), 500 + radius * np.sin(angles)])
+        if polygon.is_valid:
+            rings.append(np.asarray(polygon.exterior.coords))
+    return rings
+
+
+def test_simplify_rings_matches_geos():
+    """Ядро DP совпадает с simplify(preserve_topology=False) для валидных результатов"""
+    rings = _random_rings(50)
+    coords, offsets = pack_rings(rings)
+
+    for tolerance in (0.1, 1.0, 3.0):
+        simplified, simplified_offsets = simplify_rings(coords, offsets, tolerance)
+        for k, ring in enumerate(rings):
+            result = simplified[simplified_offsets[k]:simplified_offsets[k + 1]]
+            if len(result) < 4 or not Polygon(result).is_valid:
+                continue
+            expected = Polygon(ring).simplify(tolerance, preserve_topology=False)
+            assert np.array_equal(result, np.asarray(expected.exterior.coords))
+
+
+def _assert_batch_matches_scalar(simplifier: AdaptivePolygonSimplifier, rings: list):
+    """Сравнивает simplify_batch с поштучным simplify_polygon"""
+    batch_results = simplifier.simplify_batch(rings)
+    assert len(batch_results) == len(rings)
+
+    for ring, (batch_polygon, batch_metrics) in zip(rings, batch_results):
+        polygon, metrics = simplifier.simplify_polygon(Polygon(ring))
+        assert np.array_equal(np.asarray(batch_polygon.exterior.coords), np.asarray(polygon.exterior.coords))
+        assert batch_metrics['method'] == metrics['method']
+        assert batch_metrics['simplified_points'] == metrics['simplified_points']
+        assert np.isclose(batch_metrics['area_preserved'], metrics['area_preserved'])
+
+
+def test_simplify_batch_matches_simplify_polygon():
+    """Пакетное упрощение дает те же полигоны и метрики, что и поштучное"""
+    simplifier = AdaptivePolygonSimplifier()
+    _assert_batch_matches_scalar(simplifier, _random_rings(200, seed=1))
+    assert simplifier.simplify_batch([]) == []
+
+
+def test_simplify_batch_without_numba():
+    """Без numba шаг DP выполняет векторизованный shapely.simplify с тем же результатом"""
+    numba_available = adaptive_polygon_simplifier.NUMBA_AVAILABLE
+    adaptive_polygon_simplifier.NUMBA_AVAILABLE = False
+    try:
+        _assert_batch_matches_scalar(AdaptivePolygonSimplifier(), _random_rings(100, seed=2))
+    finally:
+        adaptive_polygon_simplifier.NUMBA_AVAILABLE = numba_available
+
+
+def test_simplify_batch_parallel():
+    """Упрощение частями в пуле процессов дает те же результаты в том же порядке"""
+    simplifier = AdaptivePolygonSimplifier()
+    rings = _random_rings(60, seed=3)
+
+    serial = simplifier.simplify_batch(rings)
+    parallel = simplifier.simplify_batch_parallel(rings, max_workers=2, chunk_size=16)
+
+    assert len(parallel) == len(serial)
+    for (polygon, metrics), (expected_polygon, expected_metrics) in zip(parallel, serial):
+        assert polygon.equals_exact(expected_polygon, 0)
+        assert metrics['method'] == expected_metrics['method']
+
+
+def test_visvalingam_ring_budget():
+    """Visvalingam-Whyatt оставляет ровно заданное число вершин и первой удаляет вершину на прямой"""
+    square = np.array([[0.0, 0.0], [1.0, 0.0], [2.0, 0.0], [2.0, 2.0], [0.0, 2.0]])
+    assert visvalingam_ring(square, 4).tolist() == [0, 2, 3, 4]
+
+    for ring in _random_rings(20, seed=4):
+        coords = ring[:-1]
+        kept = visvalingam_ring(coords, 12)
+        assert len(kept) == min(12, len(coords))
+        assert np.all(np.diff(kept) > 0)
+
+
+def test_fast_simplify_keeps_polygon():
+    """Быстрое упрощение не возвращает MultiPolygon"""
+    polygon = Polygon([(0.9, 1.6), (0.2, 8.1), (-0.1, 2.8), (-6.0, 4.0), (-1.6, 0.4),
+                       (-5.2, -1.3), (-5.5, -7.3), (-2.5, -7.9), (0.1, -4.6), (0.8, -1.0)])
+    # Douglas-Peucker без сохранения топологии разбивает этот полигон на части
+    assert polygon.simplify(3, preserve_topology=False).geom_type == 'MultiPolygon'
+    
+    simplified = fast_simplify(polygon, 3)
+    assert simplified.geom_type == 'Polygon' and simplified.is_valid
+
+
+if __name__ == "__main__":
+    test_simplify_rings_matches_geos()
+    test_simplify_batch_matches_simplify_polygon()
+    test_simplify_batch_without_numba()
+    test_simplify_batch_parallel()
+    test_visvalingam_ring_budget()
+    test_fast_simplify_keeps_polygon()
+    print("\n✅ Все тесты пройдены успешно!")
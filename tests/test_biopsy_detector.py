@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Тесты детектора биоптатов: маска, поиск по позиции и статистика
+"""
+
+import os
+import sys
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Добавляем src в путь
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from biopsy_detector import BiopsyDetector
+
+
+def _create_detector() -> BiopsyDetector:
+    """Создает детектор с тремя тестовыми биоптатами"""
+    config = {
+        "manual_analysis": {
+            "biopsy_regions": [
+                {"id": 1, "name": "B1", "x_min": 10, "y_min": 20, "x_max": 50, "y_max": 60, "width": 40, "height": 40},
+                {"id": 2, "name": "B2", "x_min": 100, "y_min": 5, "x_max": 150, "y_max": 30, "width": 50, "height": 25},
+                {"id": 3, "name": "B3", "x_min": 40, "y_min": 50, "x_max": 70, "y_max": 90, "width": 30, "height": 40},
+            ],
+            "recommended_grid": {"step_x": 64, "step_y": 64, "cell_width": 32, "cell_height": 32},
+        }
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(config, f)
+    try:
+        return BiopsyDetector(f.name)
+    finally:
+        os.unlink(f.name)
+
+
+def test_biopsy_mask():
+    """Маска совпадает с попиксельным заполнением регионов"""
+    detector = _create_detector()
+    width, height = 160, 100
+
+    mask = detector.create_biopsy_mask((width, height))
+    expected = np.zeros((height, width), dtype=bool)
+    for region in detector.biopsy_regions:
+        for x in range(region.x_min, min(region.x_max, width)):
+            for y in range(region.y_min, min(region.y_max, height)):
+                expected[y, x] = True
+
+    assert mask.shape == (height, width)
+    assert np.array_equal(mask, expected)
+    assert np.array_equal(detector.create_biopsy_mask((width, height), packed=True), np.packbits(expected, axis=1))
+    assert detector.create_biopsy_mask((width, height), downsample=8).shape == (13, 20)
+
+
+def test_biopsy_at_position():
+    """Поиск по позиции возвращает первый биоптат в порядке конфигурации"""
+    detector = _create_detector()
+    positions = [(10, 20), (50, 60), (45, 55), (60, 80), (120, 10), (0, 0), (150, 30)]
+    expected_ids = [1, 1, 1, 3, 2, None, 2]
+
+    for (x, y), expected_id in zip(positions, expected_ids):
+        region = detector.get_biopsy_at_position(x, y)
+        assert (region.id if region else None) == expected_id
+        assert detector.is_position_in_biopsy(x, y) == (expected_id is not None)
+
+    xs, ys = np.array(positions).T
+    indices = detector.get_biopsy_at_position_batch(xs, ys)
+    assert [detector.biopsy_regions[i].id if i >= 0 else None for i in indices] == expected_ids
+
+    assert [region.id for region in detector.get_biopsies_in_bbox(0, 0, 64, 64)] == [1, 3]
+    assert detector.get_biopsy_by_id(2).name == "B2"
+    assert detector.get_biopsy_by_id(9) is None
+
+
+def test_biopsy_statistics():
+    """Статистика и рекомендации, в том числе без загруженных биоптатов"""
+    detector = _create_detector()
+    stats = detector.get_biopsy_statistics()
+
+    assert stats["total_area"] == 40 * 40 + 50 * 25 + 30 * 40
+    assert stats["average_width"] == 40.0
+    assert stats["average_height"] == 35.0
+    assert detector.get_optimization_recommendations()["speed_optimization"]["time_reduction"] == "66.7%"
+
+    empty_detector = BiopsyDetector("nonexistent_config.json")
+    assert empty_detector.get_biopsy_statistics() == {}
+    assert empty_detector.get_optimization_recommendations()["speed_optimization"]["time_reduction"] == "N/A"
+
+
+def test_reload_config():
+    """Повторная загрузка конфигурации обновляет массивы границ и дерево биоптатов"""
+    detector = _create_detector()
+    assert detector.get_biopsy_at_position(30, 40).id == 1
+
+    config = {"manual_analysis": {
+        "biopsy_regions": [
+            {"id": 7, "name": "B7", "x_min": 200, "y_min": 200, "x_max": 260, "y_max": 240, "width": 60, "height": 40},
+        ],
+        "recommended_grid": {"step_x": 64, "step_y": 64, "cell_width": 32, "cell_height": 32},
+    }}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(config, f)
+    try:
+        detector.config_path = f.name
+        detector._load_config()
+    finally:
+        os.unlink(f.name)
+
+    assert detector.get_biopsy_at_position(30, 40) is None
+    assert detector.get_biopsy_at_position(210, 210).id == 7
+    assert [region.id for region in detector.get_biopsies_in_bbox(0, 0, 300, 300)] == [7]
+    assert detector.get_biopsy_at_position_batch(np.array([30, 210]), np.array([40, 210])).tolist() == [-1, 0]
+
+
+if __name__ == "__main__":
+    test_biopsy_mask()
+    test_biopsy_at_position()
+    test_biopsy_statistics()
+    test_reload_config()
+    print("\n✅ Все тесты пройдены успешно!")
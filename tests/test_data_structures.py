@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Тесты векторизованных операций над структурами данных
+"""
+
+import sys
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Добавляем src в путь
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from data_structures import (Prediction, Coords, Box, PatchInfo, PatchBatch, boxes_to_array, box_iou_matrix,
+                             box_iou_pairs, morton_order,
+                             predictions_to_records, records_to_predictions, prediction_to_dict,
+                             write_predictions_json)
+
+
+def _make_prediction(x1, y1, x2, y2, class_name="lp", conf=0.8):
+    """Создает предсказание с заданным bounding box"""
+    return Prediction(
+        class_name=class_name,
+        box=Box(start=Coords(x=x1, y=y1), end=Coords(x=x2, y=y2)),
+        conf=conf
+    )
+
+
+def test_box_iou_matrix_matches_box_iou():
+    """Матрица IoU совпадает с попарным Box.iou"""
+    print("🧪 Сравнение box_iou_matrix с Box.iou...")
+
+    predictions = [
+        _make_prediction(100, 100, 200, 200),
+        _make_prediction(105, 105, 195, 195),
+        _make_prediction(150, 150, 250, 250),
+        _make_prediction(300, 300, 400, 400),
+        _make_prediction(10, 10, 10, 10),  # Вырожденный box
+    ]
+
+    boxes = boxes_to_array(predictions)
+    iou_matrix = box_iou_matrix(boxes, boxes)
+
+    assert iou_matrix.shape == (len(predictions), len(predictions))
+    for i, pred1 in enumerate(predictions):
+        for j, pred2 in enumerate(predictions):
+            assert np.isclose(iou_matrix[i, j], pred1.box.iou(pred2.box))
+
+    rows, cols = np.triu_indices(len(predictions))
+    assert np.allclose(box_iou_pairs(boxes[rows], boxes[cols]), iou_matrix[rows, cols])
+
+    print("   ✅ Матрица IoU корректна")
+
+
+def test_boxes_to_array_empty():
+    """Пустой список дает массив формы (0, 4)"""
+    boxes = boxes_to_array([])
+    assert boxes.shape == (0, 4)
+    assert box_iou_matrix(boxes, boxes).shape == (0, 0)
+
+
+def test_prediction_polygon_from_array():
+    """Список Coords строится лениво из polygon_xy и следует за его заменой"""
+    pred = Prediction(class_name="lp", box=Box(start=Coords(x=0, y=0), end=Coords(x=2, y=2)), conf=0.9,
+                      polygon_xy=np.array([[0.0, 0.0], [2.0, 0.0], [2.0, 2.0]]))
+    assert pred.polygon == [Coords(x=0.0, y=0.0), Coords(x=2.0, y=0.0), Coords(x=2.0, y=2.0)]
+    assert pred.polygon is pred.polygon
+
+    pred.polygon_xy = np.array([[1.0, 1.0], [3.0, 1.0], [3.0, 3.0]])
+    assert pred.polygon[0] == Coords(x=1.0, y=1.0)
+
+    pred.polygon = [Coords(x=5, y=5), Coords(x=6, y=5), Coords(x=6, y=6)]
+    assert pred.polygon_xy.tolist() == [[5, 5], [6, 5], [6, 6]]
+
+    pred.polygon = None
+    assert pred.polygon is None and pred.polygon_xy is None
+
+
+def test_prediction_records_roundtrip():
+    """Структурированный массив сохраняет класс, уверенность и box"""
+    predictions = [_make_prediction(1, 2, 3, 4, "lp", 0.9), _make_prediction(5, 6, 7, 8, "mild", 0.75)]
+    records = predictions_to_records(predictions)
+
+    assert records['class_name'].tolist() == ["lp", "mild"]
+    assert np.array_equal(boxes_to_array(predictions), np.stack([records[k] for k in ('x1', 'y1', 'x2', 'y2')], axis=1))
+
+    restored = records_to_predictions(records, [None, np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]])])
+    assert restored[0] == predictions[0] and restored[1] == predictions[1]
+    assert restored[0].polygon is None and restored[1].num_points == 3
+
+
+def test_patch_batch_roundtrip():
+    """PatchBatch хранит поля патчей массивами и фильтрует по ткани"""
+    patches = [
+        PatchInfo(patch_id=i, x=i * 64, y=i * 32, size=64,
+                  image=np.full((64, 64, 3), i, dtype=np.uint8), has_tissue=i % 2 == 0)
+        for i in range(5)
+    ]
+
+    batch = PatchBatch.from_patches(patches)
+    assert len(batch) == 5
+    assert batch.images.shape == (5, 64, 64, 3)
+    assert batch.to_patches()[3].x == 192
+
+    tissue = batch.tissue_only()
+    assert tissue.patch_ids.tolist() == [0, 2, 4]
+    for patch_id, x, y, image in tissue.iter_patches():
+        assert (x, y) == (patch_id * 64, patch_id * 32)
+        assert image[0, 0, 0] == patch_id
+
+    assert len(PatchBatch.from_patches([])) == 0
+
+
+def test_morton_order():
+    """Обход сетки по кривой Мортона: блоки 2x2 подряд, каждая клетка ровно один раз"""
+    rows, cols = np.mgrid[0:4, 0:4].reshape(2, -1)
+    order = morton_order(cols, rows)
+
+    assert list(zip(cols[order][:8].tolist(), rows[order][:8].tolist())) == [
+        (0, 0), (1, 0), (0, 1), (1, 1), (2, 0), (3, 0), (2, 1), (3, 1)
+    ]
+
+    rows, cols = np.mgrid[0:37, 0:53].reshape(2, -1)
+    assert np.array_equal(np.sort(morton_order(cols, rows)), np.arange(37 * 53))
+
+
+def test_write_predictions_json():
+    """Потоковая запись JSON совпадает с кодированием всего словаря, в том числе без предсказаний"""
+    predictions = [_make_prediction(1, 2, 3, 4, "lp", 0.9), _make_prediction(5, 6, 7, 8, "фон", 0.75)]
+    predictions[1].polygon_xy = np.array([[5.0, 6.0], [7.0, 6.0], [7.0, 8.0]])
+    header = {'wsi_info': {'path': "slide.tiff", 'width': 100, 'height': 50, 'levels': 3, 'mpp': None}}
+
+    for items in (predictions, []):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "predictions.json"
+            write_predictions_json(str(path), header, iter(items))
+            loaded = json.loads(path.read_text(encoding='utf-8'))
+
+        assert loaded == {**header, 'predictions': [prediction_to_dict(p) for p in items]}
+
+    assert "polygon" not in prediction_to_dict(predictions[0])
+    assert prediction_to_dict(predictions[1])["polygon"][2] == {'x': 7.0, 'y': 8.0}
+
+
+if __name__ == "__main__":
+    test_box_iou_matrix_matches_box_iou()
+    test_boxes_to_array_empty()
+    test_prediction_polygon_from_array()
+    test_prediction_records_roundtrip()
+    test_patch_batch_roundtrip()
+    test_morton_order()
+    test_write_predictions_json()
+    print("\n✅ Все тесты пройдены успешно!")
@@ -5,18 +5,21 @@
 и фильтрацию коротких сегментов для lp модели.
 """
 
+import concurrent.futures
 import sys
 import os
 import numpy as np
 from pathlib import Path
 from typing import List
-from shapely.geometry import Polygon
+from shapely.geometry import Point, Polygon
+from shapely.ops import unary_union
 
 # Добавляем src в путь
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
-from data_structures import Prediction, Coords, Box
+from data_structures import Prediction, Coords, Box, predictions_to_records
 from improved_polygon_merger import ImprovedPolygonMerger
+from polygon_merger import union_polygons
 
 
 class ImprovedMergerTester:
@@ -387,6 +390,91 @@ class ImprovedMergerTester:
         
         return stats
     
+    def test_records_input(self):
+        """Тестирует объединение для структурированного массива предсказаний"""
+        print("🧪 Тестирование объединения для структурированного массива...")
+        
+        predictions = self.create_test_predictions()
+        records = predictions_to_records(predictions)
+        polygons = [pred.polygon_xy for pred in predictions]
+        
+        merged_from_list = self.merger.merge_predictions(predictions)
+        merged_from_records = self.merger.merge_predictions(records, polygons)
+        
+        assert len(merged_from_records) == len(merged_from_list)
+        for pred1, pred2 in zip(merged_from_list, merged_from_records):
+            assert pred1.class_name == pred2.class_name
+            assert np.allclose(pred1.polygon_xy, pred2.polygon_xy)
+        
+        print("   ✅ Массив и список дают одинаковый результат")
+    
+    def test_union_by_components(self):
+        """Тестирует объединение по компонентам связности против unary_union всего набора"""
+        print("🧪 Тестирование объединения по компонентам связности...")
+        
+        rng = np.random.default_rng(0)
+        centers = rng.uniform(0, 2000, (300, 2))
+        polygons = np.array([Point(x, y).buffer(rng.uniform(5, 60)) for x, y in centers], dtype=object)
+        
+        expected = unary_union(list(polygons))
+        
+        parts = union_polygons(polygons)
+        assert len(parts) == len(expected.geoms)
+        assert unary_union(parts).symmetric_difference(expected).area < 1e-9 * expected.area
+        
+        # Каскадное объединение частями в пуле потоков дает те же части
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            cascaded = union_polygons(polygons, executor, chunk_size=8)
+        assert len(cascaded) == len(parts)
+        assert unary_union(cascaded).symmetric_difference(expected).area < 1e-9 * expected.area
+        
+        print(f"   ✅ {len(parts)} частей совпадают с unary_union")
+    
+    def test_iou_filtering_matches_dense(self):
+        """Тестирует IoU фильтрацию по парам из STRtree против перебора всех пар"""
+        print("🧪 Сравнение IoU фильтрации с перебором всех пар...")
+        
+        rng = np.random.default_rng(1)
+        predictions = []
+        for k in range(400):
+            # Соседние объекты - сдвинутые копии одного bbox, часть из них дубликаты
+            if k % 4 == 0:
+                x, y = rng.uniform(0, 1500, 2)
+                w, h = rng.uniform(40, 120, 2)
+            else:
+                x, y = x + rng.uniform(-15, 15), y + rng.uniform(-15, 15)
+            box = Box(start=Coords(x=x, y=y), end=Coords(x=x + w, y=y + h))
+            predictions.append(Prediction(class_name=("lp", "mild")[k % 3 == 0], box=box, conf=float(rng.uniform(0.3, 1.0))))
+        
+        filtered = self.merger.filter_by_improved_iou(predictions)
+        
+        expected = []
+        for pred in sorted(predictions, key=lambda p: p.conf, reverse=True):
+            if not any(pred.class_name == kept.class_name and pred.box.iou(kept.box) > self.merger.iou_threshold
+                       for kept in expected):
+                expected.append(pred)
+        
+        assert [id(pred) for pred in filtered] == [id(pred) for pred in expected]
+        print(f"   ✅ Оставлено {len(filtered)} из {len(predictions)}, как при переборе")
+    
+    def test_merged_polygons_cached(self):
+        """Тестирует, что объединенные предсказания несут свой полигон без дыр"""
+        print("🧪 Тестирование кэша полигонов объединенных предсказаний...")
+        
+        merged_predictions = self.merger.merge_predictions(self.create_test_predictions())
+        cached = [self.merger.cached_polygon(pred) for pred in merged_predictions]
+        
+        assert any(polygon is not None for polygon in cached)
+        for pred, polygon in zip(merged_predictions, cached):
+            if polygon is not None:
+                assert polygon.equals_exact(Polygon(pred.polygon_xy), 0)
+        
+        # Замена точек сбрасывает кэш
+        pred = merged_predictions[0]
+        pred.polygon_xy = pred.polygon_xy.copy()
+        assert self.merger.cached_polygon(pred) is None
+        print("   ✅ Кэшированные полигоны совпадают с построенными из точек")
+    
     def run_all_tests(self):
         """Запускает все тесты"""
         print("🚀 Запуск тестов улучшенного алгоритма объединения")
@@ -413,6 +501,22 @@ class ImprovedMergerTester:
             stats = self.test_complete_merger_pipeline()
             print()
             
+            # Тест 6: Структурированный массив на входе
+            self.test_records_input()
+            print()
+            
+            # Тест 7: Объединение по компонентам связности
+            self.test_union_by_components()
+            print()
+            
+            # Тест 8: IoU фильтрация по парам из пространственного индекса
+            self.test_iou_filtering_matches_dense()
+            print()
+            
+            # Тест 9: Кэш полигонов объединенных предсказаний
+            self.test_merged_polygons_cached()
+            print()
+            
             print("📊 Итоговая статистика:")
             print("-" * 40)
             print(f"Исходных предсказаний: {stats['total_original']}")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Тесты вспомогательных методов улучшенного pipeline (без загрузки моделей и WSI)
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Добавляем src в путь
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from data_structures import PatchInfo
+from improved_wsi_yolo_pipeline import ImprovedWSIYOLOPipeline
+
+
+def _create_pipeline() -> ImprovedWSIYOLOPipeline:
+    """Pipeline без инициализации моделей: только параметры, нужные проверяемым методам"""
+    pipeline = ImprovedWSIYOLOPipeline.__new__(ImprovedWSIYOLOPipeline)
+    pipeline.mask_crop_margin = 5
+    return pipeline
+
+
+def test_polygon_from_mask_bleeding_past_box():
+    """Маска, выходящая за box на несколько пикселей, дает тот же контур, что и вся маска"""
+    pipeline = _create_pipeline()
+    patch = PatchInfo(patch_id=0, x=1000, y=2000, size=128, image=None)
+
+    # Маска как у YOLO: обрезана по box на сетке прототипов (1/4) и растянута билинейно,
+    # поэтому пиксели маски выходят за box
+    yy, xx = np.mgrid[0:128, 0:128]
+    mask = ((xx - 60) ** 2 / 30.0 ** 2 + (yy - 70) ** 2 / 20.0 ** 2 <= 1).astype(np.float32)
+    box = (33.0, 52.0, 87.0, 88.0)
+    assert mask[:, :int(box[0]) - 1].any() and mask[:, int(box[2]) + 1:].any()
+
+    full = pipeline._create_polygon_from_mask(mask, patch)
+    cropped = pipeline._create_polygon_from_mask(mask, patch, box)
+    assert np.allclose(full, cropped)
+
+    # Маска, выходящая за box дальше запаса окна, тоже не обрезается
+    pipeline.mask_crop_margin = 1
+    assert np.allclose(full, pipeline._create_polygon_from_mask(mask, patch, box))
+
+
+def test_tensor_batch_matches_numpy_preprocessing():
+    """Батч для моделей совпадает с тем, что ultralytics готовит из того же патча numpy"""
+    from ultralytics.data.augment import LetterBox
+
+    pipeline = _create_pipeline()
+    pipeline.device, pipeline.half, pipeline.imgsz = "cpu", False, 640
+    pipeline.input_scale_folded = False
+    patch = np.random.default_rng(0).integers(0, 256, (512, 512, 3), dtype=np.uint8)
+
+    # ultralytics для массивов numpy: LetterBox до imgsz, BGR -> RGB, HWC -> CHW, / 255
+    letterboxed = LetterBox((640, 640), auto=False)(image=patch)
+    expected = torch.from_numpy(np.ascontiguousarray(letterboxed[..., ::-1].transpose(2, 0, 1)))[None].float() / 255
+
+    batch_tensor = pipeline._images_to_tensor(torch.from_numpy(patch[None]))
+    assert batch_tensor.shape == expected.shape
+    # LetterBox округляет результат cv2.resize до uint8
+    assert (batch_tensor - expected).abs().max() <= 1 / 255 + 1e-6
+
+    # Патч размера imgsz не масштабируется, только переставляются каналы
+    pipeline.imgsz = 512
+    expected = torch.from_numpy(np.ascontiguousarray(patch[..., ::-1].transpose(2, 0, 1)))[None].float() / 255
+    assert torch.equal(pipeline._images_to_tensor(torch.from_numpy(patch[None])), expected)
+
+
+if __name__ == "__main__":
+    test_polygon_from_mask_bleeding_past_box()
+    test_tensor_batch_matches_numpy_preprocessing()
+    print("\n✅ Все тесты пройдены успешно!")
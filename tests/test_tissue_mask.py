@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Тесты маски ткани по уменьшенному уровню WSI
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Добавляем src в путь
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from tissue_mask import otsu_threshold, tissue_window_counts
+
+
+def test_otsu_threshold_splits_modes():
+    """Порог Оцу лежит между двумя модами гистограммы (ткань темнее фона)"""
+    rng = np.random.default_rng(0)
+    gray = np.concatenate([rng.normal(90, 10, 3000), rng.normal(220, 8, 7000)]).clip(0, 255).astype(np.uint8)
+
+    threshold = otsu_threshold(gray)
+    assert 100 < threshold < 200
+    assert (gray <= threshold).sum() == 3000
+
+
+def test_tissue_window_counts_matches_direct_sum():
+    """Счет ткани по интегральному изображению совпадает с прямой суммой окна маски"""
+    rng = np.random.default_rng(1)
+    tissue_mask = rng.random((23, 31)) < 0.1
+    downsample, size = 16.0, 100
+    ys, xs = np.mgrid[0:23 * 16:50, 0:31 * 16:50].reshape(2, -1)
+
+    counts, areas = tissue_window_counts(tissue_mask, downsample, xs, ys, size)
+    for k, (x, y) in enumerate(zip(xs, ys)):
+        window = tissue_mask[int(y // downsample):int(np.ceil((y + size) / downsample)),
+                             int(x // downsample):int(np.ceil((x + size) / downsample))]
+        assert counts[k] == window.sum()
+        assert areas[k] == window.size
+
+
+if __name__ == "__main__":
+    test_otsu_threshold_splits_modes()
+    test_tissue_window_counts_matches_direct_sum()
+    print("\n✅ Все тесты пройдены успешно!")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Тесты подготовки входа YOLO моделей (без загрузки моделей)
+"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+# Добавляем src в путь
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from data_structures import Model, PatchInfo
+from yolo_inference import YOLOInference
+
+
+def test_gpu_input_matches_numpy_channel_order():
+    """Тензор для патча из видеопамяти совпадает с тем, что ultralytics делает из массива numpy"""
+    inference = YOLOInference([])
+    image = np.random.default_rng(0).integers(0, 256, (32, 48, 3), dtype=np.uint8)
+
+    # ultralytics для массивов numpy: BGR -> RGB, HWC -> CHW, / 255
+    expected = torch.from_numpy(np.ascontiguousarray(image[..., ::-1].transpose(2, 0, 1)))[None].float() / 255
+
+    model_input = inference._rgb_to_model_tensor(torch.from_numpy(image))
+    assert model_input.shape == (1, 3, 32, 48)
+    assert torch.equal(model_input, expected)
+
+
+def test_predict_batch_keeps_patches_after_batch_error():
+    """Ошибка одного патча в батче не теряет предсказания остальных патчей"""
+    class FailingModel:
+        """Модель, которая падает на батче с изображением неверной формы"""
+        def __call__(self, images, **kwargs):
+            if any(image.ndim != 3 for image in images):
+                raise ValueError("неверная форма изображения")
+            return [SimpleNamespace(masks=None) for _ in images]
+
+    inference = YOLOInference([])
+    inference.loaded_models = {
+        "model.pt": {'model': FailingModel(), 'config': Model(model_path="model.pt", window_size=8),
+                     'class_names': {0: "lp"}}
+    }
+    inference._process_detection_results = lambda result, patch, class_names: [patch.patch_id]
+
+    patches = [PatchInfo(patch_id=k, x=0, y=0, size=8, image=np.zeros((8, 8, 3), dtype=np.uint8))
+               for k in range(5)]
+    patches[2].image = np.zeros((8, 8), dtype=np.uint8)
+
+    assert inference.predict_batch(patches, batch_size=4) == [0, 1, 3, 4]
+
+
+if __name__ == "__main__":
+    test_gpu_input_matches_numpy_channel_order()
+    test_predict_batch_keeps_patches_after_batch_error()
+    print("\n✅ Все тесты пройдены успешно!")